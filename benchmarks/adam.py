@@ -0,0 +1,82 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+
+"""
+Benchmark fairscale.optim.Adam against torch.optim.Adam, on a set of params shaped like a small transformer.
+
+On CUDA, fairscale Adam uses the fused kernel if the extension is built, and the multi-tensor implementation
+otherwise (or on CPU). On CPU, fairscale CPUAdam is benchmarked as well. For instance:
+
+    python benchmarks/adam.py --cpu
+"""
+
+import argparse
+import logging
+import time
+from typing import Callable, List
+
+import torch
+
+from fairscale.optim import Adam, CPUAdam, Precision
+
+
+def make_params(num_layers: int, hidden: int, device: torch.device, dtype: torch.dtype) -> List[torch.Tensor]:
+    params = []
+    for _ in range(num_layers):
+        for shape in [(4 * hidden, hidden), (4 * hidden,), (hidden, 4 * hidden), (hidden,), (hidden,), (hidden,)]:
+            p = torch.randn(shape, device=device, dtype=dtype, requires_grad=True)
+            p.grad = torch.randn_like(p) * 1e-3
+            params.append(p)
+    return params
+
+
+def benchmark(name: str, make_optimizer: Callable, params: List[torch.Tensor], args: argparse.Namespace) -> None:
+    optimizer = make_optimizer(params)
+    timings: List[float] = []
+    for i in range(args.warmup + args.iterations):
+        if params[0].is_cuda:
+            torch.cuda.synchronize()
+        start = time.monotonic()
+        optimizer.step()
+        if params[0].is_cuda:
+            torch.cuda.synchronize()
+        if i >= args.warmup:
+            timings.append((time.monotonic() - start) * 1000.0)
+
+    print(f"{name:<48} {sorted(timings)[len(timings) // 2]:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark fairscale Adam against torch.optim.Adam")
+    parser.add_argument("--num_layers", action="store", default=12, type=int)
+    parser.add_argument("--hidden", action="store", default=256, type=int)
+    parser.add_argument("--warmup", action="store", default=3, type=int)
+    parser.add_argument("--iterations", action="store", default=20, type=int)
+    parser.add_argument("--cpu", action="store_true", default=False)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logging.info("Benchmark arguments: %s" % args)
+
+    device = torch.device("cpu") if args.cpu or not torch.cuda.is_available() else torch.device("cuda")
+
+    fp32_params = make_params(args.num_layers, args.hidden, device, torch.float32)
+    benchmark("torch.optim.Adam", lambda p: torch.optim.Adam(p, lr=1e-3), fp32_params, args)
+    try:
+        benchmark("torch.optim.Adam (foreach)", lambda p: torch.optim.Adam(p, lr=1e-3, foreach=True), fp32_params, args)
+    except TypeError:
+        logging.info("torch.optim.Adam has no foreach implementation in this version")
+    benchmark("fairscale Adam", lambda p: Adam(p, lr=1e-3), fp32_params, args)
+    if device.type == "cpu":
+        benchmark("fairscale CPUAdam", lambda p: CPUAdam(p, lr=1e-3), fp32_params, args)
+        benchmark(
+            "fairscale CPUAdam, FP16 copy",
+            lambda p: CPUAdam(p, lr=1e-3, low_precision_dtype=torch.float16),
+            fp32_params,
+            args,
+        )
+
+    fp16_params = make_params(args.num_layers, args.hidden, device, torch.float16)
+    for precision in [Precision.MIXED_PRECISION, Precision.MEMORY_EFFICIENT_MIXED_PRECISION, Precision.PURE_FP16]:
+        benchmark(
+            f"fairscale Adam {precision.name}", lambda p: Adam(p, lr=1e-3, precision=precision), fp16_params, args
+        )
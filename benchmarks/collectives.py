@@ -0,0 +1,96 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+
+"""
+Microbenchmark of the reduce_scatter and all_gather strategies from fairscale.utils.collectives.
+
+Use it to check which fallback is the fastest on a given backend and interconnect, for instance:
+
+    python benchmarks/collectives.py --world_size 4 --gloo
+"""
+
+import argparse
+import logging
+import tempfile
+import time
+from typing import Callable, List
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from fairscale.utils.collectives import CollectiveStrategy, all_gather, reduce_scatter
+
+
+def _time(fn: Callable, warmup: int, iterations: int, device: torch.device) -> float:
+    """Median time of a collective, in ms"""
+    timings: List[float] = []
+    for i in range(warmup + iterations):
+        dist.barrier()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.monotonic()
+        fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        if i >= warmup:
+            timings.append((time.monotonic() - start) * 1000.0)
+    return sorted(timings)[len(timings) // 2]
+
+
+def run(rank: int, args: argparse.Namespace, backend: str, temp_file_name: str) -> None:
+    dist.init_process_group(
+        init_method="file://" + temp_file_name, backend=backend, rank=rank, world_size=args.world_size
+    )
+    if backend == "nccl":
+        torch.cuda.set_device(rank)
+    device = torch.device("cuda", rank) if backend == "nccl" else torch.device("cpu")
+    world_size = args.world_size
+
+    strategies = [CollectiveStrategy.NATIVE, CollectiveStrategy.ALL_REDUCE, CollectiveStrategy.RING]
+    if rank == 0:
+        print("collective      strategy    elements    median (ms)")
+
+    for numel in args.sizes:
+        inputs = [torch.rand(numel, device=device) for _ in range(world_size)]
+        output = torch.zeros(numel, device=device)
+        outputs = [torch.zeros(numel, device=device) for _ in range(world_size)]
+
+        for strategy in strategies:
+            for name, fn in (
+                ("reduce_scatter", lambda: reduce_scatter(output, inputs, strategy=strategy)),
+                ("all_gather", lambda: all_gather(outputs, output, strategy=strategy)),
+            ):
+                try:
+                    timing = _time(fn, args.warmup, args.iterations, device)
+                except (AssertionError, RuntimeError) as e:
+                    # The native collective is not supported by all backends
+                    logging.debug("%s %s failed: %s" % (name, strategy.value, e))
+                    continue
+
+                if rank == 0:
+                    print(f"{name:<15} {strategy.value:<11} {numel:<11} {timing:.3f}")
+
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the reduce_scatter and all_gather fallback strategies")
+    parser.add_argument("--world_size", action="store", default=2, type=int)
+    parser.add_argument(
+        "--sizes", action="store", nargs="+", default=[1024, 65536, 1048576, 8388608], type=int,
+    )
+    parser.add_argument("--warmup", action="store", default=2, type=int)
+    parser.add_argument("--iterations", action="store", default=10, type=int)
+    parser.add_argument("--gloo", action="store_true", default=False)
+    parser.add_argument("--debug", action="store_true", default=False, help="Display additional debug information")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if not args.debug else logging.DEBUG)
+    logging.info("Benchmark arguments: %s" % args)
+
+    BACKEND = "nccl" if not args.gloo and torch.cuda.is_available() else "gloo"
+
+    mp.spawn(
+        run, args=(args, BACKEND, tempfile.mkstemp()[1]), nprocs=args.world_size, join=True,  # type: ignore
+    )
@@ -74,6 +74,7 @@ class OptimType(str, Enum):
     vanilla = "pytorch"
     oss_ddp = "oss_ddp"
     oss_sharded_ddp = "oss_sharded_ddp"
+    oss_sharded_ddp_reduce_scatter = "oss_sharded_ddp_reduce_scatter"
     everyone = "everyone"
 
 
@@ -143,9 +144,9 @@ def train(
     model = cast(nn.Module, model)
     scaler = (TorchGradScaler() if args.optim_type == OptimType.vanilla else ShardedGradScaler()) if args.amp else None
 
-    if optim_type == OptimType.oss_sharded_ddp:
+    if optim_type in [OptimType.oss_sharded_ddp, OptimType.oss_sharded_ddp_reduce_scatter]:
         optimizer = OSS(params=model.parameters(), optim=OPTIM, lr=1e-4, momentum=0.9)
-        model = ShardedDDP(model, optimizer)
+        model = ShardedDDP(model, optimizer, reduce_scatter=optim_type == OptimType.oss_sharded_ddp_reduce_scatter)
     else:
         device_ids = None if args.cpu else [rank]
         model = DDP(model, device_ids=device_ids, find_unused_parameters=False)  # type: ignore
@@ -246,7 +247,7 @@ def train(
             batch_end = time.monotonic()
             epoch_runtime += batch_end - batch_start
 
-        if optim_type == OptimType.oss_ddp or optim_type == OptimType.oss_sharded_ddp:
+        if optim_type in [OptimType.oss_ddp, OptimType.oss_sharded_ddp, OptimType.oss_sharded_ddp_reduce_scatter]:
             # Check the checkpointing in the case of the OSS optimizer
             # Memory usage could spill over from there
             optimizer = cast(OSS, optimizer)
@@ -339,3 +340,12 @@ if __name__ == "__main__":
             nprocs=args.world_size,
             join=True,
         )
+
+    if args.optim_type == OptimType.oss_sharded_ddp_reduce_scatter or args.optim_type == OptimType.everyone:
+        logging.info("\n*** Benchmark OSS with ShardedDDP, reduce-scatter gradient reduction")
+        mp.spawn(
+            train,  # type: ignore
+            args=(args, BACKEND, OptimType.oss_sharded_ddp_reduce_scatter, False),  # no golden data for this mode
+            nprocs=args.world_size,
+            join=True,
+        )
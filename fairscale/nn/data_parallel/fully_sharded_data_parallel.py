@@ -20,6 +20,7 @@ import torch.nn.functional as F
 
 from fairscale.nn.misc import FlattenParamsWrapper
 from fairscale.optim.utils import calc_grad_norm
+from fairscale.utils.all_gather_bucketer import AllGatherBucketer
 from fairscale.utils.containers import (
     apply_to_tensors,
     pack_kwargs,
@@ -27,7 +28,7 @@ from fairscale.utils.containers import (
     unpack_kwargs,
     unpack_non_tensors,
 )
-from fairscale.utils.parallel import chunk_and_pad, validate_process_group
+from fairscale.utils.parallel import chunk_and_pad, chunk_into, validate_process_group
 from fairscale.utils.reduce_scatter_bucketer import ReduceScatterBucketer
 
 if TYPE_CHECKING:
@@ -487,6 +488,7 @@ class FullyShardedDataParallel(nn.Module):
         self._is_root: Optional[bool] = None
         self._streams: Dict[str, torch.cuda.Stream] = {}
         self._reducer: Optional[ReduceScatterBucketer] = None
+        self._gatherer: Optional[AllGatherBucketer] = None
 
     def _lazy_init(self) -> None:
         """Initialization steps that should happen lazily, typically right
@@ -624,6 +626,9 @@ class FullyShardedDataParallel(nn.Module):
         # Helper for bucketing reduce-scatter ops. This is also shared with
         # children instances to improve bucket utilization.
         self._reducer = ReduceScatterBucketer(self.bucket_cap_mb)
+        # Same for the all-gather ops, which are bucketed when there are
+        # several (non flattened) params per instance.
+        self._gatherer = AllGatherBucketer(self.bucket_cap_mb)
         # We share streams with all children instances, which allows them to
         # overlap transfers across the forward pass without synchronizing with
         # the default stream.
@@ -631,6 +636,7 @@ class FullyShardedDataParallel(nn.Module):
             if n != "" and isinstance(m, FullyShardedDataParallel):
                 m._streams = self._streams
                 m._reducer = self._reducer
+                m._gatherer = self._gatherer
 
     def _wait_for_previous_optim_step(self) -> None:
         """
@@ -792,8 +798,15 @@ class FullyShardedDataParallel(nn.Module):
             if param._is_sharded:
                 assert param._is_sharded
                 assert self._reducer is not None
-                grad_chunks = chunk_and_pad(param.grad.data, self.world_size)
-                self._reducer.reduce_scatter_async(grad_chunks, group=self.process_group, callback_fn=callback_fn)
+                grad = param.grad.data
+                shard_numel = (grad.numel() + self.world_size - 1) // self.world_size
+                slot = self._reducer.get_slot(shard_numel, grad.dtype, grad.device, self.process_group, callback_fn)
+                if slot is not None:
+                    # Write the grad straight into the bucket
+                    chunk_into(grad, slot)
+                else:
+                    grad_chunks = chunk_and_pad(grad, self.world_size)
+                    self._reducer.reduce_scatter_async(grad_chunks, group=self.process_group, callback_fn=callback_fn)
             else:
                 # Currently the only way for _is_sharded to be False is if
                 # world_size == 1. This could be relaxed in the future, in which
@@ -853,6 +866,11 @@ class FullyShardedDataParallel(nn.Module):
             if self.mixed_precision:
                 self._cast_fp32_param_shards_to_fp16()
 
+            # With a single sharded param (flatten_parameters=True) there is nothing to bucket,
+            # gather it in place rather than through the bucket and a temporary
+            assert self._gatherer is not None
+            use_bucketer = sum(1 for p in self.params if p._is_sharded) > 1
+
             for p in self.params:
                 if not p._is_sharded:
                     if self.mixed_precision:
@@ -865,9 +883,13 @@ class FullyShardedDataParallel(nn.Module):
                     alloc_storage_(p._full_param_padded, size=p_size)
                     assert p_size.numel() % self.world_size == 0
                     if p._is_sharded:
-                        # Fill p._full_param_padded with (p.data for each shard in self.world_size)
-                        chunks = list(p._full_param_padded.chunk(self.world_size))
-                        dist.all_gather(chunks, p.data, group=self.process_group)
+                        # Fill p._full_param_padded with (p.data for each shard in self.world_size).
+                        # Small shards are bucketed, the gathering is only complete after the flush below
+                        if use_bucketer:
+                            self._gatherer.all_gather_async(p.data, p._full_param_padded, group=self.process_group)
+                        else:
+                            chunks = list(p._full_param_padded.chunk(self.world_size))
+                            dist.all_gather(chunks, p.data, group=self.process_group)
                     else:
                         p._full_param_padded.copy_(torch.flatten(p.data), non_blocking=True)
 
@@ -875,6 +897,9 @@ class FullyShardedDataParallel(nn.Module):
 
                 if self.mixed_precision:
                     self._free_fp16_param_shard([p])
+
+            if use_bucketer:
+                self._gatherer.flush()
         torch.cuda.current_stream().wait_stream(self._streams["all_gather"])
 
     @torch.no_grad()
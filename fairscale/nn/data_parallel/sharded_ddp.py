@@ -8,15 +8,18 @@ A nn.Module wrapper to go with a Sharded Optimizer in order to handle targeted g
 reduction automatically.
 """
 
-from collections import deque
+from collections import OrderedDict, deque
 import contextlib
 import functools
 from itertools import chain
 import logging
+import statistics
+import time
 from typing import Any, Callable, Deque, Dict, Generator, List, Optional, Tuple, Union
 
 import torch
 from torch import nn
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 from torch.autograd import Variable
 import torch.distributed as dist
 from torch.nn import Parameter
@@ -29,6 +32,11 @@ def _trainable(param: torch.Tensor) -> bool:
     return param.requires_grad
 
 
+def _unflatten_in_place(flat_tensor: torch.Tensor, tensors: List[torch.Tensor]) -> None:
+    for tensor, synced in zip(tensors, _unflatten_dense_tensors(flat_tensor, tensors)):
+        tensor.copy_(synced)
+
+
 class ShardedDataParallel(nn.Module):
     """ Wrap the model, and reduce the gradients to the right rank during the backward pass.
 
@@ -48,6 +56,11 @@ class ShardedDataParallel(nn.Module):
         broadcast_buffers (bool):
             Whether to additionally broadcast model buffers in between ranks at the beginning of each forward pass.
             Same setting as in Pytorch DDP, this is in addition to the broadcast and reduction of the model parameters.
+            The buffers are coalesced per device and type, so that this costs a few collective calls at most.
+        broadcast_buffers_interval (int):
+            (default: 1) only broadcast the buffers every `broadcast_buffers_interval` forward passes.
+            Values over 1 trade some drift of the buffers (batch norm statistics for instance) in between the ranks
+            for a lower latency.
         sync_models_at_startup (bool):
             Synchronize the models in between the ranks when starting up. Not needed if each rank has the same seed,
             or the training restarts from a saved state
@@ -62,6 +75,43 @@ class ShardedDataParallel(nn.Module):
         reduce_fp16 (bool):
             cast the grads to fp16 before reducing. Not needed if the model is already fp16, but will probably improve performance
             for multi node jobs using PyTorch AMP. The effect is similar to DDP's fp16_compress_hook_ and will also save some memory.
+            Shorthand for `reduce_dtype=torch.float16`.
+        reduce_dtype (torch.dtype, optional):
+            (default: None) cast the grads to this type (typically torch.float16 or torch.bfloat16) before reducing.
+            Compatible with the reduce buckets: these are then allocated in this type, the grads are cast when copied in
+            and cast back into the full precision grad on the owning rank after the reduction.
+            The grads are divided by the world size before being cast, so that the sum cannot overflow if the grads
+            do not. An overflow (inf) still ends up in the owning rank's grad, where a `ShardedGradScaler` will
+            catch it.
+        reduce_scatter (bool):
+            (default: False) reduce the bucketed gradients with `reduce_scatter` calls instead of one `reduce` per rank.
+            Each bucket then holds a row per rank, filled with the gradients this rank owns, and every rank receives exactly
+            its row. This makes a better use of the ring bandwidth at scale. All the gradients which fit in a bucket row
+            (`reduce_buffer_size` / world size) are bucketed, bigger ones are reduced directly.
+            Backends which do not support `reduce_scatter` (Gloo) fall back to an all-reduce of the buckets.
+        bucket_in_backward_order (bool):
+            (default: True) record the order in which the gradients are ready during the first backward pass, and rebuild
+            the buckets accordingly at the next forward, so that they are complete and reduced as early as possible.
+            The order observed on the reference rank is used on all ranks. This is re-evaluated when the trainability changes.
+        reduce_buffer_size_candidates (list of int, optional):
+            (default: None) reduce buffer sizes to try during the first steps, in place of `reduce_buffer_size`.
+            Each candidate is timed (from the first gradient being ready to the end of the reductions) over `auto_tune_steps`
+            steps plus one warmup step, and the fastest one across ranks is kept. The buckets are then rebuilt once.
+            The result is logged, and exposed as `reduce_buffer_size_measurements` for reuse.
+        auto_tune_steps (int):
+            (default: 3) number of timed steps per reduce buffer size candidate.
+        find_unused_parameters (bool):
+            (default: False) support trainable parameters which do not get a gradient in some steps (conditional
+            branches, mixture of experts). The autograd graph is traversed after the forward pass to find the parameters
+            which are not used on this rank. The parameters which are unused on any rank are then reduced at the end of
+            the backward pass, in the same order on all ranks and with a zero contribution from the ranks which did not
+            use them. Once the usage is the same for two consecutive steps, it is cached and the graph traversal is skipped:
+            a param which then becomes unused on some ranks only raises at the end of the backward pass.
+        find_unused_parameters_every_step (bool):
+            (default: False) with `find_unused_parameters`, never cache the usage of the parameters. The graph is traversed
+            after every training forward pass, and the usage is agreed on across ranks with a blocking all-reduce, which
+            syncs the host with the device. Needed when the parameters used on some ranks only can change from step to step
+            (mixture of experts routing for instance).
 
     .. _fp16_compress_hook: https://pytorch.org/docs/1.8.0/ddp_comm_hooks.html?highlight=fp16#torch.distributed.algorithms.ddp_comm_hooks.default_hooks.fp16_compress_hook
 
@@ -95,23 +145,29 @@ class ShardedDataParallel(nn.Module):
         sharded_optimizer: Union[OSS, List[OSS]],
         process_group: Any = None,
         broadcast_buffers: bool = True,
+        broadcast_buffers_interval: int = 1,
         sync_models_at_startup: bool = True,
         reduce_buffer_size: int = 2 ** 23,
         auto_refresh_trainable: bool = True,
         reduce_fp16: bool = False,
+        reduce_dtype: Optional[torch.dtype] = None,
+        reduce_scatter: bool = False,
+        bucket_in_backward_order: bool = True,
+        reduce_buffer_size_candidates: Optional[List[int]] = None,
+        auto_tune_steps: int = 3,
+        find_unused_parameters: bool = False,
+        find_unused_parameters_every_step: bool = False,
     ):
         super().__init__()
 
         self.module = module
         self.sharded_optimizers = [sharded_optimizer] if isinstance(sharded_optimizer, OSS) else sharded_optimizer
         self.enable_broadcast_buffers = broadcast_buffers
+        assert broadcast_buffers_interval > 0, "The buffers broadcast interval needs to be strictly positive"
+        self.broadcast_buffers_interval = broadcast_buffers_interval
+        self._forward_counter = 0
         self.auto_refresh_trainable = auto_refresh_trainable
-        self.reduce_fp16 = reduce_fp16
-        if reduce_buffer_size > 0:
-            self.reduce_fp16 = False
-            logging.warning(
-                "fp16 gradient reduction is not compatible with reduction buffers, which are requested. fp16 grad reduction is deactivated."
-            )
+        self.reduce_dtype = torch.float16 if reduce_fp16 else reduce_dtype
 
         # Handle a no_sync() context which prevents the gradient synchronization,
         # accumulate in place
@@ -120,7 +176,8 @@ class ShardedDataParallel(nn.Module):
 
         # Communication related attributes
         self.process_group = process_group if process_group is not None else dist.group.WORLD
-        self.world_size_scaling = 1.0 / dist.get_world_size(self.process_group)  # > 0
+        self.world_size = dist.get_world_size(self.process_group)
+        self.world_size_scaling = 1.0 / self.world_size  # > 0
         self.reference_global_rank = OSS.get_global_rank(self.process_group, 0)  # picking rank 0 as the reference
         self.rank = dist.get_rank(self.process_group)
         self.global_rank = OSS.get_global_rank(self.process_group, self.rank)
@@ -157,20 +214,51 @@ class ShardedDataParallel(nn.Module):
         self._reduced_grads = 0
         self._reduced_grads_max = 0
 
+        # - optionally try a few bucket sizes during the first steps, and keep the fastest
+        self._buffer_size_candidates = list(reduce_buffer_size_candidates) if reduce_buffer_size_candidates else []
+        assert auto_tune_steps > 0, "At least one step per reduce buffer size candidate is required"
+        self._auto_tune_steps = auto_tune_steps
+        self._auto_tune_index = 0 if len(self._buffer_size_candidates) > 0 else -1
+        self._auto_tune_timings: List[List[float]] = [[] for _ in self._buffer_size_candidates]
+        self._auto_tune_start = 0.0
+        self.reduce_buffer_size_measurements: Dict[int, float] = {}
+
+        if self._auto_tune_index >= 0:
+            reduce_buffer_size = self._buffer_size_candidates[0]
+
+        # - optionally find the parameters which are not used in the forward pass.
+        # The grads which have been unused on any rank are reduced at the end of the backward pass
+        self.find_unused_parameters = find_unused_parameters
+        self.find_unused_parameters_every_step = find_unused_parameters_every_step
+        self._deferred_grads: List[bool] = []
+        self._unused_params_mask: Optional[List[bool]] = None
+        self._unused_params_cached = False
+
         # - setup buckets and tensor views
-        model_size = sum([p.numel() for p in self.module.parameters()])
-        self.buffer_max_size = min(reduce_buffer_size, model_size)
-        logging.info(
-            "ShardedDDP bucket size: {:.2f}M parameters, model size {:.2f}M parameters".format(
-                self.buffer_max_size / 2 ** 20, model_size / 2 ** 20
-            )
-        )
-        self.use_buckets = self.buffer_max_size > 0
+        self._model_size = sum([p.numel() for p in self.module.parameters()])
+        self._set_buffer_size(reduce_buffer_size)
+
+        self.reduce_scatter = reduce_scatter
+        if self.reduce_scatter and not self.use_buckets and self._auto_tune_index < 0:
+            self.reduce_scatter = False
+            logging.warning("Reduce-scatter gradient reduction requires reduction buffers, which are not used")
+        self._reduce_scatter_native = dist.get_backend(self.process_group) == dist.Backend.NCCL
+
+        self.bucket_in_backward_order = bucket_in_backward_order
+        self._bucket_fill_order: List[int] = []  # indices of the trainable params, in the order buckets are filled
+        self._grad_ready_order: List[int] = []
+        self._record_grad_ready_order = False
 
         self.buckets: Dict[torch.device, List[Bucket]] = {}
         self._should_bucket_grad: List[bool] = []
+        self._param_buckets: List[Optional[Bucket]] = []
         self._bucket_list: Optional[List[Bucket]] = None
 
+        # - the slot of each grad in the buckets.
+        # If the buckets are in a lower precision, the grads are not views but are copied in and out
+        self._grad_slots: List[Optional[torch.Tensor]] = []
+        self._bucket_params: Dict[Bucket, List[int]] = {}
+
         # - setup backward hooks which will be called by Torch's autograd in due time
         self._grad_accs: List[Callable] = []
 
@@ -201,16 +289,36 @@ class ShardedDataParallel(nn.Module):
                 self.refresh_trainable()
                 self._reference_trainable_mask = trainable_mask
 
-        if self.enable_broadcast_buffers:
+        # Optionally rebuild the buckets, now that the gradients order is known
+        if self._record_grad_ready_order and len(self._grad_ready_order) > 0:
+            self._setup_buckets_in_grad_ready_order()
+
+        # Optionally try the next reduce buffer size, or settle on the best one
+        if self._auto_tune_index >= 0:
+            self._auto_tune_buffer_size()
+
+        if self.enable_broadcast_buffers and self._forward_counter % self.broadcast_buffers_interval == 0:
             # NCCL communications are on a different stream, needs to be blocking
             # for the subsequent FW to be correct
             self.sync_buffers(blocking=True)
+        self._forward_counter += 1
 
         # Reset all the grad reduce and bucket state flags
         self._clear_counters()
 
         # Normal FW on the base model
-        return self.module(*inputs, **kwargs)
+        outputs = self.module(*inputs, **kwargs)
+
+        if (
+            self.find_unused_parameters
+            and not self._unused_params_cached
+            and self.training
+            and torch.is_grad_enabled()
+            and not self.should_accumulate_grads
+        ):
+            self._find_unused_params(outputs)
+
+        return outputs
 
     def to(  # type: ignore
         self,
@@ -270,6 +378,18 @@ class ShardedDataParallel(nn.Module):
         self._trainable_params.sort(key=lambda x: x.numel())
         self._grad_to_be_reduced = [True for _ in self._trainable_params]
 
+        # The usage pattern needs to be observed again
+        self._deferred_grads = [False for _ in self._trainable_params]
+        self._unused_params_mask = None
+        self._unused_params_cached = False
+
+        # Buckets are filled by increasing param size, until the gradients order is known
+        self._bucket_fill_order = list(range(len(self._trainable_params)))
+        self._grad_ready_order = []
+        self._record_grad_ready_order = self.bucket_in_backward_order and (
+            self.use_buckets or self._auto_tune_index >= 0
+        )
+
         self._trainable_param_to_rank = {}
         for optim in self.sharded_optimizers:
             # OSS may need to change the communication pattern
@@ -308,20 +428,33 @@ class ShardedDataParallel(nn.Module):
         """
         Sync all the param buffers in between ranks (including for instance batch norm statistics).
 
+        The buffers are flattened per device and type and broadcast in one call per group,
+        then copied back in place.
+
         Arguments:
-            blocking (bool): wait for the operation to conclude.
+            blocking (bool): wait for the operation to conclude. If not, the buffers are only updated
+                when the pending communications are consumed, at the latest at the end of the next backward pass.
         """
 
-        last_work_handle = None
-
+        # Group the buffers per device and type, they can be flattened together
+        buffer_groups: Dict[Tuple[torch.device, torch.dtype], List[torch.Tensor]] = OrderedDict()
         for buffer in self.module.buffers(recurse=True):
-            last_work_handle = dist.broadcast(
-                buffer.data, self.reference_global_rank, self.process_group, async_op=True
+            buffer_groups.setdefault((buffer.device, buffer.dtype), []).append(buffer.data)
+
+        for buffers in buffer_groups.values():
+            if len(buffers) == 1:
+                handle = dist.broadcast(buffers[0], self.reference_global_rank, self.process_group, async_op=True)
+                self._work_handles.append(Workhandle(handle=handle, callback=None))
+                continue
+
+            flat_buffer = _flatten_dense_tensors(buffers)
+            handle = dist.broadcast(flat_buffer, self.reference_global_rank, self.process_group, async_op=True)
+            self._work_handles.append(
+                Workhandle(handle=handle, callback=functools.partial(_unflatten_in_place, flat_buffer, buffers))
             )
 
-        if blocking and last_work_handle:
-            # Only wait for the last coms, they're inlined on the same CUDA stream
-            last_work_handle.wait()
+        if blocking:
+            self._consume_work_handles()
 
     def zero_grad(self, set_to_none: bool = False) -> None:
         r"""Sets gradients of all model parameters to zero. See similar function
@@ -332,7 +465,7 @@ class ShardedDataParallel(nn.Module):
                 See :meth:`torch.optim.Optimizer.zero_grad` for details.
         """
 
-        for index, trainable_param in enumerate(self._all_params):
+        for index, trainable_param in enumerate(self._trainable_params):
             if set_to_none and not self._should_bucket_grad[index]:
                 trainable_param.grad = None
             elif trainable_param.grad is not None:
@@ -375,7 +508,7 @@ class ShardedDataParallel(nn.Module):
 
                 bucket.reset()
 
-            self._bucket_flush_callback_set = False
+        self._bucket_flush_callback_set = False
 
         if not self.should_accumulate_grads:
             self.accumulate_grads_flipped = False
@@ -391,108 +524,96 @@ class ShardedDataParallel(nn.Module):
 
     def _get_reduce_fn(self, index: int, param: torch.Tensor, dst_rank: int) -> Callable:
         """
-        Two possible backward hooks for a given parameter: either directly reduce to the appropriate rank,
-        or contribute to a bucket and reduce when the bucket is full.
+        Two possible behaviours for a given parameter backward hook: either directly reduce to the appropriate rank,
+        or contribute to a bucket and reduce when the bucket is full. This is decided when the hook fires,
+        since the buckets can be rebuilt.
 
         Either way a delayed action is necessary and is passed as a callback.
         """
 
-        if not self.use_buckets or not self._should_bucket_grad[index]:
-            # Direct reduction
-            @torch.no_grad()
-            def reduce(*_: Any) -> None:
-                # Skip gradient reduction, do not alter status flags
-                if not self.should_accumulate_grads and self._grad_to_be_reduced[index]:
-                    assert param.grad is not None, "Reducing gradients during backward pass, cannot be None"
-
-                    if not self._bucket_flush_callback_set:
-                        Variable._execution_engine.queue_callback(self._flush_buckets)
-                        self._bucket_flush_callback_set = True
-
-                    # Make sure that this is not fired twice
-                    self._grad_to_be_reduced[index] = False
-                    param.grad.mul_(self.world_size_scaling)
-
-                    if self.reduce_fp16:
-                        param.grad.data = param.grad.data.half()
-
-                    # Future work includes clearing up the buffer if possible
-                    def cleanup() -> None:
-                        if dst_rank != self.global_rank:
-                            param.grad = None
-                        else:
-                            assert param.grad is not None
-                            param.grad.data = param.grad.data.to(dtype=param.dtype)
-
-                    # Async reduce for this buffer, log the future
-                    dst_global_rank = OSS.get_global_rank(self.process_group, dst_rank)
-
-                    self._work_handles.append(
-                        Workhandle(
-                            handle=dist.reduce(
-                                tensor=param.grad.data, dst=dst_global_rank, group=self.process_group, async_op=True
-                            ),
-                            callback=cleanup,
-                        )
-                    )
-                    self._reduced_grads += 1
-
-                    # Opportunistically try to empty the queue
-                    self._try_consume_work_handle()
-
-                    # If all the reduce operations have been called,
-                    # make sure that all the asynchronous calls have concluded before moving on
-                    # and execute the delayed actions (release gradients, unroll the buckets)
-                    if self._reduced_grads == self._reduced_grads_max:
-                        self._consume_work_handles()
+        @torch.no_grad()
+        def reduce(*_: Any) -> None:
+            if self._record_grad_ready_order:
+                self._grad_ready_order.append(index)
 
-        else:
+            # Skip gradient reduction, do not alter status flags
+            if not self.should_accumulate_grads and self._grad_to_be_reduced[index]:
+                assert param.grad is not None, "Reducing gradients during backward pass, cannot be None"
+
+                if not self._bucket_flush_callback_set:
+                    Variable._execution_engine.queue_callback(self._flush_buckets)
+                    self._bucket_flush_callback_set = True
+
+                    if self._auto_tune_index >= 0:
+                        self._auto_tune_start = self._synchronized_time()
+
+                # This grad is possibly missing on some ranks, it will be reduced when flushing
+                if self._deferred_grads[index]:
+                    return
 
-            @torch.no_grad()
-            def reduce(*_: Any) -> None:
-                # Skip gradient reduction, do not alter status flags
-                if not self.should_accumulate_grads and self._grad_to_be_reduced[index]:
-                    assert param.grad is not None, "Reducing gradients during backward pass, cannot be None"
-
-                    if not self._bucket_flush_callback_set:
-                        Variable._execution_engine.queue_callback(self._flush_buckets)
-                        self._bucket_flush_callback_set = True
-
-                    # Make sure that this is not fired twice
-                    self._grad_to_be_reduced[index] = False
-                    bucket = self.buckets[param.device][dst_rank]
-                    bucket.params_checked_in += 1
-
-                    if bucket.full():
-                        # Normalize the bucket in one go
-                        bucket.buffer.mul_(self.world_size_scaling)
-
-                        # Reduce the bucket
-                        bucket.sent = True
-                        self._work_handles.append(
-                            Workhandle(
-                                handle=dist.reduce(
-                                    tensor=bucket.buffer,
-                                    dst=bucket.destination,
-                                    group=self.process_group,
-                                    async_op=True,
-                                ),
-                                callback=None,
-                            )
-                        )
-                        self._reduced_grads += 1
-
-                    # Opportunistically try to empty the queue
-                    self._try_consume_work_handle()
-
-                    # If all the reduce operations have been called,
-                    # make sure that all the asynchronous calls have concluded before moving on
-                    # and execute the delayed actions (release gradients, unroll the buckets)
-                    if self._reduced_grads == self._reduced_grads_max:
-                        self._consume_work_handles()
+                self._reduce_grad(index, param, dst_rank)
 
         return reduce
 
+    def _reduce_grad(self, index: int, param: torch.Tensor, dst_rank: int) -> None:
+        """Reduce the gradient of a given trainable param, either directly or as part of its bucket"""
+
+        assert param.grad is not None
+
+        # Make sure that this is not fired twice
+        self._grad_to_be_reduced[index] = False
+
+        if self.use_buckets and self._should_bucket_grad[index]:
+            bucket = self._param_buckets[index]
+            assert bucket is not None
+            bucket.params_checked_in += 1
+
+            grad_slot = self._grad_slots[index]
+            if grad_slot is not None and grad_slot.dtype != param.dtype:
+                # Normalize before casting, so that the reduction does not overflow
+                param.grad.mul_(self.world_size_scaling)
+                grad_slot.copy_(param.grad.data)
+
+            if bucket.full():
+                self._reduce_bucket(bucket)
+                self._reduced_grads += 1
+        else:
+            # Direct reduction
+            param.grad.mul_(self.world_size_scaling)
+
+            if self.reduce_dtype is not None:
+                param.grad.data = param.grad.data.to(dtype=self.reduce_dtype)
+
+            # Future work includes clearing up the buffer if possible
+            def cleanup() -> None:
+                if dst_rank != self.global_rank:
+                    param.grad = None
+                else:
+                    assert param.grad is not None
+                    param.grad.data = param.grad.data.to(dtype=param.dtype)
+
+            # Async reduce for this buffer, log the future
+            dst_global_rank = OSS.get_global_rank(self.process_group, dst_rank)
+
+            self._work_handles.append(
+                Workhandle(
+                    handle=dist.reduce(
+                        tensor=param.grad.data, dst=dst_global_rank, group=self.process_group, async_op=True
+                    ),
+                    callback=cleanup,
+                )
+            )
+            self._reduced_grads += 1
+
+        # Opportunistically try to empty the queue
+        self._try_consume_work_handle()
+
+        # If all the reduce operations have been called,
+        # make sure that all the asynchronous calls have concluded before moving on
+        # and execute the delayed actions (release gradients, unroll the buckets)
+        if self._reduced_grads == self._reduced_grads_max:
+            self._consume_work_handles()
+
     def _setup_backward_hooks(self) -> None:
         """
         Attach a reduce function to each grad-requiring parameter.
@@ -552,23 +673,45 @@ class ShardedDataParallel(nn.Module):
 
         # A priori, one reduce call per param
         self._reduced_grads_max = len(self._trainable_params)
+        self._should_bucket_grad = [False for _ in self._trainable_params]
+        self._param_buckets = [None for _ in self._trainable_params]
+        self._grad_slots = [None for _ in self._trainable_params]
+        self._bucket_params = {}
+        self._bucket_list = None
 
         if not self.use_buckets:
+            self.buckets = {}
             return
 
         # Devise the bucketing strategy. Parameters are already sorted, in that:
         # - these are only the trainable parameters, so they should produce grads
-        # - they are sorted by increasing size
+        # - they are visited by increasing size, or in the order the gradients were ready if this is known
         self.buckets = {}
 
-        for param in self._trainable_params:
+        if self.reduce_scatter:
+            self._setup_reduce_scatter_buckets()
+        else:
+            self._setup_reduce_buckets()
+
+        self._bucket_list = list(chain(*[self.buckets[device] for device in self.buckets.keys()]))
+
+        for bucket in self._bucket_list:
+            bucket.sent = True
+            if bucket.max_params_checked_in > 0:
+                self._reduced_grads_max += 1  # one reduce call per bucket
+
+    def _setup_reduce_buckets(self) -> None:
+        """One bucket per device and per rank, holding the gradients which this rank owns, reduced to it"""
+
+        for index in self._bucket_fill_order:
+            param = self._trainable_params[index]
             device = param.device
             dst_rank = self._trainable_param_to_rank[param]
 
             if param.device not in self.buckets.keys():
                 self.buckets[param.device] = [
-                    Bucket(buffer=torch.zeros(self.buffer_max_size, dtype=param.dtype, device=device))
-                    for _ in range(dist.get_world_size(self.process_group))
+                    Bucket(buffer=torch.zeros(self.buffer_max_size, dtype=self._bucket_dtype(param), device=device))
+                    for _ in range(self.world_size)
                 ]
 
             bucket = self.buckets[device][dst_rank]
@@ -577,33 +720,267 @@ class ShardedDataParallel(nn.Module):
             # Criteria to decide whether this parameter is to be bucketed or not:
             # - enough room in the bucket
             if (bucket.fill + param.numel()) < self.buffer_max_size:
-                self._should_bucket_grad.append(True)
-
                 # This parameter gradients becomes a view of the bucket
                 fill_next = bucket.fill + param.numel()
+                self._bucket_grad(index, bucket, bucket.buffer[bucket.fill : fill_next])
+                bucket.fill = fill_next
+
+        # Resize the buckets to remove lost space in the end
+        for device in self.buckets.keys():
+            for bucket in self.buckets[device]:
+                bucket.buffer.resize_(bucket.fill)
+
+    def _setup_reduce_scatter_buckets(self) -> None:
+        """Buckets holding one row per rank, each row being filled with the gradients owned by the corresponding rank.
+        A bucket is reduce-scattered when complete, and each rank gets its own row.
+        The rows are filled first-fit, in the bucket fill order.
+        """
+
+        row_max_size = max(self.buffer_max_size // self.world_size, 1)
+
+        # - assign the params to a bucket row, per device. Params which are too big are not bucketed
+        row_fills: Dict[torch.device, List[List[int]]] = {}
+        placements: List[Tuple[int, int, int]] = []  # param index, bucket index, offset in the row
 
+        for index in self._bucket_fill_order:
+            param = self._trainable_params[index]
+            if param.numel() > row_max_size:
+                continue
+
+            dst_rank = self._trainable_param_to_rank[param]
+            fills = row_fills.setdefault(param.device, [])
+            bucket_index = next(
+                (i for i, fill in enumerate(fills) if fill[dst_rank] + param.numel() <= row_max_size), len(fills)
+            )
+            if bucket_index == len(fills):
+                fills.append([0 for _ in range(self.world_size)])
+
+            placements.append((index, bucket_index, fills[bucket_index][dst_rank]))
+            fills[bucket_index][dst_rank] += param.numel()
+
+        # - allocate the buckets, only as wide as their longest row
+        for device, fills in row_fills.items():
+            dtype = self._bucket_dtype(next(filter(lambda x: x.device == device, self._trainable_params)))
+            self.buckets[device] = [
+                Bucket(buffer=torch.zeros((self.world_size, max(fill)), dtype=dtype, device=device)) for fill in fills
+            ]
+
+        # - the gradients become views of the bucket rows
+        for index, bucket_index, offset in placements:
+            param = self._trainable_params[index]
+            bucket = self.buckets[param.device][bucket_index]
+            dst_rank = self._trainable_param_to_rank[param]
+            self._bucket_grad(index, bucket, bucket.buffer[dst_rank, offset : offset + param.numel()])
+
+    def _set_buffer_size(self, reduce_buffer_size: int) -> None:
+        self.buffer_max_size = min(reduce_buffer_size, self._model_size)
+        logging.info(
+            "ShardedDDP bucket size: {:.2f}M parameters, model size {:.2f}M parameters".format(
+                self.buffer_max_size / 2 ** 20, self._model_size / 2 ** 20
+            )
+        )
+        self.use_buckets = self.buffer_max_size > 0
+
+    def _synchronized_time(self) -> float:
+        if self.device_type == "cuda":
+            torch.cuda.synchronize(self.device)
+        return time.monotonic()
+
+    def _auto_tune_buffer_size(self) -> None:
+        """Move on to the next reduce buffer size candidate once it has been timed over enough steps.
+        When all the candidates have been timed, settle on the fastest one. All the ranks need to agree,
+        and the slowest rank dictates the pace, so the max timing across ranks is used.
+        """
+
+        # The first step for every candidate is a warmup
+        if len(self._auto_tune_timings[self._auto_tune_index]) < self._auto_tune_steps + 1:
+            return
+
+        self._auto_tune_index += 1
+        if self._auto_tune_index < len(self._buffer_size_candidates):
+            self._set_buffer_size(self._buffer_size_candidates[self._auto_tune_index])
+            self._setup_bucket_strategy()
+            return
+
+        timings = torch.tensor(
+            [statistics.median(t[1:]) for t in self._auto_tune_timings], dtype=torch.float64, device=self.device
+        )
+        dist.all_reduce(timings, op=dist.ReduceOp.MAX, group=self.process_group)
+        self.reduce_buffer_size_measurements = {
+            candidate: timing for candidate, timing in zip(self._buffer_size_candidates, timings.tolist())
+        }
+
+        best_buffer_size = self._buffer_size_candidates[int(torch.argmin(timings).item())]
+        logging.info(
+            "ShardedDDP reduce buffer size auto-tuning: {} selected. Measurements (buffer size: seconds): {}".format(
+                best_buffer_size, self.reduce_buffer_size_measurements
+            )
+        )
+
+        self._auto_tune_index = -1
+        self._set_buffer_size(best_buffer_size)
+        self._setup_bucket_strategy()
+
+    def _setup_buckets_in_grad_ready_order(self) -> None:
+        """Rebuild the buckets following the order in which the gradients were ready during the last backward,
+        so that the buckets are complete and can be reduced as early as possible.
+        The buckets need to match in between the ranks, the order observed on the reference rank is used everywhere.
+        """
+
+        self._record_grad_ready_order = False
+
+        # Keep the first occurrence of each gradient, the ones which were not ready go last
+        grad_ready_order = list(OrderedDict.fromkeys(self._grad_ready_order).keys())
+        not_ready = set(range(len(self._trainable_params))) - set(grad_ready_order)
+        grad_ready_order += sorted(not_ready)
+
+        order = torch.tensor(grad_ready_order, dtype=torch.long, device=self.device)
+        dist.broadcast(order, src=self.reference_global_rank, group=self.process_group)
+        self._bucket_fill_order = order.tolist()
+
+        self._setup_bucket_strategy()
+
+    def _find_unused_params(self, outputs: Any) -> None:
+        """Traverse the autograd graph from the outputs to find the trainable params which are not used on this rank.
+        The ones unused on any rank have their reduction deferred to the end of the backward pass"""
+
+        # Collect all the tensors in the outputs
+        tensors: List[torch.Tensor] = []
+        to_visit = [outputs]
+        while len(to_visit) > 0:
+            obj = to_visit.pop()
+            if isinstance(obj, torch.Tensor):
+                tensors.append(obj)
+            elif isinstance(obj, (list, tuple)):
+                to_visit.extend(obj)
+            elif isinstance(obj, dict):
+                to_visit.extend(obj.values())
+
+        # Walk the graph, the leaves are the AccumulateGrad nodes
+        used_params = set()
+        seen = set()
+        grad_fns = [t.grad_fn for t in tensors if t.grad_fn is not None]
+        while len(grad_fns) > 0:
+            grad_fn = grad_fns.pop()
+            if grad_fn in seen:
+                continue
+            seen.add(grad_fn)
+
+            if hasattr(grad_fn, "variable"):
+                used_params.add(id(grad_fn.variable))
+
+            grad_fns.extend(next_fn for next_fn, _ in grad_fn.next_functions if next_fn is not None)
+
+        # Agree on the params which are unused on any rank, before any reduction is issued: a param which is unused
+        # on some ranks only would otherwise be reduced in the backward hook by the others, and the order of the
+        # collectives would differ in between the ranks
+        unused = torch.tensor(
+            [id(p) not in used_params for p in self._trainable_params], dtype=torch.int32, device=self.device
+        )
+        dist.all_reduce(unused, op=dist.ReduceOp.MAX, group=self.process_group)
+        unused_mask = [bool(u) for u in unused.tolist()]
+
+        self._deferred_grads = [d or u for d, u in zip(self._deferred_grads, unused_mask)]
+
+        # Skip the traversal from now on if the pattern did not change from the previous step.
+        # All the ranks see the same mask, so that they take the same decision
+        self._unused_params_cached = (
+            not self.find_unused_parameters_every_step and unused_mask == self._unused_params_mask
+        )
+        self._unused_params_mask = unused_mask
+
+    def _reduce_deferred_grads(self) -> None:
+        """Reduce the grads which are possibly missing on some ranks, in the same order everywhere.
+        The ranks which did not use a param contribute a zero gradient"""
+
+        # A grad which was not reduced at this point was not found unused in the forward outputs, or the usage
+        # changed once cached. The other ranks could have reduced it already: the order of the collectives
+        # cannot be matched anymore
+        missing = [
+            i for i, to_reduce in enumerate(self._grad_to_be_reduced) if to_reduce and not self._deferred_grads[i]
+        ]
+        if len(missing) > 0:
+            raise RuntimeError(
+                f"ShardedDDP: {len(missing)} grads are missing, which were not found unused in the forward outputs. "
+                + "The params of the model should only be used in the computation of the outputs, and "
+                + "`find_unused_parameters_every_step` is needed if their usage changes in between the steps"
+            )
+
+        for index, param in enumerate(self._trainable_params):
+            if self._deferred_grads[index] and self._grad_to_be_reduced[index]:
                 if param.grad is None:
-                    # will be overwritten just below, see next line
-                    param.grad = torch.zeros_like(param)
+                    grad_slot = self._grad_slots[index]
+                    if grad_slot is not None and grad_slot.dtype == param.dtype:
+                        # Keep the grad as a view of its bucket
+                        grad_slot.zero_()
+                        param.grad = grad_slot
+                    else:
+                        param.grad = torch.zeros_like(param)
+
+                self._reduce_grad(index, param, self._trainable_param_to_rank[param])
+
+    def _bucket_dtype(self, param: torch.Tensor) -> torch.dtype:
+        return self.reduce_dtype if self.reduce_dtype is not None else param.dtype
+
+    def _bucket_grad(self, index: int, bucket: Bucket, grad_buffer: torch.Tensor) -> None:
+        """Make the gradient of a given trainable param a view of a bucket,
+        or reserve its slot if the bucket is in a different precision"""
+
+        param = self._trainable_params[index]
+        self._should_bucket_grad[index] = True
+        self._param_buckets[index] = bucket
+        self._bucket_params.setdefault(bucket, []).append(index)
+        self._reduced_grads_max -= 1  # one less reduce call per bucketed grad
+        bucket.max_params_checked_in += 1
+
+        self._grad_slots[index] = grad_buffer.view_as(param.data)
+        if grad_buffer.dtype != param.dtype:
+            return
 
-                param.grad.data = bucket.buffer[bucket.fill : fill_next].view_as(param.data)
-                bucket.fill = fill_next
+        if param.grad is None:
+            # will be overwritten just below, see next line
+            param.grad = torch.zeros_like(param)
+        else:
+            # Buckets can be rebuilt with gradients being accumulated
+            grad_buffer.copy_(param.grad.data.reshape(-1))
 
-                # Update the bucket
-                self._reduced_grads_max -= 1  # one less reduce call per bucketed grad
-                self.buckets[device][dst_rank].max_params_checked_in += 1
+        param.grad.data = grad_buffer.view_as(param.data)
 
-            else:
-                self._should_bucket_grad.append(False)
+    def _reduce_bucket(self, bucket: Bucket) -> None:
+        """Normalize a bucket and reduce it asynchronously, the work handle is logged"""
 
-        self._bucket_list = list(chain(*[self.buckets[device] for device in self.buckets.keys()]))
+        low_precision = any(
+            self._grad_slots[i].dtype != self._trainable_params[i].dtype  # type: ignore
+            for i in self._bucket_params.get(bucket, [])
+        )
+        if not low_precision:
+            # Low precision buckets are normalized grad per grad, when copied in
+            bucket.buffer.mul_(self.world_size_scaling)
+        bucket.sent = True
+
+        if not self.reduce_scatter:
+            handle = dist.reduce(tensor=bucket.buffer, dst=bucket.destination, group=self.process_group, async_op=True)
+        elif self._reduce_scatter_native:
+            handle = dist.reduce_scatter(
+                bucket.buffer[self.rank], list(bucket.buffer.unbind(0)), group=self.process_group, async_op=True
+            )
+        else:
+            # Emulated reduce-scatter, every rank gets all the rows reduced but only uses its own
+            handle = dist.all_reduce(bucket.buffer, group=self.process_group, async_op=True)
 
-        # Resize the buckets to remove lost space in the end
-        for bucket in self._bucket_list:
-            bucket.buffer.resize_(bucket.fill)
-            bucket.sent = True
-            if bucket.max_params_checked_in > 0:
-                self._reduced_grads_max += 1  # one reduce call per bucket
+        callback = functools.partial(self._unroll_low_precision_bucket, bucket) if low_precision else None
+        self._work_handles.append(Workhandle(handle=handle, callback=callback))
+
+    def _unroll_low_precision_bucket(self, bucket: Bucket) -> None:
+        """Cast the reduced gradients back into the owned full precision grads, release the other ones"""
+
+        for index in self._bucket_params[bucket]:
+            param = self._trainable_params[index]
+            if self._trainable_param_to_rank[param] != self.rank:
+                param.grad = None
+            else:
+                assert param.grad is not None
+                param.grad.data.copy_(self._grad_slots[index])  # type: ignore
 
     def _consume_work_handles(self) -> None:
         """Consume all the futures which are tied to this optimizer's buckets.
@@ -625,18 +1002,16 @@ class ShardedDataParallel(nn.Module):
 
     # Flush all the buckets, just in case
     def _flush_buckets(self) -> None:
+        if self.find_unused_parameters:
+            self._reduce_deferred_grads()
+
         if self._bucket_list is not None:
-            last_handle = None
             for bucket in self._bucket_list:
                 if not bucket.sent:
-                    # Normalize the bucket in one go
-                    bucket.buffer.mul_(self.world_size_scaling)
+                    self._reduce_bucket(bucket)
 
-                    # Reduce the bucket
-                    last_handle = dist.reduce(
-                        tensor=bucket.buffer, dst=bucket.destination, group=self.process_group, async_op=True,
-                    )
-                    bucket.sent = True
+        # Make sure that all the reductions have concluded before handing over to the optimizer
+        self._consume_work_handles()
 
-            if last_handle is not None:
-                last_handle.wait()
+        if self._auto_tune_index >= 0:
+            self._auto_tune_timings[self._auto_tune_index].append(self._synchronized_time() - self._auto_tune_start)
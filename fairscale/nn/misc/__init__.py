@@ -3,5 +3,6 @@
 # This source code is licensed under the BSD license found in the
 # LICENSE file in the root directory of this source tree.
 
-from .checkpoint_activations import checkpoint_wrapper
+from .checkpoint_activations import checkpoint_wrapper, free_offload_buffers, set_offload_buffers_limit
+from .checkpoint_planner import CheckpointPlan, ModuleProfile, auto_checkpoint
 from .flatten_params_wrapper import FlattenParamsWrapper
@@ -3,9 +3,10 @@
 # This source code is licensed under the BSD license found in the
 # LICENSE file in the root directory of this source tree.
 
+from collections import OrderedDict
 from contextlib import contextmanager
 import functools
-from typing import Any, Dict, Generator, Optional, Tuple
+from typing import Any, Dict, Generator, List, Optional, Tuple
 import weakref
 
 import torch
@@ -16,7 +17,9 @@ import torch.utils.checkpoint as torch_checkpoint
 from fairscale.utils.containers import pack_kwargs, split_non_tensors, unpack_kwargs, unpack_non_tensors
 
 
-def checkpoint_wrapper(module: nn.Module, offload_to_cpu: bool = False) -> nn.Module:
+def checkpoint_wrapper(
+    module: nn.Module, offload_to_cpu: bool = False, compress_dtype: Optional[torch.dtype] = None
+) -> nn.Module:
     """
     A friendlier wrapper for performing activation checkpointing.
 
@@ -25,7 +28,8 @@ def checkpoint_wrapper(module: nn.Module, offload_to_cpu: bool = False) -> nn.Mo
         - wraps an nn.Module, so that all subsequent calls will use checkpointing
         - handles keyword arguments in the forward
         - handles non-Tensor outputs from the forward
-        - supports offloading activations to CPU
+        - supports offloading activations to CPU, asynchronously
+        - supports compressing the saved activations
 
     Usage::
 
@@ -46,6 +50,17 @@ def checkpoint_wrapper(module: nn.Module, offload_to_cpu: bool = False) -> nn.Mo
         - When both inner and outer are large, both help and the
           benefit is additive.
 
+    The offloaded activations are copied to pinned host buffers, which are reused from one
+    iteration to the next, on a side CUDA stream so that the copies overlap with the forward.
+    In the backward, the activations of the next checkpointed module (the previous one in the
+    forward) are copied back while the current one is recomputed. The free host buffers are
+    capped, see :func:`set_offload_buffers_limit` and :func:`free_offload_buffers`.
+
+    With `compress_dtype`, the floating point inputs which are saved for the backward
+    (and offloaded) are stored in FP16, BF16, or in INT8 with a scale per channel
+    (the last dimension). They are decompressed before the recomputation, which is
+    then approximate: so are the gradients.
+
     ..Note::
 
         The first and last layers are not likely to benefit from the `offload_to_cpu` flag
@@ -58,6 +73,9 @@ def checkpoint_wrapper(module: nn.Module, offload_to_cpu: bool = False) -> nn.Mo
             The module to be wrapped
         offload_to_cpu (Optional, bool):
             Whether to offload activations to CPU.
+        compress_dtype (Optional, torch.dtype):
+            One of torch.float16, torch.bfloat16 or torch.int8, the type the saved activations
+            are stored in. They are kept in their type if None (default: None)
 
     Returns:
         (nn.Module):
@@ -69,19 +87,32 @@ def checkpoint_wrapper(module: nn.Module, offload_to_cpu: bool = False) -> nn.Mo
     #
     # We prefer this over a class wrapper since the class wrapper would have to
     # proxy a lot of fields and methods.
-    module.forward = functools.partial(_checkpointed_forward, type(module).forward, weakref.ref(module), offload_to_cpu)  # type: ignore
+    assert compress_dtype in _COMPRESSED_DTYPES, f"Unsupported compress_dtype {compress_dtype}"
+    module.forward = functools.partial(  # type: ignore
+        _checkpointed_forward, type(module).forward, weakref.ref(module), offload_to_cpu, compress_dtype
+    )
     return module
 
 
 def _checkpointed_forward(
-    original_forward: Any, weak_self: Any, offload_to_cpu: bool, *args: Any, **kwargs: Any
+    original_forward: Any,
+    weak_self: Any,
+    offload_to_cpu: bool,
+    compress_dtype: Optional[torch.dtype],
+    *args: Any,
+    **kwargs: Any,
 ) -> Any:
     # Autograd Functions in PyTorch work best with positional args, since
     # the backward must return gradients (or None) for every input argument.
     # We can flatten keyword arguments to make this easier.
     args = (weak_self(),) + args
     kwarg_keys, flat_args = pack_kwargs(*args, **kwargs)
-    parent_ctx_dict: Dict[str, Any] = {"offload": offload_to_cpu}
+    # Nothing to offload without a backward (validation for instance). Grad is always disabled within the
+    # forward of an autograd Function, it is checked here
+    parent_ctx_dict: Dict[str, Any] = {
+        "offload": offload_to_cpu and torch.is_grad_enabled(),
+        "compress_dtype": compress_dtype,
+    }
     output = CheckpointFunction.apply(original_forward, parent_ctx_dict, kwarg_keys, *flat_args)
     if not isinstance(output, torch.Tensor):
         packed_non_tensor_outputs = parent_ctx_dict["packed_non_tensor_outputs"]
@@ -90,6 +121,233 @@ def _checkpointed_forward(
     return output
 
 
+_COMPRESSED_DTYPES = (None, torch.float16, torch.bfloat16, torch.int8)
+
+
+def _compress(
+    tensors: Tuple[Tensor, ...], dtype: torch.dtype
+) -> Tuple[Tuple[Tensor, ...], List[Optional[torch.dtype]]]:
+    """Casts the floating point tensors to *dtype*. The INT8 ones are followed by their scales, per channel.
+
+    Returns the tensors to save, and the original type of each input (None if it is not compressed).
+    """
+    compressed: List[Tensor] = []
+    dtypes: List[Optional[torch.dtype]] = []
+    for tensor in tensors:
+        tensor = tensor.detach()
+        # Empty tensors have no memory to save, nor channels to scale in INT8
+        if (
+            not tensor.is_floating_point()
+            or tensor.dtype == dtype
+            or tensor.numel() == 0
+            or (dtype == torch.int8 and tensor.dim() == 0)
+        ):
+            compressed.append(tensor)
+            dtypes.append(None)
+        elif dtype == torch.int8:
+            scale = tensor.abs().reshape(-1, tensor.shape[-1]).max(dim=0)[0].float().div_(127.0).clamp_(min=1e-12)
+            compressed.append((tensor.float() / scale).round_().clamp_(-127, 127).to(torch.int8))
+            compressed.append(scale)
+            dtypes.append(tensor.dtype)
+        else:
+            compressed.append(tensor.to(dtype))
+            dtypes.append(tensor.dtype)
+    return tuple(compressed), dtypes
+
+
+def _decompress(tensors: Tuple[Tensor, ...], dtypes: List[Optional[torch.dtype]]) -> Tuple[Tensor, ...]:
+    """Reverts :func:`_compress`"""
+    decompressed = []
+    position = 0
+    for dtype in dtypes:
+        tensor = tensors[position]
+        position += 1
+        if dtype is None:
+            decompressed.append(tensor)
+        elif tensor.dtype == torch.int8:
+            decompressed.append(tensor.float().mul_(tensors[position]).to(dtype))
+            position += 1
+        else:
+            decompressed.append(tensor.to(dtype))
+    return tuple(decompressed)
+
+
+class _PinnedBufferPool:
+    """Host buffers for the offloaded activations, reused in between the iterations.
+
+    The buffers are pinned when CUDA is available, so that the copies are asynchronous.
+    Their sizes are rounded up to powers of two, so that varying shapes (sequence lengths,
+    batch sizes) share the buffers. A buffer is released with the event of the last copy
+    which uses it, it is only handed out again once this copy is done.
+
+    The free buffers add up to ``max_bytes`` at most, the least recently released ones are
+    dropped beyond.
+    """
+
+    def __init__(self, max_bytes: int = 2 ** 30) -> None:
+        self.max_bytes = max_bytes
+        self._free: "OrderedDict[int, Tuple[Tensor, Optional[torch.cuda.Event]]]" = OrderedDict()
+        self._free_bytes = 0
+
+    @property
+    def free_bytes(self) -> int:
+        return self._free_bytes
+
+    def acquire(self, numel: int, dtype: torch.dtype) -> Tensor:
+        """ Flat buffer of at least *numel* elements """
+        size = 1 << max(numel - 1, 0).bit_length()
+        for key, (buffer, event) in self._free.items():
+            if buffer.dtype == dtype and buffer.numel() == size and (event is None or event.query()):
+                del self._free[key]
+                self._free_bytes -= buffer.numel() * buffer.element_size()
+                return buffer
+        return torch.empty(size, dtype=dtype, pin_memory=torch.cuda.is_available())  # type: ignore
+
+    def release(self, buffer: Tensor, event: Optional[torch.cuda.Event] = None) -> None:
+        self._free[id(buffer)] = (buffer, event)
+        self._free_bytes += buffer.numel() * buffer.element_size()
+        self.trim()
+
+    def trim(self) -> None:
+        """ Drops the least recently released buffers beyond ``max_bytes`` """
+        while self._free_bytes > self.max_bytes:
+            _, (dropped, _) = self._free.popitem(last=False)
+            self._free_bytes -= dropped.numel() * dropped.element_size()
+
+    def release_all(
+        self, buffers: List[Tuple[Tensor, torch.device]], events: Dict[torch.device, torch.cuda.Event]
+    ) -> None:
+        """ Releases the buffers with the event of the last copy on their device """
+        for buffer, device in buffers:
+            self.release(buffer, events.get(device, None))
+
+    def clear(self) -> None:
+        self._free.clear()
+        self._free_bytes = 0
+
+
+class _OffloadedTensors:
+    """The tensor inputs of a checkpointed module, while they are offloaded to CPU.
+
+    The host copies are kept as long as the autograd graph, since the backward can be run more than once
+    (``retain_graph=True``). The pooled buffers are released when this object is collected, with the event
+    of the last copy which uses them on their device, to or from the host.
+    """
+
+    def __init__(self, tensors: Tuple[Tensor, ...], pool: _PinnedBufferPool) -> None:
+        self.devices = tuple(t.device for t in tensors)
+        self.host_tensors: List[Tensor] = []
+        self.pooled_buffers: List[Tuple[Tensor, torch.device]] = []
+        self.device_tensors: Optional[List[Tensor]] = None
+        self.copy_events: Dict[torch.device, torch.cuda.Event] = {}
+        weakref.finalize(self, pool.release_all, self.pooled_buffers, self.copy_events)
+
+
+class _ActivationOffloader:
+    """Moves the inputs of the checkpointed modules to CPU and back, on a side stream per device.
+
+    The offloaded inputs are kept in the order of the forward. The backward goes through them in
+    the reverse order, so when the inputs of a module are fetched, the ones of the previous module
+    are prefetched.
+
+    The bytes copied in each direction are counted, to measure the transfers.
+    """
+
+    def __init__(self) -> None:
+        self.pool = _PinnedBufferPool()
+        self.bytes_to_host = 0
+        self.bytes_to_device = 0
+        self._streams: Dict[torch.device, torch.cuda.Stream] = {}
+        self._queue: List[weakref.ref] = []
+
+    def _stream(self, device: torch.device) -> torch.cuda.Stream:
+        if device not in self._streams:
+            self._streams[device] = torch.cuda.Stream(device=device)
+        return self._streams[device]
+
+    def offload(self, tensors: Tuple[Tensor, ...]) -> _OffloadedTensors:
+        offloaded = _OffloadedTensors(tensors, self.pool)
+        for tensor in tensors:
+            if tensor.device.type != "cpu":
+                self.bytes_to_host += tensor.numel() * tensor.element_size()
+            if tensor.device.type != "cuda":
+                offloaded.host_tensors.append(tensor.detach().cpu())
+                continue
+
+            buffer = self.pool.acquire(tensor.numel(), tensor.dtype)
+            offloaded.pooled_buffers.append((buffer, tensor.device))
+            host = buffer[: tensor.numel()].view(tensor.shape)
+            stream = self._stream(tensor.device)
+            stream.wait_stream(torch.cuda.current_stream(tensor.device))
+            with torch.cuda.stream(stream):
+                host.copy_(tensor, non_blocking=True)
+                # The buffer is only handed out again once written, if it is released before the backward
+                offloaded.copy_events[tensor.device] = stream.record_event()
+            # The memory of the activation cannot be reused before the copy is done
+            tensor.record_stream(stream)
+            offloaded.host_tensors.append(host)
+
+        self._queue = [ref for ref in self._queue if ref() is not None]
+        self._queue.append(weakref.ref(offloaded))
+        return offloaded
+
+    def _copy_to_device(self, offloaded: _OffloadedTensors) -> None:
+        device_tensors = []
+        for host, device in zip(offloaded.host_tensors, offloaded.devices):
+            if device.type != "cpu":
+                self.bytes_to_device += host.numel() * host.element_size()
+            if device.type != "cuda":
+                device_tensors.append(host.to(device))
+                continue
+
+            # The host buffer was written on the same stream, the copy does not wait for the computations
+            stream = self._stream(device)
+            with torch.cuda.stream(stream):
+                device_tensors.append(host.to(device, non_blocking=True))
+                offloaded.copy_events[device] = stream.record_event()
+        offloaded.device_tensors = device_tensors
+
+    def fetch(self, offloaded: _OffloadedTensors) -> Tuple[Tensor, ...]:
+        if offloaded.device_tensors is None:
+            self._copy_to_device(offloaded)
+        assert offloaded.device_tensors is not None
+
+        # Prefetch the inputs of the module which comes next in the backward
+        queue = [o for o in (ref() for ref in self._queue) if o is not None]
+        if offloaded in queue:
+            position = queue.index(offloaded)
+            if position > 0 and queue[position - 1].device_tensors is None:
+                self._copy_to_device(queue[position - 1])
+            queue.pop(position)
+        self._queue = [weakref.ref(o) for o in queue]
+
+        tensors = offloaded.device_tensors
+        for tensor in tensors:
+            if tensor.device.type == "cuda" and tensor.device in offloaded.copy_events:
+                torch.cuda.current_stream(tensor.device).wait_event(offloaded.copy_events[tensor.device])
+                tensor.record_stream(torch.cuda.current_stream(tensor.device))
+
+        # The host copies stay, in case of another backward through the same graph
+        offloaded.device_tensors = None
+        return tuple(tensors)
+
+
+_offloader = _ActivationOffloader()
+
+
+def free_offload_buffers() -> None:
+    """Frees the pinned host buffers which the offloaded activations do not use at the moment,
+    see :func:`checkpoint_wrapper`. They are allocated again when needed."""
+    _offloader.pool.clear()
+
+
+def set_offload_buffers_limit(max_bytes: int) -> None:
+    """Caps the pinned host buffers which are kept for reuse by the offloaded activations, when they
+    do not use them (default: 1GB). The buffers in use are not limited."""
+    _offloader.pool.max_bytes = max_bytes
+    _offloader.pool.trim()
+
+
 def get_rng_state() -> Dict[str, Any]:
     state = {"torch_rng_state": torch.get_rng_state()}
     if torch.cuda.is_available():
@@ -126,6 +384,9 @@ class CheckpointFunction(torch.autograd.Function):
     The caller is expected to provide a dict (*parent_ctx_dict*) that will hold
     the non-Tensor outputs. These should be combined with the Tensor *outputs*
     by calling :func:`unpack_non_tensors`.
+
+    *parent_ctx_dict* also holds the options: ``offload`` (bool) and
+    ``compress_dtype`` (optional torch.dtype), see :func:`checkpoint_wrapper`.
     """
 
     @staticmethod
@@ -135,7 +396,7 @@ class CheckpointFunction(torch.autograd.Function):
         parent_ctx_dict: Dict[str, Any],
         kwarg_keys: Tuple[str, ...],
         *args: Any,
-        **kwargs: Any
+        **kwargs: Any,
     ) -> Any:
         if torch.is_grad_enabled():  # grad may be disabled, e.g., during validation
             torch_checkpoint.check_backward_validity(args)
@@ -146,12 +407,16 @@ class CheckpointFunction(torch.autograd.Function):
         ctx.had_autocast_in_fwd = is_autocast_enabled()
 
         tensor_inputs, packed_non_tensor_inputs = split_non_tensors(args)
+        ctx.grad_requirements = tuple(x.requires_grad for x in tensor_inputs)
+        ctx.compressed_dtypes = None
+        if parent_ctx_dict.get("compress_dtype") is not None:
+            tensor_inputs, ctx.compressed_dtypes = _compress(tensor_inputs, parent_ctx_dict["compress_dtype"])
+
         if parent_ctx_dict["offload"]:
-            ctx.fwd_device = tuple(x.device for x in tensor_inputs)
-            ctx.grad_requirements = tuple(x.requires_grad for x in tensor_inputs)
-            tensor_inputs = tuple(x.cpu() for x in tensor_inputs)
+            ctx.offloaded = _offloader.offload(tensor_inputs)
+            tensor_inputs = ()
         else:
-            ctx.fwd_device, ctx.grad_requirements = None, None
+            ctx.offloaded = None
 
         ctx.save_for_backward(*tensor_inputs)
         ctx.packed_non_tensor_inputs = packed_non_tensor_inputs
@@ -174,9 +439,12 @@ class CheckpointFunction(torch.autograd.Function):
             raise RuntimeError("Checkpointing is not compatible with .grad(), please use .backward() if possible")
 
         tensor_inputs: Tuple = ctx.saved_tensors
+        if ctx.offloaded is not None:
+            tensor_inputs = _offloader.fetch(ctx.offloaded)
+        if ctx.compressed_dtypes is not None:
+            tensor_inputs = _decompress(tensor_inputs, ctx.compressed_dtypes)
         tensor_inputs = torch_checkpoint.detach_variable(tensor_inputs)
-        if ctx.fwd_device is not None:
-            tensor_inputs = tuple(t.to(ctx.fwd_device[i]) for i, t in enumerate(tensor_inputs))
+        if ctx.offloaded is not None or ctx.compressed_dtypes is not None:
             for i, need_grad in enumerate(ctx.grad_requirements):
                 tensor_inputs[i].requires_grad = need_grad
         inputs = unpack_non_tensors(tensor_inputs, ctx.packed_non_tensor_inputs)
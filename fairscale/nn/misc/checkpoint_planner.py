@@ -0,0 +1,271 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Memory budgeted planning of the activation checkpointing."""
+
+import logging
+import math
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+import torch
+from torch import Tensor
+import torch.nn as nn
+
+from .checkpoint_activations import checkpoint_wrapper
+
+__all__ = ["CheckpointPlan", "ModuleProfile", "auto_checkpoint", "plan_checkpointing", "profile_activations"]
+
+
+class ModuleProfile(NamedTuple):
+    """ What checkpointing a module would save and cost, for the profiled batch """
+
+    #: Bytes of the activations saved for the backward within the module, which checkpointing would free.
+    #: The module inputs are not part of them, since they are kept by the checkpointing.
+    activation_bytes: int
+
+    #: Time of the forward of the module, in seconds, which checkpointing would spend again in the backward
+    forward_time: float
+
+
+class CheckpointPlan(NamedTuple):
+    """ The outcome of :func:`auto_checkpoint` """
+
+    #: Names of the modules which are checkpointed
+    modules: List[str]
+
+    #: Bytes of the activations saved for the backward, without checkpointing
+    activation_bytes: int
+
+    #: Bytes of the activations saved for the backward, with the planned checkpointing
+    planned_activation_bytes: int
+
+    #: Extra forward time spent in the backward, in seconds
+    recompute_time: float
+
+    #: Profiles of all the candidate modules
+    profiles: Dict[str, ModuleProfile]
+
+
+def _storage_key(tensor: Tensor) -> Tuple[int, int]:
+    """ Identifies the memory of a tensor, so that views and repeated references are only counted once """
+    return tensor.storage().data_ptr(), tensor.device.index if tensor.device.index is not None else -1
+
+
+def _tensors(inputs: Any) -> List[Tensor]:
+    if isinstance(inputs, Tensor):
+        return [inputs]
+    if isinstance(inputs, (list, tuple)):
+        return [t for x in inputs for t in _tensors(x)]
+    if isinstance(inputs, dict):
+        return [t for x in inputs.values() for t in _tensors(x)]
+    return []
+
+
+def profile_activations(
+    model: nn.Module, modules: Dict[str, nn.Module], *args: Any, iterations: int = 3, **kwargs: Any
+) -> Tuple[Dict[str, ModuleProfile], int]:
+    """
+    Runs the forward of the model on a sample batch, and measures for each candidate module the activations
+    that checkpointing it would free, and its forward time. This works on any device, CPU included.
+
+    The state of the model, buffers included, is not modified and no backward is run.
+
+    Args:
+        model (nn.Module):
+            The model to profile, which is called with ``*args`` and ``**kwargs``
+        modules (Dict[str, nn.Module]):
+            Candidate modules, by name. They cannot be nested
+        iterations (int):
+            Number of forward passes, the shortest times are kept (default: 3)
+
+    Returns:
+        (Dict[str, ModuleProfile], int):
+            The profiles of the candidate modules, and the total bytes of the activations saved for the backward
+    """
+    assert hasattr(torch.autograd, "graph") and hasattr(
+        torch.autograd.graph, "saved_tensors_hooks"
+    ), "torch >= 1.10 is required to profile the activations"
+    assert iterations >= 1
+
+    names = {module: name for name, module in modules.items()}
+    params = {_storage_key(p) for p in model.parameters()}
+    buffers = [(b, b.clone()) for b in model.buffers()]
+
+    active: List[str] = []
+    inputs: Set[Tuple[int, int]] = set()
+    saved: Dict[Tuple[int, int], Tuple[Optional[str], int]] = {}
+    times: Dict[str, List[float]] = {name: [] for name in modules.keys()}
+    starts: Dict[str, float] = {}
+
+    def synchronize() -> None:
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def pre_hook(module: nn.Module, module_inputs: Any) -> None:
+        assert len(active) == 0, f"Candidate modules cannot be nested, {names[module]} is within {active[-1]}"
+        active.append(names[module])
+        inputs.update(_storage_key(t) for t in _tensors(module_inputs))
+        synchronize()
+        starts[names[module]] = time.perf_counter()
+
+    def post_hook(module: nn.Module, *_: Any) -> None:
+        synchronize()
+        times[names[module]].append(time.perf_counter() - starts[names[module]])
+        active.pop()
+
+    def pack(tensor: Tensor) -> Tensor:
+        key = _storage_key(tensor)
+        if key not in params and key not in saved:
+            saved[key] = (active[-1] if len(active) > 0 else None, tensor.numel() * tensor.element_size())
+        return tensor
+
+    handles = []
+    for module in modules.values():
+        handles.append(module.register_forward_pre_hook(pre_hook))
+        handles.append(module.register_forward_hook(post_hook))
+
+    try:
+        for _ in range(iterations):
+            saved.clear()
+            inputs.clear()
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+                output = model(*args, **kwargs)
+            del output
+    finally:
+        for handle in handles:
+            handle.remove()
+        with torch.no_grad():
+            for buffer, value in buffers:
+                buffer.copy_(value)
+
+    # The inputs of the candidates are kept by the checkpointing, they are not freed
+    activation_bytes = {name: 0 for name in modules.keys()}
+    for key, (name, size) in saved.items():
+        if name is not None and key not in inputs:
+            activation_bytes[name] += size
+
+    profiles = {name: ModuleProfile(activation_bytes[name], min(times[name])) for name in modules.keys()}
+    return profiles, sum(size for _, size in saved.values())
+
+
+def plan_checkpointing(profiles: Dict[str, ModuleProfile], max_bytes: int, resolution: int = 1024) -> List[str]:
+    """
+    Picks the modules to checkpoint, so that the activations of the other ones fit in ``max_bytes``
+    with the smallest recompute time. This is a knapsack over the modules which are not checkpointed,
+    solved by dynamic programming with ``resolution`` steps of memory (rounded conservatively).
+
+    Args:
+        profiles (Dict[str, ModuleProfile]):
+            The candidate modules, see :func:`profile_activations`
+        max_bytes (int):
+            Bytes of activations that the modules which are not checkpointed can keep
+        resolution (int):
+            Number of memory steps of the knapsack (default: 1024)
+
+    Returns:
+        (List[str]):
+            The names of the modules to checkpoint
+    """
+    names = list(profiles.keys())
+    if sum(p.activation_bytes for p in profiles.values()) <= max_bytes:
+        return []
+    if max_bytes <= 0:
+        return names
+
+    step = max(1, math.ceil(max_bytes / resolution))
+    capacity = max_bytes // step
+    weights = [math.ceil(profiles[name].activation_bytes / step) for name in names]
+
+    # best[c]: largest forward time kept without checkpointing, within c memory steps
+    best = [0.0] * (capacity + 1)
+    kept = [[False] * (capacity + 1) for _ in names]
+    for i, name in enumerate(names):
+        weight, value = weights[i], profiles[name].forward_time
+        for c in range(capacity, weight - 1, -1):
+            if best[c - weight] + value > best[c]:
+                best[c] = best[c - weight] + value
+                kept[i][c] = True
+
+    checkpointed = []
+    c = capacity
+    for i in reversed(range(len(names))):
+        if kept[i][c]:
+            c -= weights[i]
+        else:
+            checkpointed.append(names[i])
+    return list(reversed(checkpointed))
+
+
+def auto_checkpoint(
+    model: nn.Module,
+    memory_budget: int,
+    *args: Any,
+    modules: Optional[Dict[str, nn.Module]] = None,
+    offload_to_cpu: bool = False,
+    iterations: int = 3,
+    **kwargs: Any,
+) -> CheckpointPlan:
+    """
+    Profiles the candidate modules on a sample batch, then wraps the ones which minimize the recompute
+    time in :func:`checkpoint_wrapper`, so that the activations saved for the backward fit in the budget.
+
+    The profiling can run on CPU, before moving the model to its device: the activation sizes do not depend
+    on the device, and the forward times are only compared in between modules.
+
+    Usage::
+
+        plan = auto_checkpoint(model, 8 * 2 ** 30, sample_batch)
+        print(plan.modules)
+        model.cuda()
+
+    Args:
+        model (nn.Module):
+            The model, which is called with ``*args`` and ``**kwargs`` for the profiling. The sample batch
+            should be the size of the actual (micro) batches
+        memory_budget (int):
+            Bytes of activations saved for the backward that the model can use, for the sample batch
+        modules (Dict[str, nn.Module], optional):
+            Candidate modules, by name, which cannot be nested. Defaults to the children of the model
+        offload_to_cpu (bool):
+            Whether the checkpointed modules offload their inputs to CPU, see :func:`checkpoint_wrapper`
+        iterations (int):
+            Number of forward passes for the profiling (default: 3)
+
+    Returns:
+        (CheckpointPlan):
+            The checkpointed modules and the expected memory and time
+    """
+    if modules is None:
+        modules = dict(model.named_children())
+
+    profiles, activation_bytes = profile_activations(model, modules, *args, iterations=iterations, **kwargs)
+
+    # Activations which are outside of the candidates, or their inputs, cannot be freed
+    fixed_bytes = activation_bytes - sum(p.activation_bytes for p in profiles.values())
+    checkpointed = plan_checkpointing(profiles, memory_budget - fixed_bytes)
+
+    planned_activation_bytes = activation_bytes - sum(profiles[name].activation_bytes for name in checkpointed)
+    if planned_activation_bytes > memory_budget:
+        logging.warning(
+            "The activations do not fit in the budget of %d bytes, %d bytes with all the candidates checkpointed"
+            % (memory_budget, planned_activation_bytes)
+        )
+
+    for name in checkpointed:
+        checkpoint_wrapper(modules[name], offload_to_cpu=offload_to_cpu)
+
+    plan = CheckpointPlan(
+        modules=checkpointed,
+        activation_bytes=activation_bytes,
+        planned_activation_bytes=planned_activation_bytes,
+        recompute_time=sum(profiles[name].forward_time for name in checkpointed),
+        profiles=profiles,
+    )
+    logging.info(
+        "Checkpointing %d modules out of %d, %d bytes of activations instead of %d"
+        % (len(checkpointed), len(profiles), planned_activation_bytes, activation_bytes)
+    )
+    return plan
@@ -8,13 +8,12 @@
 """
 import logging
 
-from .adascale import AdaScale, AdaScaleWrapper
+from .adafactor import Adafactor
+from .adam import Adam, Precision
+from .adascale import AdaScale, AdaScaleAccumulationScheduler, AdaScaleWrapper
+from .cpu_adam import CPUAdam
 from .oss import OSS
 
-try:
-    from .adam import Adam, Precision
-except ImportError:  # pragma: no cover
-    pass  # pragma: no cover
 try:
     from .grad_scaler import GradScaler
 except ImportError:
@@ -0,0 +1,227 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+import math
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+from torch.optim import Optimizer
+
+from .adam import Precision, _build_fp32_param_groups, _check_precision
+from .utils import _restore_state, _split_state_dict
+
+if TYPE_CHECKING:  # pragma: no cover
+    from torch.optim.optimizer import _params_t
+else:
+    _params_t = Any
+
+__all__ = ["Adafactor"]
+
+
+class Adafactor(Optimizer):
+    """
+    Implements the Adafactor algorithm, proposed in `Adafactor: Adaptive Learning Rates with Sublinear Memory Cost`_.
+
+    The second moment of the params with two dimensions or more is factored: only its running averages over
+    the rows and over the columns are kept, so the state of a (m, n) matrix is O(m + n) instead of O(mn).
+    The other params keep a full second moment, and the optional first moment (``beta1``) is never factored.
+
+    The precision modes are the ones of :class:`fairscale.optim.Adam`, the update is always computed in FP32:
+
+        - Precision.FULL_PRECISION: FP32 params and state
+        - Precision.MIXED_PRECISION: FP16 params, updated through FP32 master copies (``fp32_param_groups``)
+        - Precision.MEMORY_EFFICIENT_MIXED_PRECISION: FP16 params, FP32 state
+        - Precision.PURE_FP16: FP16 params and first moment. The factored second moments are small, they stay in FP32
+
+    .. note: Wrappers which flatten the params, like :class:`FullyShardedDataParallel`, leave only 1D params. These
+        are not factored, so the state is then the size of the params (or twice that with ``beta1``).
+
+    Arguments:
+        params (iterable): iterable of parameters to optimize or dicts defining parameter groups
+        lr (float, optional): external learning rate. Required if ``relative_step`` is False (default: None)
+        eps (Tuple[float, float]): regularization constants for the square gradient
+            and the parameter scale respectively (default: (1e-30, 1e-3))
+        clip_threshold (float): threshold of the root mean square of the final update (default: 1.0)
+        decay_rate (float): coefficient used to compute the running averages of the square gradient (default: -0.8)
+        beta1 (float, optional): coefficient used for the running average of the update,
+            no first moment is kept if None (default: None)
+        weight_decay (float, optional): weight decay, scaled by the learning rate (default: 0)
+        scale_parameter (bool): if True, the learning rate is scaled by the root mean square of the param
+            (default: True)
+        relative_step (bool): if True, a time-dependent learning rate is computed instead of the external one
+            (default: True)
+        warmup_init (bool): time-dependent learning rate computation depends on whether
+            warm-up initialization is being used (default: False)
+        precision (Precision, optional): one of Precision.FULL_PRECISION, Precision.MIXED_PRECISION,
+            Precision.MEMORY_EFFICIENT_MIXED_PRECISION or Precision.PURE_FP16. Inferred from the params if None
+            (default: None)
+
+    .. _Adafactor\\: Adaptive Learning Rates with Sublinear Memory Cost:
+        https://arxiv.org/abs/1804.04235
+    """
+
+    def __init__(
+        self,
+        params: _params_t,
+        lr: Optional[float] = None,
+        eps: Tuple[float, float] = (1e-30, 1e-3),
+        clip_threshold: float = 1.0,
+        decay_rate: float = -0.8,
+        beta1: Optional[float] = None,
+        weight_decay: float = 0.0,
+        scale_parameter: bool = True,
+        relative_step: bool = True,
+        warmup_init: bool = False,
+        precision: Optional[Precision] = None,
+    ):
+        if lr is not None and relative_step:
+            raise ValueError("Cannot combine manual lr and relative_step options")
+        if lr is None and not relative_step:
+            raise ValueError("An external lr is required if relative_step is False")
+        if warmup_init and not relative_step:
+            raise ValueError("warmup_init requires relative_step=True")
+
+        parameters: List[Any] = list(params)
+        self.precision = _check_precision(precision, parameters)
+        assert self.precision is not Precision.INT8_STATE, "Adafactor does not support Precision.INT8_STATE"
+
+        defaults = {
+            "lr": lr,
+            "eps": eps,
+            "clip_threshold": clip_threshold,
+            "decay_rate": decay_rate,
+            "beta1": beta1,
+            "weight_decay": weight_decay,
+            "scale_parameter": scale_parameter,
+            "relative_step": relative_step,
+            "warmup_init": warmup_init,
+        }
+        super().__init__(parameters, defaults)
+
+        self.optim_type = torch.float16 if self.precision is Precision.PURE_FP16 else torch.float32
+        self.fp32_param_groups: List[Dict[str, Any]] = []
+        if self.mixed_precision:
+            self.fp32_param_groups = _build_fp32_param_groups(self.param_groups, defaults)
+
+    @property
+    def supports_memory_efficient_fp16(self) -> bool:
+        return True
+
+    @property
+    def mixed_precision(self) -> bool:
+        return self.precision is Precision.MIXED_PRECISION
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        # The base optimizer casts the state to the type of the params, the moments keep theirs
+        state_dict, kept = _split_state_dict(state_dict, ["exp_avg", "exp_avg_sq", "exp_avg_sq_row", "exp_avg_sq_col"])
+        super().load_state_dict(state_dict)
+        _restore_state(self, state_dict, kept)
+
+    @torch.no_grad()
+    def step(self, closure: Optional[Callable[[], float]] = None) -> Optional[float]:
+        """Performs a single optimization step.
+
+        Arguments:
+            closure (callable, optional): A closure that reevaluates the model and returns the loss.
+        """
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for i, group in enumerate(self.param_groups):
+            for j, p in enumerate(group["params"]):
+                if p.grad is None:
+                    continue
+                if p.grad.is_sparse:
+                    raise RuntimeError("Adafactor does not support sparse gradients")
+
+                grad = p.grad.float()
+                factored = grad.dim() >= 2
+
+                state = self.state[p]
+                if len(state) == 0:
+                    state["step"] = 0
+                    if group["beta1"] is not None:
+                        state["exp_avg"] = torch.zeros_like(p, dtype=self.optim_type)
+                    if factored:
+                        state["exp_avg_sq_row"] = grad.new_zeros(grad.shape[:-1])
+                        state["exp_avg_sq_col"] = grad.new_zeros(grad.shape[:-2] + grad.shape[-1:])
+                    else:
+                        state["exp_avg_sq"] = torch.zeros_like(grad)
+                    state["RMS"] = 0.0
+
+                # The update is computed in FP32, on the master copy in mixed precision
+                param = self.fp32_param_groups[i]["params"][j] if self.mixed_precision else p
+                param_fp32 = param.data if param.dtype == torch.float32 else param.data.float()
+
+                state["step"] += 1
+                state["RMS"] = _rms(param_fp32)
+                lr = self._get_lr(group, state)
+
+                beta2t = 1.0 - math.pow(state["step"], group["decay_rate"])
+                update = (grad * grad).add_(group["eps"][0])
+                if factored:
+                    exp_avg_sq_row = state["exp_avg_sq_row"]
+                    exp_avg_sq_col = state["exp_avg_sq_col"]
+                    exp_avg_sq_row.mul_(beta2t).add_(update.mean(dim=-1), alpha=1.0 - beta2t)
+                    exp_avg_sq_col.mul_(beta2t).add_(update.mean(dim=-2), alpha=1.0 - beta2t)
+
+                    # Approximation of the inverse square root of the second moment, out of the factors
+                    update = _approx_sq_grad(exp_avg_sq_row, exp_avg_sq_col).mul_(grad)
+                else:
+                    exp_avg_sq = state["exp_avg_sq"]
+                    exp_avg_sq.mul_(beta2t).add_(update, alpha=1.0 - beta2t)
+                    update = exp_avg_sq.rsqrt().mul_(grad)
+
+                update.div_(max(1.0, _rms(update) / group["clip_threshold"])).mul_(lr)
+
+                if group["beta1"] is not None:
+                    exp_avg = state["exp_avg"]
+                    exp_avg_fp32 = exp_avg.float().mul_(group["beta1"]).add_(update, alpha=1 - group["beta1"])
+                    exp_avg.copy_(exp_avg_fp32)
+                    update = exp_avg_fp32
+
+                if group["weight_decay"] != 0:
+                    param_fp32.add_(param_fp32, alpha=-group["weight_decay"] * lr)
+
+                param_fp32.add_(-update)
+
+                if param_fp32 is not param.data:
+                    param.data.copy_(param_fp32)
+                if self.mixed_precision:
+                    p.data.copy_(param.data)
+
+        return loss
+
+    @staticmethod
+    def _get_lr(param_group: Dict[str, Any], param_state: Dict[str, Any]) -> float:
+        rel_step_sz = param_group["lr"]
+        if param_group["relative_step"]:
+            min_step = 1e-6 * param_state["step"] if param_group["warmup_init"] else 1e-2
+            rel_step_sz = min(min_step, 1.0 / math.sqrt(param_state["step"]))
+        param_scale = 1.0
+        if param_group["scale_parameter"]:
+            param_scale = max(param_group["eps"][1], param_state["RMS"])
+        return param_scale * rel_step_sz
+
+
+def _rms(tensor: torch.Tensor) -> float:
+    return tensor.pow(2).mean().sqrt().item()
+
+
+def _approx_sq_grad(exp_avg_sq_row: torch.Tensor, exp_avg_sq_col: torch.Tensor) -> torch.Tensor:
+    r_factor = (exp_avg_sq_row / exp_avg_sq_row.mean(dim=-1, keepdim=True)).rsqrt_().unsqueeze(-1)
+    c_factor = exp_avg_sq_col.unsqueeze(-2).rsqrt()
+    return torch.mul(r_factor, c_factor)
+
+
+def _state_size(param: torch.Tensor, beta1: Optional[float]) -> int:
+    """ Number of elements of the Adafactor state of a param """
+    numel = param.numel() if beta1 is not None else 0
+    if param.dim() >= 2:
+        rows, cols = param.shape[-2:]
+        return numel + param.numel() // (rows * cols) * (rows + cols)
+    return numel + param.numel()
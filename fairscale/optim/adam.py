@@ -4,10 +4,13 @@
 # LICENSE file in the root directory of this source tree.
 
 from enum import Enum, auto
-from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+import math
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Set, Tuple
 
 import torch
 
+from .utils import _multi_tensor_norm, _restore_state, _split_state_dict
+
 if TYPE_CHECKING:
     from torch.optim.optimizer import _params_t
 else:
@@ -15,287 +18,589 @@ else:
 
 try:
     from fairscale import fused_adam_cuda  # type: ignore
-
-    class Precision(Enum):
-        FULL_PRECISION = auto()
-        MIXED_PRECISION = auto()
-        MEMORY_EFFICIENT_MIXED_PRECISION = auto()
-        PURE_FP16 = auto()
-
-    class _MultiDeviceReplicator(object):
-        """
-        Lazily serves copies of a tensor to requested devices.  Copies are cached per-device.
-        """
-
-        def __init__(self, master_tensor: torch.Tensor):
-            assert master_tensor.is_cuda
-            self.master = master_tensor
-            self._per_device_tensors: Dict[torch.device, torch.Tensor] = {}
-
-        def get(self, device: torch.device) -> torch.Tensor:
-            retval = self._per_device_tensors.get(device, None)
-            if retval is None:
-                retval = self.master.to(device=device, non_blocking=True, copy=True)
-                self._per_device_tensors[device] = retval
-            return retval
-
-    class Adam(torch.optim.Optimizer):
-        state: dict
-        defaults: dict
-        """
-        Implements Adam algorithm. Currently GPU-only.
-        It has been proposed in `Adam: A Method for Stochastic Optimization`_.
-        Compared to the original version in Apex, the fairseq version casts grads
-        and params to FP32 internally to support ``--memory-efficient-fp16``.
+except ImportError:
+    fused_adam_cuda = None
+
+
+class Precision(Enum):
+    FULL_PRECISION = auto()
+    MIXED_PRECISION = auto()
+    MEMORY_EFFICIENT_MIXED_PRECISION = auto()
+    PURE_FP16 = auto()
+    INT8_STATE = auto()
+
+
+# Largest FP16 value, the FP16 optimizer state overflows beyond
+_FP16_MAX = 65504.0
+
+# Precision.INT8_STATE: the moments are quantized per block of values, relative to the block absmax. A power law
+# companding keeps the small values, exp_avg_sq spans a wider range and gets the higher exponent
+_QUANTIZATION_BLOCK_SIZE = 2048
+_QUANTIZED_STATE_KEYS = ["exp_avg", "exp_avg_sq", "exp_avg_absmax", "exp_avg_sq_absmax"]
+_EXP_AVG_EXPONENT = 2.0
+_EXP_AVG_SQ_EXPONENT = 4.0
+
+
+class _MultiDeviceReplicator(object):
+    """
+    Lazily serves copies of a tensor to requested devices.  Copies are cached per-device.
+    """
+
+    def __init__(self, master_tensor: torch.Tensor):
+        self.master = master_tensor
+        self._per_device_tensors: Dict[torch.device, torch.Tensor] = {}
+
+    def get(self, device: torch.device) -> torch.Tensor:
+        retval = self._per_device_tensors.get(device, None)
+        if retval is None:
+            retval = self.master.to(device=device, non_blocking=True, copy=True)
+            self._per_device_tensors[device] = retval
+        return retval
+
+
+class Adam(torch.optim.Optimizer):
+    state: dict
+    defaults: dict
+    """
+    Implements Adam algorithm.
+    It has been proposed in `Adam: A Method for Stochastic Optimization`_.
+    Compared to the original version in Apex, the fairseq version casts grads
+    and params to FP32 internally to support ``--memory-efficient-fp16``.
+    The CUDA params are updated with the fused kernel, if the extension is built.
+    Other params, or all of them if the extension is missing, go through a
+    multi-tensor implementation with the same semantics.
+    Arguments:
+        params (iterable): iterable of parameters to optimize or dicts defining
+            parameter groups.
+        lr (float, optional): learning rate. (default: 1e-3)
+        betas (Tuple[float, float], optional): coefficients used for computing
+            running averages of gradient and its square. (default: (0.9, 0.999))
+        eps (float, optional): term added to the denominator to improve
+            numerical stability. (default: 1e-8)
+        weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
+        amsgrad (boolean, optional): whether to use the AMSGrad variant of this
+            algorithm from the paper `On the Convergence of Adam and Beyond`_
+            (default: False) NOT SUPPORTED in FusedAdam!
+        eps_inside_sqrt (boolean, optional): in the 'update parameters' step,
+            adds eps to the bias-corrected second moment estimate before
+            evaluating square root instead of adding it to the square root of
+            second moment estimate as in the original paper. (default: False)
+        precision (Precision, optional): One of Precision.FULL_PRECISION,
+            Precision.MIXED_PRECISION, Precision.MEMORY_EFFICIENT_MIXED_PRECISION,
+            Precision.PURE_FP16 or Precision.INT8_STATE. Inferred based on model
+            parameter precision if None. (default: None)
+            With Precision.INT8_STATE, the params keep their type (FP32 or FP16)
+            and the moments are stored in 8 bits, with one scale per block of
+            2048 values. This is about 4x smaller than FP32 moments.
+        defer_optim_scale_update (bool, optional): with Precision.PURE_FP16,
+            the overflows of the optimizer state are detected and handled on
+            device, but adjusting the state scale requires a host sync. By default
+            it happens once per step, if set it is deferred to the next call to
+            :meth:`update_optim_scale` (or :meth:`state_dict`). The state scale
+            cannot go down in between, so this should be called regularly.
+            (default: False)
+    .. _Adam: A Method for Stochastic Optimization:
+        https://arxiv.org/abs/1412.6980
+    .. _On the Convergence of Adam and Beyond:
+        https://openreview.net/forum?id=ryQu7f-RZ
+    """
+
+    def __init__(
+        self,
+        params: _params_t,
+        lr: Optional[float] = 1e-3,
+        bias_correction: Optional[bool] = True,
+        betas: Optional[Tuple[float, float]] = (0.9, 0.999),
+        eps: Optional[float] = 1e-8,
+        eps_inside_sqrt: Optional[bool] = False,
+        weight_decay: Optional[float] = 0.0,
+        max_grad_norm: Optional[float] = 0.0,
+        amsgrad: Optional[bool] = False,
+        precision: Optional[Precision] = None,
+        defer_optim_scale_update: bool = False,
+    ):
+        parameters: List[Any] = list(params)
+        self.precision = _check_precision(precision, parameters)
+
+        self.optim_type = torch.float16 if precision is Precision.PURE_FP16 else torch.float32
+        self._optim_scale = float(2 ** 16) if precision is Precision.PURE_FP16 else 1.0
+        self._steps_since_optim_scale_change = 0
+        self._optim_scale_update_freq = 2000  # This is the value that GradScaler uses by default
+        self.defer_optim_scale_update = defer_optim_scale_update
+
+        # Overflows since the last optim scale update, kept on device so that checking them does not require a sync:
+        # number of steps which overflowed, and index of the last one (1-based, 0 if none)
+        self._steps_since_sync = 0
+        self._overflow_steps: Optional[torch.Tensor] = None
+        self._last_overflow_step: Optional[torch.Tensor] = None
+        self._overflow_buf = torch.cuda.IntTensor([0]) if fused_adam_cuda is not None else None  # type: ignore
+
+        if amsgrad:
+            raise RuntimeError("FusedAdam does not support the AMSGrad variant.")
+        defaults = {
+            "lr": lr,
+            "bias_correction": bias_correction,
+            "betas": betas,
+            "eps": eps,
+            "weight_decay": weight_decay,
+            "max_grad_norm": max_grad_norm,
+        }
+        super().__init__(parameters, defaults)
+        self.eps_mode = 0 if eps_inside_sqrt else 1
+
+        self.fp32_param_groups: List[Any] = []
+        if self.mixed_precision:
+            self._build_fp32_params(parameters)
+
+    def _build_fp32_params(self, params: Any) -> None:
+        param_groups = list(params)
+        if not isinstance(param_groups[0], dict):
+            param_groups = [{"params": param_groups}]
+
+        self.fp32_param_groups = _build_fp32_param_groups(param_groups, self.defaults)
+
+    @property
+    def supports_memory_efficient_fp16(self) -> bool:
+        return True
+
+    @property
+    def _step_supports_amp_scaling(self) -> bool:
+        return False
+
+    @property
+    def mixed_precision(self) -> bool:
+        return self.precision is Precision.MIXED_PRECISION
+
+    @property
+    def quantized_state(self) -> bool:
+        return self.precision is Precision.INT8_STATE
+
+    def state_dict(self) -> Dict[str, Any]:
+        self.update_optim_scale()
+        d = super().state_dict()
+        d["optim_scale"] = self._optim_scale
+        return d
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        kept: Dict[Any, Dict[str, torch.Tensor]] = {}
+        if self.quantized_state:
+            # The scales are FP32 whatever the params, and would not survive the cast to their type
+            state_dict, kept = _split_state_dict(state_dict, _QUANTIZED_STATE_KEYS)
+
+        super().load_state_dict(state_dict)
+        _restore_state(self, state_dict, kept)
+        self._optim_scale = state_dict["optim_scale"]
+        self._reset_overflow_tracking()
+
+        # TODO: Optimizer state gets cast to FP16 and back to FP32 for
+        # mixed-precision and memory-efficient mixed-precision. Eventually
+        # we want to fix this, as some precision may be lost
+        for group in self.param_groups:
+            for p in group["params"]:
+                if self.quantized_state:
+                    continue
+
+                self.state[p]["exp_avg"] = self.state[p]["exp_avg"].type(self.optim_type)
+                self.state[p]["exp_avg_sq"] = self.state[p]["exp_avg_sq"].type(self.optim_type)
+
+    def step(self, closure: Optional[Callable[[], float]] = None) -> Optional[float]:
+        """Performs a single optimization step.
         Arguments:
-            params (iterable): iterable of parameters to optimize or dicts defining
-                parameter groups.
-            lr (float, optional): learning rate. (default: 1e-3)
-            betas (Tuple[float, float], optional): coefficients used for computing
-                running averages of gradient and its square. (default: (0.9, 0.999))
-            eps (float, optional): term added to the denominator to improve
-                numerical stability. (default: 1e-8)
-            weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
-            amsgrad (boolean, optional): whether to use the AMSGrad variant of this
-                algorithm from the paper `On the Convergence of Adam and Beyond`_
-                (default: False) NOT SUPPORTED in FusedAdam!
-            eps_inside_sqrt (boolean, optional): in the 'update parameters' step,
-                adds eps to the bias-corrected second moment estimate before
-                evaluating square root instead of adding it to the square root of
-                second moment estimate as in the original paper. (default: False)
-            precision (Precision, optional): One of Precision.FULL_PRECISION,
-                Precision.MIXED_PRECISION, Precision.MEMORY_EFFICIENT_MIXED_PRECISION
-                or Precision.PURE_FP16. Inferred based on model parameter precision if
-                None. (default: None)
-        .. _Adam: A Method for Stochastic Optimization:
-            https://arxiv.org/abs/1412.6980
-        .. _On the Convergence of Adam and Beyond:
-            https://openreview.net/forum?id=ryQu7f-RZ
+            closure (callable, optional): A closure that reevaluates the model
+                and returns the loss.
+            grads (list of tensors, optional): weight gradient to use for the
+                optimizer update. If gradients have type torch.half, parameters
+                are expected to be in type torch.float. (default: None)
+            output params (list of tensors, optional): A reduced precision copy
+                of the updated weights written out in addition to the regular
+                updated weights. Have to be of same type as gradients. (default: None)
+            scale (float, optional): factor to divide gradient tensor values
+                by before applying to weights. (default: 1)
         """
-
-        def __init__(
-            self,
-            params: _params_t,
-            lr: Optional[float] = 1e-3,
-            bias_correction: Optional[bool] = True,
-            betas: Optional[Tuple[float, float]] = (0.9, 0.999),
-            eps: Optional[float] = 1e-8,
-            eps_inside_sqrt: Optional[bool] = False,
-            weight_decay: Optional[float] = 0.0,
-            max_grad_norm: Optional[float] = 0.0,
-            amsgrad: Optional[bool] = False,
-            precision: Optional[Precision] = None,
-        ):
-            parameters: List[Any] = list(params)
-            self.precision = precision
-
-            if self.precision is None:
-                self.precision = (
-                    Precision.FULL_PRECISION if parameters[0].dtype == torch.float32 else Precision.MIXED_PRECISION
-                )
-
-            if self.precision is not Precision.FULL_PRECISION:
-                assert parameters[0].dtype == torch.float16
-
-            self.optim_type = torch.float16 if precision is Precision.PURE_FP16 else torch.float32
-            self._optim_scale = float(2 ** 16) if precision is Precision.PURE_FP16 else 1.0
-            self._steps_since_optim_scale_change = 0
-            self._optim_scale_update_freq = 2000  # This is the value that GradScaler uses by default
-            self._overflow_buf = torch.cuda.IntTensor([0])  # type: ignore
-
-            if amsgrad:
-                raise RuntimeError("FusedAdam does not support the AMSGrad variant.")
-            defaults = {
-                "lr": lr,
-                "bias_correction": bias_correction,
-                "betas": betas,
-                "eps": eps,
-                "weight_decay": weight_decay,
-                "max_grad_norm": max_grad_norm,
-            }
-            super().__init__(parameters, defaults)
-            self.eps_mode = 0 if eps_inside_sqrt else 1
-
-            self.fp32_param_groups: List[Any] = []
-            if self.mixed_precision:
-                self._build_fp32_params(parameters)
-
-        def _build_fp32_params(self, params: Any) -> None:
-            # create FP32 copy of parameters and grads
-            fp32_params = []
-            for p in params:
-                p32 = torch.nn.Parameter(p.data.float()).to(p.device)
-                p32.grad = torch.zeros_like(p32.data)
-                fp32_params.append(p32)
-            params = fp32_params
-
-            self.fp32_param_groups = []
-            param_groups = list(params)
-            if not isinstance(param_groups[0], dict):
-                param_groups = [{"params": param_groups}]
-
-            for param_group in param_groups:
-                params = param_group["params"]
-                if isinstance(params, torch.Tensor):
-                    param_group["params"] = [params]
-                else:
-                    param_group["params"] = list(params)
-
-                for name, default in self.defaults.items():
-                    param_group.setdefault(name, default)
-
-                params = param_group["params"]
-
-                param_set = set()
-                for group in self.param_groups:
-                    param_set.update(set(group["params"]))
-
-                self.fp32_param_groups.append(param_group)
-
-        @property
-        def supports_memory_efficient_fp16(self) -> bool:
-            return True
-
-        @property
-        def _step_supports_amp_scaling(self) -> bool:
-            return False
-
-        @property
-        def mixed_precision(self) -> bool:
-            return self.precision is Precision.MIXED_PRECISION
-
-        def state_dict(self) -> Dict[str, Any]:
-            d = super().state_dict()
-            d["optim_scale"] = self._optim_scale
-            return d
-
-        def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
-            super().load_state_dict(state_dict)
-            self._optim_scale = state_dict["optim_scale"]
-
-            # TODO: Optimizer state gets cast to FP16 and back to FP32 for
-            # mixed-precision and memory-efficient mixed-precision. Eventually
-            # we want to fix this, as some precision may be lost
-            for group in self.param_groups:
-                for p in group["params"]:
-                    self.state[p]["exp_avg"] = self.state[p]["exp_avg"].type(self.optim_type)
-                    self.state[p]["exp_avg_sq"] = self.state[p]["exp_avg_sq"].type(self.optim_type)
-
-        def step(self, closure: Optional[Callable[[], float]] = None) -> Optional[float]:
-            """Performs a single optimization step.
-            Arguments:
-                closure (callable, optional): A closure that reevaluates the model
-                    and returns the loss.
-                grads (list of tensors, optional): weight gradient to use for the
-                    optimizer update. If gradients have type torch.half, parameters
-                    are expected to be in type torch.float. (default: None)
-                output params (list of tensors, optional): A reduced precision copy
-                    of the updated weights written out in addition to the regular
-                    updated weights. Have to be of same type as gradients. (default: None)
-                scale (float, optional): factor to divide gradient tensor values
-                    by before applying to weights. (default: 1)
-            """
-            loss = None
-            if closure is not None:
-                loss = closure()
-
-            for i in range(len(self.param_groups)):
-                group = self.param_groups[i]
-                bias_correction = 1 if group["bias_correction"] else 0
-                tensorlists: Dict[torch.device, List[List[torch.Tensor]]] = dict()
-
-                for j in range(len(group["params"])):
-                    p = group["params"][j]
-                    # note: p.grad should not ever be set for correct
-                    # operation of mixed precision optimizer that sometimes
-                    # sends None gradients
-                    if p.grad is None:
-                        continue
-                    grad = p.grad.data
-                    if grad.is_sparse:
-                        raise RuntimeError(
-                            "FusedAdam does not support sparse gradients, " "please consider SparseAdam instead"
-                        )
-
-                    state = self.state[p]
-
-                    # State initialization
-                    if len(state) == 0:
-                        state["step"] = 0
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        # Overflows of the optimizer state, for all the param groups
+        per_device_found_inf: Optional[_MultiDeviceReplicator] = None
+        # FP16 state per device and param group, the overflows reset it
+        per_device_states: Dict[torch.device, List[List[torch.Tensor]]] = {}
+        fused_devices: Set[torch.device] = set()
+
+        for i in range(len(self.param_groups)):
+            group = self.param_groups[i]
+            bias_correction = 1 if group["bias_correction"] else 0
+            tensorlists: Dict[torch.device, List[List[torch.Tensor]]] = dict()
+            quantized_states: List[Tuple[Dict[str, Any], torch.Tensor, torch.Tensor]] = []
+
+            for j in range(len(group["params"])):
+                p = group["params"][j]
+                # note: p.grad should not ever be set for correct
+                # operation of mixed precision optimizer that sometimes
+                # sends None gradients
+                if p.grad is None:
+                    continue
+                grad = p.grad.data
+                if grad.is_sparse:
+                    raise RuntimeError(
+                        "FusedAdam does not support sparse gradients, " "please consider SparseAdam instead"
+                    )
+
+                state = self.state[p]
+
+                # State initialization
+                if len(state) == 0:
+                    state["step"] = 0
+                    if self.quantized_state:
+                        _init_quantized_state(state, p)
+                    else:
                         # Exponential moving average of gradient values
                         state["exp_avg"] = torch.zeros_like(p, dtype=self.optim_type)
                         # Exponential moving average of squared gradient values
                         state["exp_avg_sq"] = torch.zeros_like(p, dtype=self.optim_type)
 
+                if self.quantized_state:
+                    # Work on FP32 moments, quantized back once the step is done
+                    exp_avg = _dequantize_blockwise(state["exp_avg"], state["exp_avg_absmax"], _EXP_AVG_EXPONENT)
+                    exp_avg_sq = _dequantize_blockwise(
+                        state["exp_avg_sq"], state["exp_avg_sq_absmax"], _EXP_AVG_SQ_EXPONENT
+                    )
+                    quantized_states.append((state, exp_avg, exp_avg_sq))
+                else:
                     exp_avg = state["exp_avg"]
                     exp_avg_sq = state["exp_avg_sq"]
-                    beta1, beta2 = group["betas"]
+                beta1, beta2 = group["betas"]
 
-                    state["step"] += 1
-                    out_p = p.data if self.mixed_precision else torch.tensor([])
-                    param = self.fp32_param_groups[i]["params"][j] if self.mixed_precision else p
+                state["step"] += 1
+                out_p = p.data if self.mixed_precision else torch.tensor([])
+                param = self.fp32_param_groups[i]["params"][j] if self.mixed_precision else p
 
-                    scale = 1.0
+                scale = 1.0
 
-                    if self.mixed_precision:
-                        pl = [param.data, exp_avg, exp_avg_sq, grad, out_p]
-                        if p.device not in tensorlists:
-                            tensorlists[p.device] = [[], [], [], [], []]
+                if self.mixed_precision:
+                    pl = [param.data, exp_avg, exp_avg_sq, grad, out_p]
+                    if p.device not in tensorlists:
+                        tensorlists[p.device] = [[], [], [], [], []]
 
-                        for tl, t in zip(tensorlists[p.device], pl):
-                            tl.append(t)
-                    else:
-                        pl = [param.data, exp_avg, exp_avg_sq, grad]
+                    for tl, t in zip(tensorlists[p.device], pl):
+                        tl.append(t)
+                else:
+                    pl = [param.data, exp_avg, exp_avg_sq, grad]
 
-                        if p.device not in tensorlists:
-                            tensorlists[p.device] = [[], [], [], []]
+                    if p.device not in tensorlists:
+                        tensorlists[p.device] = [[], [], [], []]
 
-                        for tl, t in zip(tensorlists[p.device], pl):
-                            tl.append(t)
+                    for tl, t in zip(tensorlists[p.device], pl):
+                        tl.append(t)
 
+            if len(tensorlists) == 0:
+                continue
+
+            if per_device_found_inf is None:
                 found_inf = torch.full((1,), 0.0, dtype=torch.float32, device=list(tensorlists.keys())[0])
                 per_device_found_inf = _MultiDeviceReplicator(found_inf)
 
-                for tensordevice, tensorlist in tensorlists.items():
-                    with torch.cuda.device(tensordevice):
-                        fused_adam_cuda.adam(
-                            2048 * 32,
-                            self._overflow_buf,
-                            tensorlist,
-                            group["lr"],
-                            beta1,
-                            beta2,
-                            group["eps"],
-                            scale,
-                            self._optim_scale,
-                            per_device_found_inf.get(tensordevice),
-                            state["step"],
-                            self.eps_mode,
-                            bias_correction,
-                            group["weight_decay"],
-                        )
-
-                if sum(v.item() for v in per_device_found_inf._per_device_tensors.values()):
-                    self._steps_since_optim_scale_change = 0
-                    self._optim_scale /= 2
-
-                    if self._optim_scale < 1.0:
-                        raise RuntimeError("Optimizer state scale < 1. This may mean that gradients are exploding")
-
-                    for group in self.param_groups:
-                        for p in group["params"]:
-                            self.state[p]["exp_avg"] = torch.zeros_like(p, dtype=self.optim_type)
-                            self.state[p]["exp_avg_sq"] = torch.zeros_like(p, dtype=self.optim_type)
-                else:
-                    self._steps_since_optim_scale_change += 1
-
-                if self._steps_since_optim_scale_change == self._optim_scale_update_freq:
-                    self._steps_since_optim_scale_change = 0
-                    if self._optim_scale < 2 ** 16:
-                        self._optim_scale *= 2
-
-            return loss
-
-
-except ImportError:
-    pass
+            for tensordevice, tensorlist in tensorlists.items():
+                per_device_states.setdefault(tensordevice, []).append(tensorlist[1] + tensorlist[2])
+                if fused_adam_cuda is None or tensordevice.type != "cuda":
+                    _multi_tensor_adam(
+                        tensorlist,
+                        group["lr"],
+                        beta1,
+                        beta2,
+                        group["eps"],
+                        scale,
+                        self._optim_scale,
+                        per_device_found_inf.get(tensordevice),
+                        state["step"],
+                        self.eps_mode,
+                        bias_correction,
+                        group["weight_decay"],
+                    )
+                    continue
+
+                fused_devices.add(tensordevice)
+                with torch.cuda.device(tensordevice):
+                    fused_adam_cuda.adam(
+                        2048 * 32,
+                        self._overflow_buf,
+                        tensorlist,
+                        group["lr"],
+                        beta1,
+                        beta2,
+                        group["eps"],
+                        scale,
+                        self._optim_scale,
+                        per_device_found_inf.get(tensordevice),
+                        state["step"],
+                        self.eps_mode,
+                        bias_correction,
+                        group["weight_decay"],
+                    )
+
+            for state, exp_avg, exp_avg_sq in quantized_states:
+                _quantize_blockwise(exp_avg, state["exp_avg"], state["exp_avg_absmax"], _EXP_AVG_EXPONENT)
+                _quantize_blockwise(exp_avg_sq, state["exp_avg_sq"], state["exp_avg_sq_absmax"], _EXP_AVG_SQ_EXPONENT)
+
+        # Only the FP16 state can overflow
+        if self.precision is Precision.PURE_FP16 and per_device_found_inf is not None:
+            self._handle_overflows(per_device_found_inf, per_device_states, fused_devices)
+            if not self.defer_optim_scale_update:
+                self.update_optim_scale()
+
+        return loss
+
+    def update_optim_scale(self) -> None:
+        """
+        Adjust the optimizer state scale, given the overflows since the last update. This syncs with the device.
+        Only useful with `defer_optim_scale_update`, the scale is otherwise updated at every step.
+        """
+        if self._steps_since_sync == 0:
+            return
+
+        assert self._overflow_steps is not None and self._last_overflow_step is not None
+        # Single sync for both counters
+        overflow_steps, last_overflow_step = map(
+            int, torch.cat([self._overflow_steps, self._last_overflow_step]).tolist()
+        )
+        steps = self._steps_since_sync
+        self._reset_overflow_tracking()
+
+        if overflow_steps > 0:
+            # The state scale is halved for every step which overflowed
+            self._steps_since_optim_scale_change = steps - last_overflow_step
+            self._optim_scale /= 2 ** overflow_steps
+
+            if self._optim_scale < 1.0:
+                raise RuntimeError("Optimizer state scale < 1. This may mean that gradients are exploding")
+        else:
+            self._steps_since_optim_scale_change += steps
+
+        if self._steps_since_optim_scale_change >= self._optim_scale_update_freq:
+            self._steps_since_optim_scale_change = 0
+            if self._optim_scale < 2 ** 16:
+                self._optim_scale *= 2
+
+    def _handle_overflows(
+        self,
+        per_device_found_inf: _MultiDeviceReplicator,
+        per_device_states: Dict[torch.device, List[List[torch.Tensor]]],
+        fused_devices: Set[torch.device],
+    ) -> None:
+        """Reset the state if it overflowed on any device, and keep track of the overflows. All of it stays on device.
+
+        The multi-tensor update resets the state of its param group as part of the update, given the overflows
+        seen so far on the device, so that its state is always finite. The other param groups are then reset
+        with a single batched pass per device. The fused kernel does not reset the state, which can then hold
+        infs: these are masked per tensor.
+        """
+        master = per_device_found_inf.master
+        step_overflow = torch.zeros_like(master)
+        for found_inf in per_device_found_inf._per_device_tensors.values():
+            step_overflow = torch.max(step_overflow, found_inf.to(master.device, non_blocking=True))
+
+        # All the param groups are reset if any of them overflowed, on any device
+        for device, states in per_device_states.items():
+            overflow = step_overflow.to(device, non_blocking=True)
+            if device in fused_devices:
+                for tensors in states:
+                    for t in tensors:
+                        t.masked_fill_(overflow > 0, 0.0)
+            else:
+                # The state is finite, keep is 0 if any param group overflowed
+                tensors = [t for group_tensors in states for t in group_tensors]
+                keep = (overflow == 0).to(tensors[0].dtype).squeeze()
+                torch._foreach_mul_(tensors, [keep] * len(tensors))
+
+        if self._overflow_steps is None or self._overflow_steps.device != master.device:
+            self._overflow_steps = torch.zeros_like(master)
+            self._last_overflow_step = torch.zeros_like(master)
+
+        assert self._last_overflow_step is not None
+        self._steps_since_sync += 1
+        self._overflow_steps += (step_overflow > 0).float()
+        self._last_overflow_step.masked_fill_(step_overflow > 0, float(self._steps_since_sync))
+
+    def _reset_overflow_tracking(self) -> None:
+        self._steps_since_sync = 0
+        if self._overflow_steps is not None and self._last_overflow_step is not None:
+            self._overflow_steps.zero_()
+            self._last_overflow_step.zero_()
+
+
+def _check_precision(precision: Optional[Precision], params: List[Any]) -> Precision:
+    """ Infer the precision from the type of the params if it is not given, and check that they match """
+    first_param = params[0]["params"][0] if isinstance(params[0], dict) else params[0]
+
+    if precision is None:
+        precision = Precision.FULL_PRECISION if first_param.dtype == torch.float32 else Precision.MIXED_PRECISION
+
+    if precision not in (Precision.FULL_PRECISION, Precision.INT8_STATE):
+        assert first_param.dtype == torch.float16
+
+    return precision
+
+
+def _build_fp32_param_groups(param_groups: List[Dict[str, Any]], defaults: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """ FP32 copies of the params, with zeroed grads, as one group per param group. Used as master weights """
+    fp32_param_groups = []
+    for param_group in param_groups:
+        params = param_group["params"]
+        params = [params] if isinstance(params, torch.Tensor) else list(params)
+
+        fp32_params = []
+        for p in params:
+            p32 = torch.nn.Parameter(p.data.float()).to(p.device)
+            p32.grad = torch.zeros_like(p32.data)
+            fp32_params.append(p32)
+
+        fp32_param_group = {**param_group, "params": fp32_params}
+        for name, default in defaults.items():
+            fp32_param_group.setdefault(name, default)
+        fp32_param_groups.append(fp32_param_group)
+
+    return fp32_param_groups
+
+
+def _to_fp32(tensors: List[torch.Tensor]) -> List[torch.Tensor]:
+    """ FP32 version of the tensors, the FP32 tensors are not copied """
+    return [t if t.dtype == torch.float32 else t.float() for t in tensors]
+
+
+def _copy_back(src: List[torch.Tensor], dst: List[torch.Tensor]) -> None:
+    for s, d in zip(src, dst):
+        if s is not d:
+            d.copy_(s)
+
+
+@torch.no_grad()
+def _multi_tensor_adam(
+    tensorlist: List[List[torch.Tensor]],
+    lr: float,
+    beta1: float,
+    beta2: float,
+    eps: float,
+    grad_scale: float,
+    optim_scale: float,
+    found_inf: torch.Tensor,
+    step: int,
+    eps_mode: int,
+    bias_correction: int,
+    decay: float,
+) -> None:
+    """
+    Same as the fused_adam_cuda kernel, with the multi-tensor ops from PyTorch.
+    The math is done in FP32, whatever the type of the params, grads and state.
+
+    Arguments:
+        tensorlist: params, exp_avgs, exp_avg_sqs, grads and optionally the FP16 copies of the params,
+            all on the same device
+        found_inf: set to 1 if the FP16 state overflows
+    """
+    assert hasattr(torch, "_foreach_addcmul_"), "torch >= 1.7 is required when the fused Adam kernel is not used"
+
+    params, exp_avgs, exp_avg_sqs, grads = tensorlist[:4]
+    use_optim_scaling = exp_avgs[0].dtype == torch.float16
+
+    if bias_correction == 1:
+        step_size = lr * math.sqrt(1 - beta2 ** step) / (1 - beta1 ** step)
+    else:
+        step_size = lr
+
+    params_fp32 = _to_fp32(params)
+    momentums = _to_fp32(exp_avgs)
+    velocities = _to_fp32(exp_avg_sqs)
+    scaled_grads = _to_fp32(grads)
+    if grad_scale != 1.0:
+        scaled_grads = torch._foreach_div(scaled_grads, grad_scale)
+
+    if use_optim_scaling:
+        # Optimizer state is in half precision and must be scaled
+        torch._foreach_div_(momentums, optim_scale)
+        torch._foreach_div_(velocities, optim_scale)
+
+    torch._foreach_mul_(momentums, beta1)
+    torch._foreach_add_(momentums, scaled_grads, alpha=1 - beta1)
+    torch._foreach_mul_(velocities, beta2)
+    torch._foreach_addcmul_(velocities, scaled_grads, scaled_grads, value=1 - beta2)
+
+    if use_optim_scaling:
+        # The FP16 state overflows past its largest value (or is not finite), which is checked on the FP32 values
+        # in a single pass. The state is then reset to zero on the device as part of the copy back
+        scaled = torch._foreach_mul(momentums + velocities, optim_scale)
+        overflow = ~(_multi_tensor_norm(scaled, math.inf).max() <= _FP16_MAX)
+        found_inf.masked_fill_(overflow, 1.0)
+        overflow = (found_inf > 0).squeeze()
+        for src, dst in zip(scaled, exp_avgs + exp_avg_sqs):
+            dst.copy_(src.masked_fill_(overflow, 0.0))
+    else:
+        _copy_back(momentums, exp_avgs)
+        _copy_back(velocities, exp_avg_sqs)
+
+    if eps_mode == 0:
+        # eps under the square root
+        denoms = torch._foreach_add(velocities, eps)
+        torch._foreach_sqrt_(denoms)
+    else:
+        denoms = torch._foreach_sqrt(velocities)
+        torch._foreach_add_(denoms, eps)
+
+    if decay != 0:
+        updates = torch._foreach_div(momentums, denoms)
+        torch._foreach_add_(updates, params_fp32, alpha=decay)
+        torch._foreach_add_(params_fp32, updates, alpha=-step_size)
+    else:
+        torch._foreach_addcdiv_(params_fp32, momentums, denoms, value=-step_size)
+    _copy_back(params_fp32, params)
+
+    if len(tensorlist) == 5:
+        # Mixed precision, refresh the FP16 params
+        _copy_back(params_fp32, tensorlist[4])
+
+
+def _init_quantized_state(state: Dict[str, Any], p: torch.Tensor) -> None:
+    num_blocks = (p.numel() + _QUANTIZATION_BLOCK_SIZE - 1) // _QUANTIZATION_BLOCK_SIZE
+    # exp_avg is signed, exp_avg_sq is not and gets the full uint8 range
+    state["exp_avg"] = torch.zeros_like(p, dtype=torch.int8)
+    state["exp_avg_absmax"] = torch.zeros(num_blocks, dtype=torch.float32, device=p.device)
+    state["exp_avg_sq"] = torch.zeros_like(p, dtype=torch.uint8)
+    state["exp_avg_sq_absmax"] = torch.zeros(num_blocks, dtype=torch.float32, device=p.device)
+
+
+def _padded_blocks(t: torch.Tensor, num_blocks: int) -> torch.Tensor:
+    """ View of t, flat and zero padded, shaped (num_blocks, _QUANTIZATION_BLOCK_SIZE). Copies if padding is needed """
+    flat = t.reshape(-1)
+    padding = num_blocks * _QUANTIZATION_BLOCK_SIZE - flat.numel()
+    if padding > 0:
+        flat = torch.cat([flat, flat.new_zeros(padding)])
+    return flat.view(num_blocks, _QUANTIZATION_BLOCK_SIZE)
+
+
+@torch.no_grad()
+def _quantize_blockwise(src: torch.Tensor, dst: torch.Tensor, absmax: torch.Tensor, exponent: float) -> None:
+    """
+    Quantize src into dst (int8 or uint8, which then requires src >= 0), in place.
+    Each block is scaled by its absmax, then the values are companded with the given exponent.
+    """
+    blocks = _padded_blocks(src.float(), absmax.numel())
+    absmax.copy_(blocks.abs().max(dim=1)[0])
+
+    normalized = blocks / absmax.masked_fill(absmax == 0, 1.0).unsqueeze(1)
+    if dst.dtype == torch.int8:
+        quantized = normalized.abs().pow_(1.0 / exponent).mul_(127.0).round_().mul_(normalized.sign())
+    else:
+        assert dst.dtype == torch.uint8
+        quantized = normalized.pow_(1.0 / exponent).mul_(255.0).round_()
+
+    dst.view(-1).copy_(quantized.view(-1)[: dst.numel()])
+
+
+@torch.no_grad()
+def _dequantize_blockwise(src: torch.Tensor, absmax: torch.Tensor, exponent: float) -> torch.Tensor:
+    """ FP32 tensor out of a tensor quantized with _quantize_blockwise """
+    blocks = _padded_blocks(src.float(), absmax.numel())
+    levels = 127.0 if src.dtype == torch.int8 else 255.0
+    values = blocks.abs().div_(levels).pow_(exponent).mul_(absmax.unsqueeze(1))
+    if src.dtype == torch.int8:
+        values.mul_(blocks.sign())
+    return values.view(-1)[: src.numel()].view_as(src)
@@ -32,7 +32,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import functools
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Type
+import logging
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Type
 
 import numpy as np
 import torch
@@ -40,6 +41,9 @@ from torch.autograd import Variable
 import torch.distributed as dist
 from torch.optim import SGD, Optimizer
 
+from .oss import OSS
+from .utils import calc_grad_norm_partial
+
 if TYPE_CHECKING:  # pragma: no cover
     from torch.optim.optimizer import _params_t
 else:
@@ -60,6 +64,12 @@ class AdaScale(Optimizer):
 
     Note that, AdaScale does *not* help increase per-GPU batch size.
 
+    The reduced gradients can be sharded: AdaScale can wrap ``OSS`` (with
+    ``DistributedDataParallel`` or ``ShardedDataParallel``), or an optimizer
+    for the params of a ``FullyShardedDataParallel`` model. The squared norms
+    are then computed over the owned gradients or the local shards, and summed
+    in between the ranks.
+
     There are several ways to integrate AdaScale with your training loop.
     We show two examples below.
 
@@ -164,6 +174,7 @@ class AdaScale(Optimizer):
 
         # The previous function call sets smoothing to its default value.
         # Override that here if smoothing was passed as an argument.
+        self._user_smoothing = smoothing is not None
         if smoothing is not None:
             self._smoothing = smoothing
 
@@ -180,10 +191,17 @@ class AdaScale(Optimizer):
             },
         )
 
+        # Device copies of the moving averages, updated after each backward pass without any host sync.
+        # The NumPy state above is only refreshed when it is read, see `_state`.
+        self._device_state: Dict[str, torch.Tensor] = {}
+        self._device_state_dirty = False
+
         self._scale = 1.0  # Assign to inform mypy about the typing of this variable.
         self.set_scale(self._world_size * self._num_grads_to_accum if scale is None else scale)
 
         self._hook_handles: List[Any] = []
+        self._replicated_params: List[List[torch.nn.Parameter]] = []
+        self._sharded_params: List[List[torch.nn.Parameter]] = []
         self._hook()
 
     def _hook(self) -> None:
@@ -199,6 +217,41 @@ class AdaScale(Optimizer):
                 h = param.register_hook(functools.partial(self._backward_hook, idx))
                 self._hook_handles.append(h)
 
+        self._split_params()
+
+    def _split_params(self) -> None:
+        """ Internal function to sort the params of each group, depending on where their reduced gradients live.
+
+            - the reduced gradients of the params sharded by ``FullyShardedDataParallel`` are split in between
+              the ranks, and with ``OSS`` (typically along with ``ShardedDataParallel``) they are only
+              guaranteed to be there on the rank which owns the param. The squared norms of these are
+              summed locally, over the owned params or the local shards, then in between the ranks.
+            - the other params (typically ``DistributedDataParallel``) have the full reduced gradients
+              on all the ranks, their squared norms are computed locally.
+        """
+        param_to_rank: Dict[torch.Tensor, int] = {}
+        rank = 0
+        if isinstance(self._optimizer, OSS):
+            param_to_rank = self._optimizer.param_to_rank
+            rank = self._optimizer.rank
+
+        self._replicated_params, self._sharded_params = [], []
+        for param_group in self._optimizer.param_groups:
+            replicated, sharded = [], []
+            for param in param_group["params"]:
+                if getattr(param, "_is_sharded", False):
+                    sharded.append(param)
+                elif param in param_to_rank:
+                    if param_to_rank[param] == rank:
+                        sharded.append(param)
+                else:
+                    replicated.append(param)
+            self._replicated_params.append(replicated)
+            self._sharded_params.append(sharded)
+
+        # This has to be the same on all ranks, since it decides of the collective
+        self._has_sharded_grads = isinstance(self._optimizer, OSS) or any(len(s) > 0 for s in self._sharded_params)
+
     def __del__(self) -> None:
         """ Unhook in case caller forgets to call unhook.
 
@@ -225,9 +278,42 @@ class AdaScale(Optimizer):
     @property
     def _state(self) -> Dict[str, np.ndarray]:
         """
-        Return the states of AdaScale.
+        Return the states of AdaScale, as NumPy arrays.
+
+        The moving averages are updated on device during the backward passes, they are
+        copied back here (with a single device to host transfer) when they are first read.
+        """
+        state = self._optimizer.state["adascale"]
+        if self._device_state_dirty:
+            names = list(self._device_state.keys())
+            values = torch.cat([self._device_state[name] for name in names]).cpu().numpy()
+            offset = 0
+            for name in names:
+                numel = self._device_state[name].numel()
+                state[name] = values[offset : offset + numel]
+                offset += numel
+            self._device_state_dirty = False
+        return state
+
+    def _get_device_state(self, device: torch.device) -> Dict[str, torch.Tensor]:
+        """
+        Return the device copies of the moving averages, which are created from the NumPy state if needed.
+        The counts of the non debiased averages are host values, they are not part of it.
         """
-        return self._optimizer.state["adascale"]
+        if len(self._device_state) == 0 or next(iter(self._device_state.values())).device != device:
+            state = self._state
+            self._device_state = {
+                name: torch.as_tensor(value, dtype=torch.float64).to(device)
+                for name, value in state.items()
+                if not name.endswith("_count")
+            }
+        return self._device_state
+
+    def _invalidate_device_state(self) -> None:
+        """ Drop the device copies of the moving averages, to be called when the NumPy state is modified """
+        # Make sure that pending updates are not lost
+        _ = self._state
+        self._device_state = {}
 
     @property
     def scale(self) -> float:
@@ -284,6 +370,7 @@ class AdaScale(Optimizer):
             elif "grad_var_avg_total" in self._state:  # _debias_ewma==False
                 self._state["grad_var_avg_total"] *= self._scale / scale
             self._state["grad_var_avg"] *= self._scale / scale
+            self._invalidate_device_state()
         self._scale = scale
 
     def _grad_sqr_avg(self, pg_idx: Optional[int] = None) -> float:
@@ -340,17 +427,20 @@ class AdaScale(Optimizer):
         gain = (var + sqr) / (var / self.scale + sqr)
         return gain
 
-    def _update_avg(self, name: str, value: np.ndarray, factor: float) -> None:
+    def _update_avg(self, name: str, value: torch.Tensor, factor: float) -> None:
+        # The averages are kept on the device of `value`, the NumPy state is refreshed lazily.
+        device_state = self._get_device_state(value.device)
+        self._device_state_dirty = True
         if self._debias_ewma:
             # This function computes and stores the moving average of a vector
             # using a smoothing factor.
-            biased = self._state.get(name + "_biased", np.zeros(value.shape[0]))
-            unbias = self._state.get(name + "_unbias", np.zeros(value.shape[0]))
+            biased = device_state.get(name + "_biased", torch.zeros_like(value))
+            unbias = device_state.get(name + "_unbias", torch.zeros_like(value))
             biased = factor * biased + (1.0 - factor) * value
             unbias = factor * unbias + (1.0 - factor)
-            self._state[name + "_biased"] = biased
-            self._state[name + "_unbias"] = unbias
-            self._state[name] = biased / unbias
+            device_state[name + "_biased"] = biased
+            device_state[name + "_unbias"] = unbias
+            device_state[name] = biased / unbias
         else:
             # Moving average procedure described in Appendix B.3
             # For iterations t < 1 / (1 - smoothing) define grad_var_avg
@@ -362,19 +452,22 @@ class AdaScale(Optimizer):
             #       after some iterations are done. But, then the if condition
             #       below will need to be a np.where. I leave this corner
             #       case to a future exercise.
-            count = self._state.get(name + "_count", np.zeros(1))
+            #
+            # The count is a host value, it does not need to be synced.
+            host_state = self._optimizer.state["adascale"]
+            count = host_state.get(name + "_count", np.zeros(1))
             count[0] += 1
-            self._state[name + "_count"] = count
+            host_state[name + "_count"] = count
             if count < 1 / (1 - self._smoothing):
-                total = self._state.get(name + "_total", None)
+                total = device_state.get(name + "_total", None)
                 if total is None:
                     total = value
                 else:
-                    total += value
-                self._state[name + "_total"] = total
-                self._state[name] = total / count
+                    total = total + value
+                device_state[name + "_total"] = total
+                device_state[name] = total / float(count[0])
             else:
-                self._state[name] = factor * self._state[name] + (1.0 - factor) * value
+                device_state[name] = factor * device_state[name] + (1.0 - factor) * value
 
     def _backward_hook(self, pg_idx: int, grad: torch.Tensor) -> None:
         # This method should be invoked once for each parameter during the
@@ -438,25 +531,34 @@ class AdaScale(Optimizer):
         # Since self._local_grad_sqr is FP32, sum shouldn't overflow.
         # This vector has length of # of param_groups, so it is small, but we
         # use async to hide the all_reduce latency, esp when # of nodes is large.
+        #
+        # The sums of squares of the sharded reduced gradients are partial, they are
+        # summed in between the ranks as part of the same all_reduce.
+        # One multi-tensor kernel per param group, the results stay on device: no host sync.
+        device = self._local_grad_sqr.device
+        num_groups = len(self._optimizer.param_groups)
+        buffer = self._local_grad_sqr
+        if self._has_sharded_grads:
+            buffer = torch.cat([buffer, self._grad_sqr(self._sharded_params, device)])
+
         work = None
         if self._world_size > 1:
-            work = dist.all_reduce(self._local_grad_sqr, async_op=True)  # SUM
+            work = dist.all_reduce(buffer, async_op=True)  # SUM
 
-        # Compute the sums of squares for reduced gradients.
-        # Divide by _num_grads_to_accum since the gradients are accumulated.
-        total_grad_sqr = np.array(
-            [sum(param.grad.pow(2).sum().item() for param in group["params"]) for group in self._optimizer.param_groups]
-        )
-        # Divide by (_num_grads_to_accum ** 2) to account for gradient
-        # accumulation.
-        if self._num_grads_to_accum > 1:
-            # np array doesn't support /=.
-            total_grad_sqr = total_grad_sqr / (self._num_grads_to_accum ** 2)
+        # Compute the sums of squares for the replicated reduced gradients, while the all_reduce is in flight.
+        total_grad_sqr = self._grad_sqr(self._replicated_params, device).double()
 
-        # Wait for all_reduce to be done and move it to cpu & np.
+        # Wait for all_reduce to be done, the statistics are then computed on device.
         if work:
             work.wait()
-        local_grad_sqr = self._local_grad_sqr.cpu().numpy()
+        local_grad_sqr = buffer[:num_groups].double()
+        if self._has_sharded_grads:
+            total_grad_sqr += buffer[num_groups:].double()
+
+        # Divide by (_num_grads_to_accum ** 2) to account for gradient
+        # accumulation.
+        if self._num_grads_to_accum > 1:
+            total_grad_sqr /= self._num_grads_to_accum ** 2
 
         # See appendix B.3 of the paper.
         # Modified to handle cases where scale != world_size
@@ -468,14 +570,19 @@ class AdaScale(Optimizer):
         cN = self._world_size * self._num_grads_to_accum
         grad_var = local_grad_sqr * (S / cN) / (cN - 1) - total_grad_sqr * S / (cN - 1)
         grad_sqr = total_grad_sqr - grad_var / S
-        grad_var = np.maximum(grad_var, 1e-6)
-        grad_sqr = np.maximum(grad_sqr, 0.0)
+        grad_var = grad_var.clamp(min=1e-6)
+        grad_sqr = grad_sqr.clamp(min=0.0)
         self._update_avg("grad_sqr_avg", grad_sqr, self.smoothing)
         self._update_avg("grad_var_avg", grad_var, self.smoothing)
         self._last_final_backward_call = self._num_backward_calls
         # Indicating backward is done.
         self._local_grad_sqr = None
 
+    @staticmethod
+    def _grad_sqr(params_per_group: List[List[torch.nn.Parameter]], device: torch.device) -> torch.Tensor:
+        """ Sums of the squared gradients, per param group, as a single FP32 tensor on the given device """
+        return torch.stack([calc_grad_norm_partial(params, 2.0, device) for params in params_per_group]).float()
+
     def step(self, *args: Any, **kwargs: Any) -> Optional[float]:
         """
         Run one optimizer step using Adascale. Essentially just invokes
@@ -524,7 +631,8 @@ class AdaScale(Optimizer):
         # Update the hooks.
         self.unhook()
         self._hook()
-        # Extend the states.
+        # Extend the states, on the host. The device copies are rebuilt on the next backward pass.
+        self._invalidate_device_state()
         for name in self._state.keys():
             assert name.startswith("grad_sqr_avg") or name.startswith("grad_var_avg"), name
             if name.endswith("_count"):
@@ -550,6 +658,8 @@ class AdaScale(Optimizer):
                 associated AdaScale internal states are not saved in the checkpoint.
         """
         assert self._local_grad_sqr is None, "Don't checkpoint in backward"
+        # Make sure that the NumPy state is up to date
+        _ = self._state
         return self._optimizer.state_dict()
 
     def load_state_dict(self, data: Dict) -> None:
@@ -561,6 +671,8 @@ class AdaScale(Optimizer):
                 associated AdaScale internal states are not saved in the checkpoint.
         """
         assert self._local_grad_sqr is None, "Don't load checkpoint in backward"
+        self._device_state = {}
+        self._device_state_dirty = False
         return self._optimizer.load_state_dict(data)
 
     def set_num_gradients_to_accumulate(self, num_gradients_to_accumulate: int, update_smoothing: bool = True,) -> None:
@@ -639,3 +751,166 @@ class AdaScaleWrapper(AdaScale):
     ):
         optim_obj = optim_cls(params, **additional_optim_args)
         super().__init__(optim_obj, world_size, scale, smoothing, num_gradients_to_accumulate, debias_ewma)
+
+
+class AccumulationChange(NamedTuple):
+    """ A change of the number of gradients to accumulate decided by :class:`AdaScaleAccumulationScheduler` """
+
+    step: int
+    old_num_gradients_to_accumulate: int
+    new_num_gradients_to_accumulate: int
+    gain: float
+    noise_scale: float
+    reason: str
+
+
+class AdaScaleAccumulationScheduler:
+    """
+    Adapts the number of gradients that :class:`AdaScale` accumulates between each optimizer
+    step, from the AdaScale estimates of the gradient mean and variance.
+
+    The gradient noise scale, relative to the batch size of scale 1, is ``grad_var_avg / grad_sqr_avg``.
+    With a noise scale :math:`\\phi`, a scale :math:`S` makes as much progress as :math:`gain(S) = (\\phi + 1)
+    / (\\phi / S + 1)` steps of scale 1: the larger batch is only worth it while the efficiency
+    :math:`gain(S) / S` stays high. Every ``interval`` steps, the scheduler doubles the number of
+    gradients to accumulate if the predicted efficiency of the larger batch is above ``min_efficiency``,
+    or halves it if the efficiency of the current batch is below, within the given budget.
+    The batch size of scale 1 is unchanged, the AdaScale scale follows the number of gradients.
+
+    The statistics are the same on all the ranks, so are the decisions. Each change is logged, and
+    recorded in :attr:`changes`.
+
+    Example:
+
+    .. code-block:: python
+
+        optim = AdaScale(SGD(model.parameters(), lr=0.1))
+        scheduler = AdaScaleAccumulationScheduler(optim, max_num_gradients_to_accumulate=16)
+
+        while step < max_steps:
+            for i in range(scheduler.num_gradients_to_accumulate):
+                with model.no_sync() if i < scheduler.num_gradients_to_accumulate - 1 else contextlib.suppress():
+                    loss = criterion(model(next(batches)), ...)
+                    loss.backward()
+            step += optim.gain()
+            optim.step()
+            optim.zero_grad()
+            scheduler.step()
+
+    Args:
+        optimizer (AdaScale):
+            AdaScale optimizer whose gradient accumulation is adapted.
+        min_efficiency (float):
+            Minimum predicted gain per unit of scale, in (0, 1]. Lower values allow larger batches
+            with diminishing returns (default: 0.8)
+        min_num_gradients_to_accumulate (int):
+            Lower bound on the number of gradients to accumulate.
+            If None, defaults to 1, or 2 with a single worker which needs at least two gradients (default: None)
+        max_num_gradients_to_accumulate (int):
+            Upper bound on the number of gradients to accumulate, which is the throughput budget:
+            the time per optimizer step grows linearly with it (default: 32)
+        interval (int):
+            Number of optimizer steps in between two decisions (default: 100)
+        warmup (int):
+            Number of optimizer steps before the first decision, while the estimates settle (default: 100)
+    """
+
+    def __init__(
+        self,
+        optimizer: AdaScale,
+        min_efficiency: float = 0.8,
+        min_num_gradients_to_accumulate: Optional[int] = None,
+        max_num_gradients_to_accumulate: int = 32,
+        interval: int = 100,
+        warmup: int = 100,
+    ):
+        if min_num_gradients_to_accumulate is None:
+            min_num_gradients_to_accumulate = 1 if optimizer._world_size > 1 else 2
+        assert 0.0 < min_efficiency <= 1.0, f"Invalid efficiency {min_efficiency}"
+        assert (
+            optimizer._world_size * min_num_gradients_to_accumulate > 1
+        ), "AdaScale does not support a single worker without grad accumulation."
+        assert (
+            1 <= min_num_gradients_to_accumulate <= max_num_gradients_to_accumulate
+        ), f"Invalid bounds {min_num_gradients_to_accumulate}, {max_num_gradients_to_accumulate}"
+        assert interval >= 1, f"Invalid interval {interval}"
+
+        self.optimizer = optimizer
+        self.min_efficiency = min_efficiency
+        self.min_num_gradients_to_accumulate = min_num_gradients_to_accumulate
+        self.max_num_gradients_to_accumulate = max_num_gradients_to_accumulate
+        self.interval = interval
+        self.warmup = warmup
+
+        #: The changes of the number of gradients to accumulate, in order
+        self.changes: List[AccumulationChange] = []
+        self._num_steps = 0
+        self._last_decision_step = 0
+
+    @property
+    def num_gradients_to_accumulate(self) -> int:
+        """ The number of gradients that the training loop should accumulate before the next optimizer step """
+        return self.optimizer._num_grads_to_accum
+
+    def noise_scale(self) -> float:
+        """
+        Current estimate of the gradient noise scale, relative to the batch size of scale 1.
+
+        Returns:
+            (float):
+                Ratio of the trace of the covariance to the squared norm of the true gradient.
+        """
+        sqr = self.optimizer._grad_sqr_avg()
+        return self.optimizer._grad_var_avg() / max(sqr, 1e-12)
+
+    def step(self) -> None:
+        """
+        To be called after each optimizer step. Periodically updates the number of gradients to
+        accumulate, and the AdaScale scale accordingly.
+        """
+        self._num_steps += 1
+        if self._num_steps < self.warmup or self._num_steps - self._last_decision_step < self.interval:
+            return
+        self._last_decision_step = self._num_steps
+
+        current = self.num_gradients_to_accumulate
+        scale_per_gradient = self.optimizer.scale / current
+        phi = self.noise_scale()
+
+        def efficiency(num_gradients: int) -> float:
+            return (phi + 1.0) / (phi + scale_per_gradient * num_gradients)
+
+        # Double while the larger batch is still efficient, halve once the current one is not.
+        # There is a gap in between the two conditions, which avoids oscillating on noisy estimates.
+        larger = min(current * 2, self.max_num_gradients_to_accumulate)
+        smaller = max(current // 2, self.min_num_gradients_to_accumulate)
+        if larger > current and efficiency(larger) >= self.min_efficiency:
+            target = larger
+            reason = f"predicted efficiency {efficiency(larger):.2f} with {larger} gradients"
+        elif smaller < current and efficiency(current) < self.min_efficiency:
+            target = smaller
+            reason = f"predicted efficiency {efficiency(current):.2f} with {current} gradients"
+        else:
+            return
+        reason = f"gradient noise scale {phi:.2f}, {reason} (target {self.min_efficiency:.2f})"
+
+        self.changes.append(
+            AccumulationChange(
+                step=self._num_steps,
+                old_num_gradients_to_accumulate=current,
+                new_num_gradients_to_accumulate=target,
+                gain=self.optimizer.gain(),
+                noise_scale=phi,
+                reason=reason,
+            )
+        )
+        logging.info(
+            "AdaScale: step %d, accumulating %d gradients instead of %d, %s"
+            % (self._num_steps, target, current, reason)
+        )
+
+        # The micro batches do not change, and neither does the batch size of scale 1:
+        # the variance estimate is still valid and should not be rescaled.
+        self.optimizer.set_scale(scale_per_gradient * target, update_estimate=False)
+        # A smoothing value set by the user is kept
+        self.optimizer.set_num_gradients_to_accumulate(target, update_smoothing=not self.optimizer._user_smoothing)
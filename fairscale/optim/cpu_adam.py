@@ -0,0 +1,218 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import math
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import torch
+from torch.optim import Optimizer
+
+if TYPE_CHECKING:  # pragma: no cover
+    from torch.optim.optimizer import _params_t
+else:
+    _params_t = Any
+
+__all__ = ["CPUAdam"]
+
+
+class _HyperParams(NamedTuple):
+    beta1: float
+    beta2: float
+    step_size: float
+    bias_correction2_sqrt: float
+    eps: float
+    weight_decay: float
+
+
+class CPUAdam(Optimizer):
+    """
+    Adam for host resident params, typically the optimizer shard of an offloaded model.
+
+    The updates are the same as `torch.optim.Adam`, but the params, grads and moments are cut in chunks
+    which are updated in parallel by a pool of threads, with vectorized in-place ops. PyTorch releases
+    the GIL while computing, so the threads actually run concurrently.
+
+    Optionally, a copy of the updated params in a lower precision is written in pinned buffers, ready
+    for the next host to device copy, see :attr:`low_precision_params`.
+
+    Arguments:
+        params (iterable): iterable of parameters to optimize or dicts defining parameter groups
+        lr (float, optional): learning rate (default: 1e-3)
+        betas (Tuple[float, float], optional): coefficients used for computing
+            running averages of gradient and its square (default: (0.9, 0.999))
+        eps (float, optional): term added to the denominator to improve numerical stability (default: 1e-8)
+        weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
+        num_threads (int, optional): number of threads updating the chunks. Defaults to `torch.get_num_threads()`
+        chunk_size (int, optional): number of elements per chunk. Chunks should be small enough
+            for a single op not to use intra-op parallelism on top of the thread pool (default: 32768)
+        low_precision_dtype (torch.dtype, optional): if set, a copy of the updated params is written
+            in this type (typically torch.float16 or torch.bfloat16) after each step (default: None)
+    """
+
+    def __init__(
+        self,
+        params: _params_t,
+        lr: float = 1e-3,
+        betas: Tuple[float, float] = (0.9, 0.999),
+        eps: float = 1e-8,
+        weight_decay: float = 0.0,
+        num_threads: Optional[int] = None,
+        chunk_size: int = 32768,
+        low_precision_dtype: Optional[torch.dtype] = None,
+    ):
+        if lr < 0.0:
+            raise ValueError(f"Invalid learning rate: {lr}")
+        if eps < 0.0:
+            raise ValueError(f"Invalid epsilon value: {eps}")
+        if not 0.0 <= betas[0] < 1.0 or not 0.0 <= betas[1] < 1.0:
+            raise ValueError(f"Invalid beta parameters: {betas}")
+        if weight_decay < 0.0:
+            raise ValueError(f"Invalid weight_decay value: {weight_decay}")
+        assert chunk_size > 0, "The chunk size needs to be positive"
+
+        defaults = {"lr": lr, "betas": betas, "eps": eps, "weight_decay": weight_decay}
+        super().__init__(params, defaults)
+
+        self.num_threads = num_threads if num_threads is not None else torch.get_num_threads()
+        self.chunk_size = chunk_size
+        self.low_precision_dtype = low_precision_dtype
+
+        #: Low precision copies of the params, views of one pinned buffer per param group.
+        #: Only filled in if `low_precision_dtype` is set, updated at every step
+        self.low_precision_params: Dict[torch.Tensor, torch.Tensor] = {}
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @torch.no_grad()
+    def step(self, closure: Optional[Callable[[], float]] = None) -> Optional[float]:
+        """Performs a single optimization step.
+
+        Arguments:
+            closure (callable, optional): A closure that reevaluates the model and returns the loss.
+        """
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        tasks: List[Callable[[], None]] = []
+        # Non contiguous params (transposed weights for instance) are updated in a contiguous copy, written back
+        write_backs: List[Tuple[torch.Tensor, torch.Tensor]] = []
+
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+
+            if self.low_precision_dtype is not None:
+                self._setup_low_precision_params(group)
+
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                if p.grad.is_sparse:
+                    raise RuntimeError("CPUAdam does not support sparse gradients")
+                assert p.device.type == "cpu", "CPUAdam only handles host params"
+
+                state = self.state[p]
+                if len(state) == 0:
+                    state["step"] = 0
+                    state["exp_avg"] = torch.zeros_like(p, memory_format=torch.contiguous_format)
+                    state["exp_avg_sq"] = torch.zeros_like(p, memory_format=torch.contiguous_format)
+
+                state["step"] += 1
+                bias_correction1 = 1 - beta1 ** state["step"]
+                bias_correction2 = 1 - beta2 ** state["step"]
+                hyper_params = _HyperParams(
+                    beta1=beta1,
+                    beta2=beta2,
+                    step_size=group["lr"] / bias_correction1,
+                    bias_correction2_sqrt=math.sqrt(bias_correction2),
+                    eps=group["eps"],
+                    weight_decay=group["weight_decay"],
+                )
+
+                flat_param, flat_grad = p.reshape(-1), p.grad.reshape(-1)
+                if not p.is_contiguous():
+                    write_backs.append((p, flat_param))
+                exp_avg, exp_avg_sq = state["exp_avg"].view(-1), state["exp_avg_sq"].view(-1)
+                low_precision = self.low_precision_params.get(p, None)
+                flat_low_precision = low_precision.view(-1) if low_precision is not None else None
+
+                for start in range(0, p.numel(), self.chunk_size):
+                    end = start + self.chunk_size
+                    tasks.append(
+                        functools.partial(
+                            _adam_chunk,
+                            flat_param[start:end],
+                            flat_grad[start:end],
+                            exp_avg[start:end],
+                            exp_avg_sq[start:end],
+                            flat_low_precision[start:end] if flat_low_precision is not None else None,
+                            hyper_params,
+                        )
+                    )
+
+        if self.num_threads <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                task()
+        else:
+            # Consume the results, so that the exceptions are raised here
+            list(self._get_executor().map(lambda task: task(), tasks))
+
+        for p, flat_param in write_backs:
+            p.copy_(flat_param.view_as(p))
+
+        return loss
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if getattr(self, "_executor", None) is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix="cpu_adam")
+        assert self._executor is not None
+        return self._executor
+
+    def _setup_low_precision_params(self, group: Dict[str, Any]) -> None:
+        """Lazily allocate the low precision copies of the params of a group, as views of a single pinned buffer"""
+        params = [p for p in group["params"] if p not in self.low_precision_params]
+        if len(params) == 0:
+            return
+
+        assert self.low_precision_dtype is not None
+        buffer = torch.empty(
+            sum(p.numel() for p in params),
+            dtype=self.low_precision_dtype,
+            pin_memory=torch.cuda.is_available(),  # type: ignore
+        )
+        offset = 0
+        for p in params:
+            low_precision = buffer[offset : offset + p.numel()].view_as(p)
+            low_precision.copy_(p)
+            self.low_precision_params[p] = low_precision
+            offset += p.numel()
+
+
+@torch.no_grad()  # grad mode is thread local, this runs in the thread pool
+def _adam_chunk(
+    param: torch.Tensor,
+    grad: torch.Tensor,
+    exp_avg: torch.Tensor,
+    exp_avg_sq: torch.Tensor,
+    low_precision: Optional[torch.Tensor],
+    hyper_params: _HyperParams,
+) -> None:
+    """ Adam update of a chunk, in place """
+    beta1, beta2, step_size, bias_correction2_sqrt, eps, weight_decay = hyper_params
+    if grad.dtype != param.dtype:
+        grad = grad.to(param.dtype)
+    if weight_decay != 0:
+        grad = grad.add(param, alpha=weight_decay)
+
+    exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+    exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+    denom = exp_avg_sq.sqrt().div_(bias_correction2_sqrt).add_(eps)
+    param.addcdiv_(exp_avg, denom, value=-step_size)
+
+    if low_precision is not None:
+        low_precision.copy_(param)
@@ -4,7 +4,8 @@
 # LICENSE file in the root directory of this source tree.
 
 import logging
-from typing import Any, Dict
+from math import inf
+from typing import Any, Dict, List
 
 import torch
 from torch.cuda.amp import GradScaler as TorchGradScaler
@@ -12,6 +13,7 @@ import torch.distributed as dist
 from torch.optim import Optimizer
 
 from .oss import OSS
+from .utils import _multi_tensor_norm
 
 
 class GradScaler(TorchGradScaler):
@@ -24,36 +26,134 @@ class GradScaler(TorchGradScaler):
 class ShardedGradScaler(TorchGradScaler):
     """
     A shard-aware :class:`GradScaler<torch.cuda.amp.GradScaler>`, to be used in conjunction with
-    :class:`OSS` and :class:`ShardedOptimizer`.
+    :class:`OSS` (possibly along with :class:`ShardedDataParallel`) or with :class:`FullyShardedDataParallel`.
+
+    Only the gradients which are local to this rank are unscaled and checked for infs and NaNs: the ones of the
+    params owned by this rank with :class:`OSS`, and the gradient shards with :class:`FullyShardedDataParallel`.
+    This is done with a multi-tensor kernel per device and type, and the ranks agree on the result with a single
+    all_reduce.
 
     Interface and usecases are not changed, more explanations can be found in the corresponding pytorch
     documentation https://pytorch.org/docs/stable/amp.html#torch.cuda.amp.GradScaler
+
+    Args:
+        process_group (optional): the process group in between which the inf checks are agreed on
+        init_scale, growth_factor, backoff_factor, growth_interval, enabled: see
+            :class:`GradScaler<torch.cuda.amp.GradScaler>`
     """
 
-    def __init__(self, process_group: Any = dist.group.WORLD) -> None:
-        super().__init__()
+    def __init__(
+        self,
+        process_group: Any = dist.group.WORLD,
+        init_scale: float = 2.0 ** 16,
+        growth_factor: float = 2.0,
+        backoff_factor: float = 0.5,
+        growth_interval: int = 2000,
+        enabled: bool = True,
+    ) -> None:
+        super().__init__(
+            init_scale=init_scale,
+            growth_factor=growth_factor,
+            backoff_factor=backoff_factor,
+            growth_interval=growth_interval,
+            enabled=enabled,
+        )
         self.display_warning = True
         self.group = process_group
 
     def unscale_(self, optimizer: Optimizer) -> None:
-        # Could be a mistake, this scaler is supposed to work with ZeroRedundancyOptimizer only
-        if self.display_warning and not isinstance(optimizer, OSS):
+        # Could be a mistake, this scaler is supposed to work with sharded gradients only
+        if self.display_warning and not isinstance(optimizer, OSS) and not _has_sharded_params(optimizer):
             logging.warning(
-                "ShardedGradScaler is to be used in combination with a sharded optimizer, this could not be checked"
+                "ShardedGradScaler is to be used in combination with a sharded optimizer or sharded params, "
+                "this could not be checked"
             )
 
         self.display_warning = False  # Only warn once
 
-        # Call the upstream unscale_ method which will only act on this rank's gradients
+        # Call the upstream unscale_ method which will only act on this rank's gradients, see `_unscale_grads_`
         super().unscale_(optimizer)
 
         # Synchronize the detected inf across the ranks
         optimizer_state = self._per_optimizer_states[id(optimizer)]
-        last_handle = None
-        for v in optimizer_state["found_inf_per_device"].values():
-            last_handle = dist.all_reduce(v, async_op=True, group=self.group)
-
-        # Make sure that the calls are done before moving out.
-        # The calls are executed in sequence, waiting for the last one is enough
-        if last_handle is not None:
-            last_handle.wait()
+        self._sync_found_inf(optimizer_state["found_inf_per_device"])
+
+    def _unscale_grads_(
+        self, optimizer: Optimizer, inv_scale: torch.Tensor, found_inf: torch.Tensor, allow_fp16: bool
+    ) -> Dict[torch.device, torch.Tensor]:
+        # Split the local grads by device and type, for the multi-tensor kernels
+        per_device_and_dtype_grads: Dict[torch.device, Dict[torch.dtype, List[torch.Tensor]]] = {}
+        with torch.no_grad():
+            for param in _local_params(optimizer):
+                if param.grad is None:
+                    continue
+                if (not allow_fp16) and param.grad.dtype == torch.float16:
+                    raise ValueError("Attempting to unscale FP16 gradients.")
+                if param.grad.is_sparse:
+                    # Check the coalesced values, duplicate indices could overflow once summed
+                    if param.grad.dtype is torch.float16:
+                        param.grad = param.grad.coalesce()
+                    to_unscale = param.grad._values()
+                else:
+                    to_unscale = param.grad
+                per_device_and_dtype_grads.setdefault(to_unscale.device, {}).setdefault(to_unscale.dtype, []).append(
+                    to_unscale
+                )
+
+            per_device_found_inf: Dict[torch.device, torch.Tensor] = {}
+            for device, per_dtype_grads in per_device_and_dtype_grads.items():
+                device_found_inf = found_inf.to(device, copy=True)
+                device_inv_scale = inv_scale.to(device)
+                for grads in per_dtype_grads.values():
+                    _unscale_and_check_(grads, device_found_inf, device_inv_scale)
+                per_device_found_inf[device] = device_found_inf
+
+        if len(per_device_found_inf) == 0:
+            # This rank has no local gradient, it still needs to take part in the all_reduce
+            per_device_found_inf[found_inf.device] = found_inf
+
+        return per_device_found_inf
+
+    def _sync_found_inf(self, found_inf_per_device: Dict[torch.device, torch.Tensor]) -> None:
+        """ Sum the detected infs over all the ranks, with a single all_reduce """
+        found_infs = list(found_inf_per_device.values())
+        if len(found_infs) == 1:
+            dist.all_reduce(found_infs[0], group=self.group)
+            return
+
+        # Several devices on this rank, reduce them all at once and broadcast the result back
+        device = found_infs[0].device
+        total = torch.stack([f.to(device) for f in found_infs]).sum(dim=0)
+        dist.all_reduce(total, group=self.group)
+        for f in found_infs:
+            f.copy_(total)
+
+
+def _has_sharded_params(optimizer: Optimizer) -> bool:
+    """ Whether some params are sharded by :class:`FullyShardedDataParallel` """
+    return any(getattr(p, "_is_sharded", False) for group in optimizer.param_groups for p in group["params"])
+
+
+def _local_params(optimizer: Optimizer) -> List[torch.Tensor]:
+    """ The params whose gradients are used by this rank: all of them, except with OSS which only uses the owned ones """
+    if isinstance(optimizer, OSS):
+        param_to_rank = optimizer.param_to_rank
+        return [p for p in param_to_rank.keys() if param_to_rank[p] == optimizer.rank]
+    return [p for group in optimizer.param_groups for p in group["params"]]
+
+
+def _unscale_and_check_(grads: List[torch.Tensor], found_inf: torch.Tensor, inv_scale: torch.Tensor) -> None:
+    """ Unscale in place a list of gradients with the same device and type, flag infs and NaNs in found_inf """
+    if grads[0].is_cuda and hasattr(torch, "_amp_foreach_non_finite_check_and_unscale_"):
+        torch._amp_foreach_non_finite_check_and_unscale_(grads, found_inf, inv_scale)
+        return
+
+    # Multi-tensor fallback. The max norms are only infinite or NaN when the gradients hold such values
+    max_norms = _multi_tensor_norm(grads, inf)
+    found_inf.masked_fill_(~torch.isfinite(max_norms).all(), 1.0)
+    if not grads[0].is_cuda and hasattr(torch, "_foreach_mul_"):
+        # Reading the scale is not a device sync on the host
+        torch._foreach_mul_(grads, inv_scale.item())
+    else:
+        for grad in grads:
+            grad.mul_(inv_scale)
@@ -3,8 +3,9 @@
 # This source code is licensed under the BSD license found in the
 # LICENSE file in the root directory of this source tree.
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 import copy
+import inspect
 from itertools import chain
 import logging
 from math import inf
@@ -15,7 +16,16 @@ import torch.distributed as dist
 from torch.nn import Parameter
 from torch.optim import SGD, Optimizer
 
-from .utils import broadcast_object, calc_grad_norm, recursive_copy_to_device
+from .adafactor import Adafactor
+from .adafactor import _state_size as _adafactor_state_size
+from .adam import Adam, Precision
+from .utils import (
+    broadcast_object,
+    calc_grad_norm_partial,
+    is_indexed_state_dict,
+    load_indexed_state_dict,
+    recursive_copy_to_device,
+)
 
 __all__ = ["OSS"]
 
@@ -24,6 +34,123 @@ if TYPE_CHECKING:  # pragma: no cover
 else:
     _params_t = Any
 
+# Multiplying a list of tensors by a device scalar is a single kernel with torch >= 2.1. The tensor list variant of
+# the previous versions is only batched for matching shapes, it falls back to one kernel per tensor otherwise
+_HAS_FOREACH_MUL_TENSOR = hasattr(torch, "_foreach_mul_") and hasattr(torch.ops.aten._foreach_mul_, "Tensor")  # type: ignore
+
+
+def _state_size_factor(optim: Type[Optimizer], param_group: Dict[str, Any]) -> float:
+    """Size of the optimizer state for a given param group, relative to the size of the params.
+    Used to balance the memory across ranks when the param groups are handled by different optimizers.
+    """
+    if issubclass(optim, SGD):
+        return 1.0 if param_group.get("momentum", 0) != 0 else 0.0
+    if issubclass(optim, (torch.optim.Adam, torch.optim.AdamW)):
+        return 3.0 if param_group.get("amsgrad", False) else 2.0
+    if issubclass(optim, Adam):
+        # The int8 moments are a quarter of the size of FP32 ones
+        return 0.5 if param_group.get("precision", None) is Precision.INT8_STATE else 2.0
+    if issubclass(optim, Adafactor):
+        # The second moments of the matrices are factored, the ratio depends on the actual shapes
+        params = param_group["params"]
+        numel = sum(p.numel() for p in params)
+        return sum(_adafactor_state_size(p, param_group.get("beta1", None)) for p in params) / max(numel, 1)
+    if issubclass(optim, (torch.optim.Adamax, torch.optim.Adadelta, torch.optim.Rprop)):
+        return 2.0
+    if issubclass(optim, torch.optim.RMSprop):
+        return 1.0 + float(param_group.get("momentum", 0) != 0) + float(param_group.get("centered", False))
+    if issubclass(optim, (torch.optim.Adagrad, torch.optim.ASGD)):
+        return 1.0
+
+    # Unknown optimizer, assume one state entry per param
+    return 1.0
+
+
+def _filter_defaults(optim: Type[Optimizer], defaults: Dict[str, Any]) -> Dict[str, Any]:
+    """Only keep the default arguments that a given optimizer constructor accepts"""
+    parameters = inspect.signature(optim.__init__).parameters
+    if any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters.values()):
+        return defaults
+    return {k: v for k, v in defaults.items() if k in parameters.keys()}
+
+
+class _MultiOptimizer(Optimizer):
+    """Drives one optimizer per optimizer class, each one handling a subset of the param groups.
+    The state and param groups are exposed as if there was a single optimizer, in the param groups order.
+    """
+
+    def __init__(self, param_groups: List[dict], optims: Dict[int, Type[Optimizer]], defaults: Dict[str, Any]) -> None:
+        # NOTE: The base constructor is skipped on purpose, the param groups are handled by the wrapped optimizers
+        self.defaults: Dict[str, Any] = {}
+        self.state: Dict[torch.Tensor, Any] = defaultdict(dict)
+        self.param_groups: List[dict] = []
+        self._optim_classes = optims
+        self._optim_defaults = defaults
+        self.optims: Dict[Type[Optimizer], Optimizer] = OrderedDict()
+
+        for param_group in param_groups:
+            self.add_param_group(param_group)
+
+    def add_param_group(self, param_group: dict) -> None:
+        optim_class = self._optim_classes[len(self.param_groups)]
+
+        if optim_class not in self.optims.keys():
+            optim = optim_class([param_group], **_filter_defaults(optim_class, self._optim_defaults))
+            # All the optimizers share the same state, the params they handle are disjoint.
+            # Some optimizers (Adagrad for instance) initialize their state in their constructor, it is kept
+            self.state.update(optim.state)
+            optim.state = self.state
+            self.optims[optim_class] = optim
+        else:
+            self.optims[optim_class].add_param_group(param_group)
+
+        # The wrapped optimizer works on this very dict, so that the attributes are kept in sync
+        self.param_groups.append(self.optims[optim_class].param_groups[-1])
+
+    def step(self, closure: Optional[Callable[[], float]] = None, **kwargs: Any) -> Optional[float]:
+        # The closure should be evaluated only once for all the wrapped optimizers
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for optim in self.optims.values():
+            optim.step(**kwargs)
+
+        return loss
+
+    def zero_grad(self, *args: Any, **kwargs: Any) -> None:
+        for optim in self.optims.values():
+            optim.zero_grad(*args, **kwargs)
+
+    def state_dict(self) -> Dict[str, Any]:
+        # Same layout as torch.optim.Optimizer: the params are indexed linearly, following the param groups order
+        param_to_index: Dict[int, int] = {}
+        param_groups = []
+        for param_group in self.param_groups:
+            packed = {k: v for k, v in param_group.items() if k != "params"}
+            packed["params"] = []
+            for param in param_group["params"]:
+                param_to_index.setdefault(id(param), len(param_to_index))
+                packed["params"].append(param_to_index[id(param)])
+            param_groups.append(packed)
+
+        state = {(param_to_index[id(k)] if isinstance(k, torch.Tensor) else k): v for k, v in self.state.items()}
+        return {"state": state, "param_groups": param_groups}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        params = chain(*[g["params"] for g in self.param_groups])
+        saved_indices = chain(*[g["params"] for g in state_dict["param_groups"]])
+        index_to_param = {index: param for index, param in zip(saved_indices, params)}
+
+        for param_group, saved_group in zip(self.param_groups, state_dict["param_groups"]):
+            param_group.update({k: v for k, v in saved_group.items() if k != "params"})
+
+        self.state.clear()
+        for key, value in state_dict["state"].items():
+            param = index_to_param[key]
+            self.state[param] = recursive_copy_to_device(value, non_blocking=False, device=param.device)
+
 
 class OSS(Optimizer):
     """Wraps an arbitrary :class:`optim.Optimizer <torch.optim.Optimizer>`
@@ -46,12 +173,20 @@ class OSS(Optimizer):
         params (list of tensors):
             parameters to be optimized
     Keyword Args:
-        optim (torch.nn.Optimizer):
-            optimizer to shard (default: SGD)
+        optim (torch.nn.Optimizer or dict):
+            optimizer to shard (default: SGD). A mapping from param group index to optimizer class can also be
+            passed, in which case each param group is handled by its own optimizer, and the partitioning takes
+            the respective optimizer state sizes into account. Default arguments which a given optimizer does not
+            accept are not passed to it.
         group (group):
             torch.distributed group (default: group.WORLD)
         broadcast_buffer_size (int):
             (deprecated) used to cap the size of the broadcast buffers, not being used anymore.
+        cpu_offload (bool):
+            keep this rank's shard of the optimizer state in host memory, alongside a full precision (FP32)
+            master copy of the shard which the wrapped optimizer works on. Gradients are copied to pinned host
+            buffers before the step, and the updated shard is copied back asynchronously before the parameters
+            are broadcast to the other ranks. (default: False)
 
 
     .. warning: the communication patterns that OSS use depend on the "trainability" graph,
@@ -70,9 +205,10 @@ class OSS(Optimizer):
     def __init__(
         self,
         params: _params_t,
-        optim: Type[Optimizer] = SGD,
+        optim: Union[Type[Optimizer], Dict[int, Type[Optimizer]]] = SGD,
         group: Optional[Any] = None,
         broadcast_buffer_size: int = -1,
+        cpu_offload: bool = False,
         **default: Any,
     ):
 
@@ -102,6 +238,12 @@ class OSS(Optimizer):
         self._all_states: List[Dict[str, Any]] = []  # Optional consolidated optimizer state
         self._default_device = torch.device("cpu")
 
+        # Optional host side copy of this rank's shard, the wrapped optimizer works on these
+        self.cpu_offload = cpu_offload
+        self._host_params: Dict[torch.Tensor, Parameter] = {}
+        self._host_buckets: Dict[torch.device, torch.Tensor] = {}
+        self._host_grad_buckets: Dict[torch.device, torch.Tensor] = {}
+
         # Setup everything which is related to the parameters to be trained
         # (partition and optimizer for the shard)
         self.refresh_trainable()
@@ -117,9 +259,15 @@ class OSS(Optimizer):
         """
         if len(self._partition_parameters) == 0:
             self._partition_parameters = [list() for _ in range(self.world_size)]
-            sizes = [0] * self.world_size
-            for param_group in self.param_groups:
+            sizes = [0.0] * self.world_size
+            for i_group, param_group in enumerate(self.param_groups):
                 param_lists: List[List] = [list() for _ in range(self.world_size)]
+
+                # If the param groups are handled by different optimizers, weight the params by their state size
+                state_factor = 1.0
+                if isinstance(self._optim_constructor, dict):
+                    state_factor = _state_size_factor(self._get_optim_class(i_group), param_group)
+
                 for param in param_group["params"]:
                     # Add this param to rank with smallest size.
                     rank = sizes.index(min(sizes))
@@ -127,10 +275,10 @@ class OSS(Optimizer):
 
                     # We're partitioning the optimizer state,
                     # so trainable parameters are the ones which really count
-                    if param.requires_grad:
-                        sizes[rank] += param.numel()
+                    if param.requires_grad and state_factor > 0:
+                        sizes[rank] += param.numel() * state_factor
                     else:
-                        # Spread frozen params on a per-tensor basis
+                        # Spread frozen (or stateless) params on a per-tensor basis
                         # Mostly useful for balance partitions for fine tuning for instance
                         # Not required strictly speaking
                         sizes[rank] += 1
@@ -235,8 +383,19 @@ class OSS(Optimizer):
         # Sync oss param_groups attributes in case they've been updated by a scheduler.
         OSS._sync_param_groups(self.param_groups, self.optim.param_groups)
 
+        if self.cpu_offload:
+            # The gradients need to be computed before they can be moved to the host shard
+            loss = None
+            if closure is not None:
+                with torch.enable_grad():
+                    loss = closure()
+
+            self._copy_grads_to_host()
+            self.optim.step(**kwargs)
+            self._copy_params_from_host()
+
         # Run the optimizer step on this shard only:
-        if closure is not None:
+        elif closure is not None:
             loss = self.optim.step(closure=closure, **kwargs)  # type: ignore
         else:
             loss = self.optim.step(**kwargs)
@@ -284,27 +443,30 @@ class OSS(Optimizer):
         # https://github.com/NVIDIA/Megatron-LM/blob/19301985dd31c8b612095cbad15bd903e8ddd497/megatron/mpu/layers.py#L54
         local_params = filter_params_fn(self.local_params) if filter_params_fn is not None else self.local_params
 
-        local_norm = calc_grad_norm(local_params, norm_type).to(self._default_device)
-        # Compute the norm on this grad set,
-        # then sync all the norms from all ranks
+        # Compute the reducible part of the norm on this grad set, for all devices at once,
+        # then sync all the partials from all ranks with a single collective
+        # local norm result can be accumulated with the remote ones if put to the right power
+        # n_i = sum_rank(a^p)^1/p
+        # -> n_total = all_reduce(n_i^p)^(1/p) = sum_i(n_i^p)^1/p = sum_i(sum_rank(a^p))^1/p
+        # all reduce over data parallel and model parallel workers
+        total_norm = calc_grad_norm_partial(local_params, norm_type, device=self._default_device)
         if norm_type == inf:
-            total_norm = local_norm
-            # all reduce over data parallel and model parallel workers
             dist.all_reduce(total_norm, op=torch.distributed.ReduceOp.MAX, group=dist.group.WORLD)
         else:
-            # local norm result can be accumulated with the remote ones if put to the right power
-            # n_i = sum_rank(a^p)^1/p
-            # -> n_total = all_reduce(n_i^p)^(1/p) = sum_i(n_i^p)^1/p = sum_i(sum_rank(a^p))^1/p
-            # all reduce over data parallel and model parallel workers
-            total_norm = local_norm ** norm_type
-            dist.all_reduce(total_norm)
+            dist.all_reduce(total_norm, group=dist.group.WORLD)
             total_norm = total_norm ** (1.0 / norm_type)
 
-        clip_coef = torch.tensor(max_norm, dtype=total_norm.dtype, device=total_norm.device) / (total_norm + 1e-6)
-        if clip_coef < 1:
-            for device, device_params in self.per_device_params.items():
-                for p in filter(lambda x: x.grad is not None, device_params[self.rank]):
-                    p.grad.detach().mul_(clip_coef.to(device))  # type: ignore
+        # Scale on device, the gradients are left untouched (factor of 1) if the norm is within bounds.
+        # Checking the coefficient on the host would require a sync with the device
+        clip_coef = torch.clamp((total_norm + 1e-6).reciprocal() * max_norm, max=1.0)
+        for device, device_params in self.per_device_params.items():
+            clip_coef_device = clip_coef.to(device)
+            grads = [p.grad.detach() for p in device_params[self.rank] if p.grad is not None]
+            if len(grads) > 0 and _HAS_FOREACH_MUL_TENSOR:
+                torch._foreach_mul_(grads, clip_coef_device)  # type: ignore
+            else:
+                for grad in grads:
+                    grad.mul_(clip_coef_device)
 
         return total_norm
 
@@ -405,6 +567,8 @@ class OSS(Optimizer):
             if self.param_to_rank[param] != self.rank:
                 state_dict["state"][key] = None
             else:
+                if self.cpu_offload:
+                    param = self._host_params[param]
                 self.optim.state[param] = recursive_copy_to_device(value, non_blocking=True, device=param.device)
 
         super().load_state_dict(state_dict)
@@ -413,6 +577,28 @@ class OSS(Optimizer):
         OSS._sync_param_groups(state_dict["param_groups"], self.param_groups)
         OSS._sync_param_groups(self.param_groups, self.optim.param_groups)
 
+    def load_state_dict_from_file(self, path: str) -> None:
+        """Restore the global parameter groups as well as the shard, straight from a file.
+
+        If the file was saved with :func:`fairscale.optim.utils.save_indexed_state_dict`, it is memory-mapped and only
+        the state entries owned by this rank are deserialized. Files saved with `torch.save` are also accepted, but
+        they need to be loaded in full.
+
+        Arguments:
+            path (str): file holding an optimizer state, as returned by :meth:`state_dict`
+        """
+
+        if is_indexed_state_dict(path):
+            # Same positional indexing as `load_state_dict`, see the PyTorch 1.5 note there
+            def is_owned(position: int, _: Any) -> bool:
+                return self.param_to_rank[self.index_to_param[position]] == self.rank
+
+            state_dict = load_indexed_state_dict(path, filter_fn=is_owned)
+        else:
+            state_dict = torch.load(path, map_location=torch.device("cpu"))
+
+        self.load_state_dict(state_dict)
+
     def refresh_trainable(self) -> None:
         """ Updates the partitioning and communication patterns if the trainability (`requires_grad`)
         of some parameters changed.
@@ -422,11 +608,30 @@ class OSS(Optimizer):
         if not hasattr(self, "optim"):
             self._clear_cache()
             self._default_device = list(self.per_device_params.keys())[0]
-            self.optim = self._optim_constructor(self.partition_parameters()[self.rank], **self._optim_defaults)
+            self.optim = self._build_optim(self._local_param_groups(self.partition_parameters()[self.rank]))
             OSS._sync_param_groups(self.optim.param_groups, self.param_groups)
 
         self._setup_flat_buffers()
 
+    def _get_optim_class(self, group_index: int) -> Type[Optimizer]:
+        """The optimizer class which handles a given param group"""
+        if not isinstance(self._optim_constructor, dict):
+            return self._optim_constructor
+
+        if group_index not in self._optim_constructor.keys():
+            raise ValueError(f"No optimizer was specified for param group {group_index}")
+        return self._optim_constructor[group_index]
+
+    def _build_optim(self, param_groups: List[dict]) -> Optimizer:
+        """Instantiate the optimizer(s) for this rank's shard"""
+        if not isinstance(self._optim_constructor, dict):
+            return self._optim_constructor(param_groups, **self._optim_defaults)
+
+        for i in range(len(self.param_groups)):
+            self._get_optim_class(i)  # Make sure that all the groups can be handled
+
+        return _MultiOptimizer(param_groups, self._optim_constructor, self._optim_defaults)
+
     def _broadcast_state_dict(self) -> None:
         """Broadcast this rank's state shard, discard others"""
 
@@ -506,6 +711,9 @@ class OSS(Optimizer):
         .. warning: This handles updating the shards on all partitions, but needs to be called on all ranks.
         """
 
+        if not self.in_super_constructor:
+            self._get_optim_class(len(self.param_groups))  # Make sure that this group can be handled
+
         super().add_param_group(param_group)
         if not self.in_super_constructor:
             # Force a re-partitioning
@@ -514,7 +722,7 @@ class OSS(Optimizer):
             # Update the partition
             param_groups = self.partition_parameters()[self.rank]
             if len(param_groups) == len(self.optim.param_groups) + 1:
-                self.optim.add_param_group(param_groups[-1])
+                self.optim.add_param_group(self._local_param_groups(param_groups[-1:])[0])
 
             # Update the bucketing strategy accordingly
             self._setup_flat_buffers()
@@ -548,16 +756,17 @@ class OSS(Optimizer):
     def _broadcast_params(self) -> None:
         """Helper function to broadcast all the parameters from a given device"""
 
-        last_work_handle = None  # Work handles are consumed within this scope, no callback
+        work_handles = []  # Work handles are consumed within this scope, no callback
 
         for device in self.buckets.keys():
             for src_rank, bucket in enumerate(self.buckets[device]):
                 global_src_rank = self.get_global_rank(self.group, src_rank)
-                last_work_handle = dist.broadcast(tensor=bucket, src=global_src_rank, group=self.group, async_op=True)
+                work_handles.append(dist.broadcast(tensor=bucket, src=global_src_rank, group=self.group, async_op=True))
 
-        # Only check on the last handle, they're all inlined on the same CUDA stream
-        if last_work_handle:
-            last_work_handle.wait()
+        # With NCCL the broadcasts are all inlined on the same CUDA stream, but other backends (Gloo)
+        # can process them concurrently, so all the handles need to be checked
+        for work_handle in work_handles:
+            work_handle.wait()
 
     def _setup_flat_buffers(self) -> None:
         """Make all params which are on the same device and tied to the same rank views of a single buffer.
@@ -598,3 +807,93 @@ class OSS(Optimizer):
                         self.buckets[device][dst_rank] = bucket
                 else:
                     self.buckets[device].append(torch.zeros(1, device=device))
+
+        if self.cpu_offload:
+            self._setup_host_buffers()
+
+    def _local_param_groups(self, param_groups: List[dict]) -> List[dict]:
+        """Param groups to be handed to the wrapped optimizer, pointing to the host copies if offloading"""
+        if not self.cpu_offload:
+            return param_groups
+
+        host_param_groups = []
+        for param_group in param_groups:
+            host_param_group = copy.copy(param_group)
+            host_param_group["params"] = [self._get_host_param(p) for p in param_group["params"]]
+            host_param_groups.append(host_param_group)
+
+        return host_param_groups
+
+    def _get_host_param(self, param: torch.Tensor) -> Parameter:
+        """Lazily create the FP32 host copy of a parameter owned by this rank"""
+        if param not in self._host_params.keys():
+            self._host_params[param] = Parameter(
+                param.data.detach().to(device=torch.device("cpu"), dtype=torch.float32, copy=True),
+                requires_grad=param.requires_grad,
+            )
+        return self._host_params[param]
+
+    def _setup_host_buffers(self) -> None:
+        """Make the host copies of the trainable params of this rank views of a single (pinned) buffer per device,
+        mirroring the device bucket layout so that the updated shard can be copied back in one go.
+        Gradients get the same treatment.
+        """
+
+        for device, per_rank_params in self.per_device_params.items():
+            params = per_rank_params[self.rank]
+            for param in filter(lambda x: not x.requires_grad, params):
+                host_param = self._get_host_param(param)
+                host_param.data = host_param.data.detach().clone()
+                host_param.requires_grad = False
+                host_param.grad = None
+
+            trainable_params = list(filter(lambda x: x.requires_grad, params))
+            buffer_size = sum(map(lambda x: x.numel(), trainable_params))
+            pin_memory = device.type == "cuda"
+            host_bucket = torch.empty(buffer_size, dtype=torch.float32, pin_memory=pin_memory)  # type: ignore
+            host_grad_bucket = torch.zeros(buffer_size, dtype=torch.float32, pin_memory=pin_memory)  # type: ignore
+            offset = 0
+
+            for param in trainable_params:
+                host_param = self._get_host_param(param)
+                offset_next = offset + param.numel()
+                host_bucket[offset:offset_next].copy_(host_param.data.flatten())
+                host_param.data = host_bucket[offset:offset_next].view_as(param.data)
+                host_param.requires_grad = True
+                host_param.grad = None
+                offset = offset_next
+
+            self._host_buckets[device] = host_bucket
+            self._host_grad_buckets[device] = host_grad_bucket
+
+    @torch.no_grad()
+    def _copy_grads_to_host(self) -> None:
+        """Move the gradients of this rank's shard to the host buffers, ahead of the local step"""
+
+        for device, per_rank_params in self.per_device_params.items():
+            host_grad_bucket = self._host_grad_buckets[device]
+            offset = 0
+
+            for param in filter(lambda x: x.requires_grad, per_rank_params[self.rank]):
+                host_param = self._host_params[param]
+                offset_next = offset + param.numel()
+
+                if param.grad is None:
+                    host_param.grad = None
+                else:
+                    host_grad = host_grad_bucket[offset:offset_next].view_as(param)
+                    host_grad.copy_(param.grad, non_blocking=True)
+                    host_param.grad = host_grad
+                offset = offset_next
+
+            # The host needs to wait for the D2H copies to land before stepping
+            if device.type == "cuda":
+                torch.cuda.current_stream(device).synchronize()
+
+    @torch.no_grad()
+    def _copy_params_from_host(self) -> None:
+        """Asynchronously copy the updated shard back to the device buckets, which are broadcast next"""
+
+        for device, host_bucket in self._host_buckets.items():
+            if host_bucket.numel() > 0:
+                self.buckets[device][self.rank].copy_(host_bucket, non_blocking=True)
@@ -5,8 +5,11 @@
 
 import collections
 import io
+import itertools
 from math import inf
-from typing import Any, Callable, Dict, List, Optional
+import mmap
+import struct
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import torch
 import torch.distributed as dist
@@ -105,20 +108,159 @@ class Bucket:
         return self.max_params_checked_in == self.params_checked_in
 
 
-def calc_grad_norm(parameters: List[torch.nn.Parameter], p: float) -> torch.Tensor:
-    r"""Calculate gradient norm of an iterable of parameters.
-    Returns:
-        Total norm of the parameters (viewed as a single vector).
+def _split_state_dict(
+    state_dict: Dict[str, Any], keys: List[str]
+) -> Tuple[Dict[str, Any], Dict[Any, Dict[str, torch.Tensor]]]:
+    """
+    Takes the given state entries out of an optimizer state dict. The base optimizer casts all the floating
+    point state to the type of the params when loading, which loses the FP32 state of the FP16 params:
+    these entries are restored with :func:`_restore_state` instead.
+    """
+    state: Dict[Any, Dict[str, Any]] = {}
+    kept: Dict[Any, Dict[str, torch.Tensor]] = {}
+    for index, param_state in state_dict["state"].items():
+        kept[index] = {k: v for k, v in param_state.items() if k in keys and isinstance(v, torch.Tensor)}
+        state[index] = {k: v for k, v in param_state.items() if k not in kept[index]}
+    return {**state_dict, "state": state}, kept
+
+
+def _restore_state(
+    optimizer: torch.optim.Optimizer, state_dict: Dict[str, Any], kept: Dict[Any, Dict[str, torch.Tensor]]
+) -> None:
+    """ Puts back the state entries taken out by :func:`_split_state_dict`, on the device of the params """
+    saved_ids = itertools.chain.from_iterable(g["params"] for g in state_dict["param_groups"])
+    params = itertools.chain.from_iterable(g["params"] for g in optimizer.param_groups)
+    id_map = dict(zip(saved_ids, params))
+    for index, entries in kept.items():
+        param = id_map[index]
+        for key, value in entries.items():
+            optimizer.state[param][key] = value.clone() if value.device == param.device else value.to(param.device)
+
+
+def _multi_tensor_norm(tensors: List[torch.Tensor], p: float) -> torch.Tensor:
+    """ Norms of a list of tensors living on the same device, as a single FP32 tensor """
+    if hasattr(torch, "_foreach_norm"):
+        norms = torch._foreach_norm(tensors, p)
+    else:
+        norms = [torch.norm(t, p) for t in tensors]
+    return torch.stack(norms).float()
+
+
+def calc_grad_norm_partial(
+    parameters: List[torch.nn.Parameter], p: float, device: Optional[torch.device] = None
+) -> torch.Tensor:
+    r"""Calculate the reducible part of the gradient norm of an iterable of parameters, on a single device:
+    the max absolute value for the inf-norm, or the sum of the gradients to the power p otherwise.
+
+    Partials can be summed (or max'ed for the inf-norm) in between ranks, with a single collective.
+    The norms are computed with a multi-tensor kernel per device, when available, and no host sync.
     """
     if isinstance(parameters, torch.Tensor):
         parameters = [parameters]
     parameters = list(filter(lambda par: par.grad is not None, parameters))
 
     if len(parameters) == 0:
-        return torch.tensor(0.0)
+        return torch.tensor(0.0, device=device)
     p = float(p)
-    if p == inf:
-        local_norm = max(par.grad.detach().abs().max() for par in parameters)  # type: ignore
-    else:
-        local_norm = torch.norm(torch.stack([torch.norm(par.grad.detach(), p) for par in parameters]), p)  # type: ignore
-    return local_norm
+
+    grads_per_device: Dict[torch.device, List[torch.Tensor]] = collections.OrderedDict()
+    for par in parameters:
+        grads_per_device.setdefault(par.grad.device, []).append(par.grad.detach())  # type: ignore
+
+    if device is None:
+        device = next(iter(grads_per_device.keys()))
+
+    partials = []
+    for grads in grads_per_device.values():
+        norms = _multi_tensor_norm(grads, p)
+        partials.append((norms.max() if p == inf else norms.pow(p).sum()).to(device))
+
+    return torch.stack(partials).max() if p == inf else torch.stack(partials).sum()
+
+
+def calc_grad_norm(parameters: List[torch.nn.Parameter], p: float) -> torch.Tensor:
+    r"""Calculate gradient norm of an iterable of parameters.
+    Returns:
+        Total norm of the parameters (viewed as a single vector).
+    """
+    p = float(p)
+    local_partial = calc_grad_norm_partial(parameters, p)
+    return local_partial if p == inf else local_partial ** (1.0 / p)
+
+
+# Indexed optimizer state files:
+# magic | one serialized blob per state entry | serialized header (param groups + index) | header size (8 bytes)
+_INDEXED_STATE_MAGIC = b"FSOPTIDX"
+_INDEXED_STATE_VERSION = 1
+
+
+def _serialize(obj: Any) -> bytes:
+    buffer = io.BytesIO()
+    torch.save(obj, buffer)
+    return buffer.getvalue()
+
+
+def save_indexed_state_dict(state_dict: Dict[str, Any], path: str) -> None:
+    """
+    Save an optimizer state dict so that the per-parameter states can be read back individually,
+    see :meth:`fairscale.optim.OSS.load_state_dict_from_file`.
+    Entries are serialized one at a time, so that the full state is never duplicated in memory.
+    """
+
+    index: Dict[Any, Any] = collections.OrderedDict()
+    with open(path, "wb") as f:
+        f.write(_INDEXED_STATE_MAGIC)
+        offset = len(_INDEXED_STATE_MAGIC)
+
+        for key, value in state_dict["state"].items():
+            blob = _serialize(value)
+            f.write(blob)
+            index[key] = (offset, len(blob))
+            offset += len(blob)
+
+        header = {
+            "version": _INDEXED_STATE_VERSION,
+            "index": index,
+            "param_groups": state_dict["param_groups"],
+            "extra": {k: v for k, v in state_dict.items() if k not in ["state", "param_groups"]},
+        }
+        header_blob = _serialize(header)
+        f.write(header_blob)
+        f.write(struct.pack("<Q", len(header_blob)))
+
+
+def is_indexed_state_dict(path: str) -> bool:
+    """ Check whether a file was written by :func:`save_indexed_state_dict` """
+    with open(path, "rb") as f:
+        return f.read(len(_INDEXED_STATE_MAGIC)) == _INDEXED_STATE_MAGIC
+
+
+def load_indexed_state_dict(path: str, filter_fn: Optional[Callable[[int, Any], bool]] = None) -> Dict[str, Any]:
+    """
+    Load an optimizer state dict saved with :func:`save_indexed_state_dict`, on CPU.
+
+    The file is memory-mapped, and only the entries for which `filter_fn(position, key)` is true are
+    deserialized. The other entries keep their key, but their state is replaced by None.
+    """
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if mapped[: len(_INDEXED_STATE_MAGIC)] != _INDEXED_STATE_MAGIC:
+            raise RuntimeError(f"{path} is not an indexed optimizer state file")
+
+        (header_size,) = struct.unpack("<Q", mapped[-8:])
+        header_start = len(mapped) - 8 - header_size
+        header = torch.load(
+            io.BytesIO(mapped[header_start : header_start + header_size]), map_location=torch.device("cpu")
+        )
+        assert header["version"] == _INDEXED_STATE_VERSION, f"Unsupported indexed state version {header['version']}"
+
+        state: Dict[Any, Any] = collections.OrderedDict()
+        for position, (key, (offset, length)) in enumerate(header["index"].items()):
+            if filter_fn is None or filter_fn(position, key):
+                state[key] = torch.load(io.BytesIO(mapped[offset : offset + length]), map_location=torch.device("cpu"))
+            else:
+                state[key] = None
+
+    state_dict = {"state": state, "param_groups": header["param_groups"]}
+    state_dict.update(header["extra"])
+    return state_dict
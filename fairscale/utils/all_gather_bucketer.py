@@ -0,0 +1,149 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+import functools
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import torch
+from torch import Tensor
+import torch.distributed as dist
+from torch.distributed import ProcessGroup
+
+
+class _GatherEntry(NamedTuple):
+    offset: int
+    numel: int
+    output: Tensor
+    callback_fn: Optional[Callable]
+
+
+class Bucket:
+    def __init__(self, data: Tensor, group: ProcessGroup):
+        self.data = data
+        self.group = group
+        self.offset = 0
+        self.entries: List[_GatherEntry] = []
+
+    def flush(self) -> None:
+        if self.offset == 0:
+            assert len(self.entries) == 0
+            return
+        world_size = self.group.size()
+        if len(self.entries) == 1:
+            # nothing to coalesce, all-gather straight into the destination
+            entry = self.entries[0]
+            outputs = list(entry.output.view(world_size, entry.numel).unbind(0))
+            dist.all_gather(outputs, self.data[entry.offset : entry.offset + entry.numel], group=self.group)
+            if entry.callback_fn is not None:
+                entry.callback_fn(entry.output)
+            self.offset = 0
+            self.entries.clear()
+            return
+
+        # all-gather the bucket, one contiguous row per rank
+        gathered = self.data.new_empty((world_size, self.offset))
+        dist.all_gather(list(gathered.unbind(0)), self.data[: self.offset], group=self.group)
+        # scatter the results back into their destination, then execute the post-gather callbacks
+        for entry in self.entries:
+            entry.output.view(world_size, entry.numel).copy_(gathered[:, entry.offset : entry.offset + entry.numel])
+            if entry.callback_fn is not None:
+                entry.callback_fn(entry.output)
+        self.offset = 0
+        self.entries.clear()
+
+
+class AllGatherBucketer:
+    """
+    Helper for bucketing multiple all-gather operations on small tensors
+    into larger all-gather ops to improve communication efficiency.
+    This is the counterpart of :class:`ReduceScatterBucketer`.
+
+    Usage::
+
+        bucketer = AllGatherBucketer()
+        bucketer.all_gather_async(small_shard, full_tensor, group)
+        bucketer.all_gather_async(big_shard, big_full_tensor, group)
+        bucketer.all_gather_async(more_small_shard, more_full_tensor, group)
+        bucketer.flush()  # outputs only guaranteed to be filled after flush()
+
+    Args:
+        bucket_cap_mb (int, Optional): bucket size for communicating. Buckets
+            hold the local shards, the gathered result is world_size times
+            bigger. Values <= 0 disable bucketing.
+    """
+
+    def __init__(self, bucket_cap_mb: int = 25):
+        self.bucket_cap_mb = bucket_cap_mb
+        self.buckets: Dict[Tuple[torch.dtype, torch.device, ProcessGroup], Bucket] = {}
+
+    @torch.no_grad()
+    def all_gather_async(
+        self, shard: Tensor, output: Tensor, group: ProcessGroup, callback_fn: Optional[Callable] = None,
+    ) -> None:
+        """
+        All-gather a tensor asynchronously, so that smaller gathers can be
+        bucketed together. ``output`` will hold the concatenation of the shards
+        of all the ranks, in rank order, and the given callback (``callback_fn``)
+        will then be called with it. Call ``flush()`` to force all queued ops and
+        callbacks to be executed.
+
+        Note that large inputs will be gathered immediately, and this function
+        may also flush the relevant bucket to make room for ``shard``.
+        The shard is copied, it can be released right after this call.
+
+        Args:
+            shard (Tensor): local shard to all-gather, same shape on all ranks
+            output (Tensor): contiguous tensor of ``group.size() * shard.numel()``
+                elements, which receives the gathered shards
+            group (ProcessGroup): process group for the gathering
+            callback_fn (Callable, Optional): callback function to call after
+                the gathering executes. Function will be called with ``output``.
+        """
+        world_size = group.size()
+        shard_size = shard.numel()
+
+        assert (
+            output.numel() == world_size * shard_size
+        ), f"all_gather output has {output.numel()} elements, expected {world_size * shard_size}"
+        assert output.is_contiguous(), "all_gather output needs to be contiguous"
+
+        bucket_size = self._get_bucket_size(shard.element_size())
+        if shard_size > bucket_size:
+            # input is too big to fit in the bucket, all-gather directly
+            dist.all_gather(list(output.view(-1).chunk(world_size)), shard.contiguous().view(-1), group=group)
+            if callback_fn is not None:
+                callback_fn(output)
+            return
+
+        bucket = self._get_bucket(shard, group)
+        if shard_size > bucket.data.numel() - bucket.offset:
+            # not enough space remaining in bucket, flush it now
+            bucket.flush()
+
+        # copy the shard into the bucket, the result will be scattered back into output
+        offset = bucket.offset
+        bucket.data[offset : offset + shard_size].copy_(shard.view(-1))
+        bucket.offset += shard_size
+        bucket.entries.append(_GatherEntry(offset, shard_size, output, callback_fn))
+
+    @torch.no_grad()
+    def flush(self) -> None:
+        """All-gather any partial buckets."""
+        for bucket in self.buckets.values():
+            bucket.flush()
+
+    @functools.lru_cache()
+    def _get_bucket_size(self, element_size: int) -> int:
+        if self.bucket_cap_mb <= 0:  # Values <= 0 disable bucketing.
+            return 0
+        MB = 1024 * 1024
+        return int(self.bucket_cap_mb * MB / element_size)
+
+    def _get_bucket(self, tensor: Tensor, group: ProcessGroup) -> Bucket:
+        key = (tensor.dtype, tensor.device, group)
+        if key not in self.buckets:
+            # buckets hold the local shards, flat
+            self.buckets[key] = Bucket(tensor.new_zeros(self._get_bucket_size(tensor.element_size())), group)
+        return self.buckets[key]
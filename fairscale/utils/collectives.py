@@ -0,0 +1,225 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Collectives with fallbacks, for the backends which do not implement them natively (Gloo has no reduce_scatter).
+
+The strategies are:
+    - NATIVE: the backend implementation
+    - ALL_REDUCE: all_reduce of the concatenated inputs, then slicing. Simple and well optimized on all backends,
+      but twice the traffic of a ring reduce_scatter
+    - RING: ring algorithm built from point to point communications, bandwidth optimal but with world_size - 1
+      sequential steps
+"""
+
+from enum import Enum
+from typing import Any, Callable, List, Optional, Set
+
+import torch
+from torch import Tensor
+import torch.distributed as dist
+
+
+class CollectiveStrategy(Enum):
+    NATIVE = "native"
+    ALL_REDUCE = "all_reduce"
+    RING = "ring"
+
+
+# Default strategy when the native collective is not available
+DEFAULT_FALLBACK = CollectiveStrategy.ALL_REDUCE
+
+# Backends which turned out not to support a collective, per collective name
+_unsupported: Set[str] = set()
+
+
+class _CallbackWork:
+    """Wrap a work handle (or nothing, if the operation is already done), and run a callback once it has completed"""
+
+    def __init__(self, work: Optional[Any], callback: Optional[Callable] = None) -> None:
+        self.work = work
+        self.callback = callback
+
+    def _complete(self) -> None:
+        self.work = None
+        if self.callback is not None:
+            callback, self.callback = self.callback, None
+            callback()
+
+    def wait(self) -> bool:
+        if self.work is not None:
+            self.work.wait()
+        self._complete()
+        return True
+
+    def is_completed(self) -> bool:
+        if self.work is not None and not self.work.is_completed():
+            return False
+        self._complete()
+        return True
+
+
+def _get_global_rank(group: Any, rank: int) -> int:
+    if group is None or group is dist.group.WORLD:
+        return rank
+    return dist.distributed_c10d._get_global_rank(group, rank)
+
+
+def _try_native(name: str, group: Any, fn: Callable, *args: Any, **kwargs: Any) -> Any:
+    """Call the native collective, returns False if the backend does not support it"""
+    key = f"{dist.get_backend(group)}.{name}"
+    if key in _unsupported:
+        return False
+    try:
+        return fn(*args, group=group, **kwargs)
+    except RuntimeError as e:
+        if "does not support" not in str(e):
+            raise
+        _unsupported.add(key)
+        return False
+
+
+def reduce_scatter(
+    output: Tensor,
+    input_list: List[Tensor],
+    group: Any = None,
+    async_op: bool = False,
+    strategy: Optional[CollectiveStrategy] = None,
+) -> Optional[Any]:
+    """
+    Same as `torch.distributed.reduce_scatter`, with a fallback if the backend does not support it.
+
+    Args:
+        output (Tensor): receives the reduced input of this rank
+        input_list (List[Tensor]): one input per rank, all the same size
+        group (ProcessGroup, optional): process group to work on
+        async_op (bool): return a work handle instead of waiting for the operation
+        strategy (CollectiveStrategy, optional): force a given strategy. By default the native collective is used,
+            or `DEFAULT_FALLBACK` if it is not supported.
+
+    Returns:
+        A work handle if `async_op` is set. The fallbacks may be synchronous, their handle is then already completed.
+    """
+    group = group if group is not None else dist.group.WORLD
+
+    if strategy is None or strategy == CollectiveStrategy.NATIVE:
+        handle = _try_native("reduce_scatter", group, dist.reduce_scatter, output, input_list, async_op=async_op)
+        if handle is not False:
+            return handle
+        assert strategy is None, "reduce_scatter is not supported by this backend"
+        strategy = DEFAULT_FALLBACK
+
+    rank = dist.get_rank(group)
+    world_size = dist.get_world_size(group)
+    numel = output.numel()
+
+    if strategy == CollectiveStrategy.ALL_REDUCE:
+        # Every rank reduces everything, and keeps its own slice
+        buffer = torch.cat([t.reshape(-1) for t in input_list])
+        work = dist.all_reduce(buffer, group=group, async_op=True)
+
+        def copy_result() -> None:
+            output.view(-1).copy_(buffer[rank * numel : (rank + 1) * numel])
+
+        handle = _CallbackWork(work, copy_result)
+
+    else:
+        assert strategy == CollectiveStrategy.RING, f"Unknown strategy {strategy}"
+
+        # At every step, send a partial sum to the next rank and accumulate the one from the previous rank.
+        # After world_size - 1 steps, each rank holds the complete sum of its own chunk
+        partial_sums = torch.stack([t.reshape(-1) for t in input_list])
+        received = torch.empty_like(partial_sums[0])
+        next_rank = _get_global_rank(group, (rank + 1) % world_size)
+        previous_rank = _get_global_rank(group, (rank - 1) % world_size)
+
+        for step in range(world_size - 1):
+            send_index = (rank - step - 1) % world_size
+            recv_index = (rank - step - 2) % world_size
+            send_work = dist.isend(partial_sums[send_index], dst=next_rank, group=group)
+            dist.recv(received, src=previous_rank, group=group)
+            send_work.wait()
+            partial_sums[recv_index] += received
+
+        output.view(-1).copy_(partial_sums[rank])
+        handle = _CallbackWork(None)
+
+    if async_op:
+        return handle
+
+    handle.wait()
+    return None
+
+
+def all_gather(
+    output_list: List[Tensor],
+    tensor: Tensor,
+    group: Any = None,
+    async_op: bool = False,
+    strategy: Optional[CollectiveStrategy] = None,
+) -> Optional[Any]:
+    """
+    Same as `torch.distributed.all_gather`, with a fallback if the backend does not support it.
+
+    Args:
+        output_list (List[Tensor]): receives the tensor of each rank
+        tensor (Tensor): the tensor of this rank, same size on all ranks
+        group (ProcessGroup, optional): process group to work on
+        async_op (bool): return a work handle instead of waiting for the operation
+        strategy (CollectiveStrategy, optional): force a given strategy. By default the native collective is used,
+            or `DEFAULT_FALLBACK` if it is not supported.
+
+    Returns:
+        A work handle if `async_op` is set. The fallbacks may be synchronous, their handle is then already completed.
+    """
+    group = group if group is not None else dist.group.WORLD
+
+    if strategy is None or strategy == CollectiveStrategy.NATIVE:
+        handle = _try_native("all_gather", group, dist.all_gather, output_list, tensor, async_op=async_op)
+        if handle is not False:
+            return handle
+        assert strategy is None, "all_gather is not supported by this backend"
+        strategy = DEFAULT_FALLBACK
+
+    rank = dist.get_rank(group)
+    world_size = dist.get_world_size(group)
+    numel = tensor.numel()
+
+    if strategy == CollectiveStrategy.ALL_REDUCE:
+        # Every rank contributes its own slice, zeros elsewhere
+        buffer = tensor.new_zeros(world_size * numel)
+        buffer[rank * numel : (rank + 1) * numel].copy_(tensor.reshape(-1))
+        work = dist.all_reduce(buffer, group=group, async_op=True)
+
+        def copy_results() -> None:
+            for out, chunk in zip(output_list, buffer.chunk(world_size)):
+                out.view(-1).copy_(chunk)
+
+        handle = _CallbackWork(work, copy_results)
+
+    else:
+        assert strategy == CollectiveStrategy.RING, f"Unknown strategy {strategy}"
+
+        # At every step, pass on the last received tensor to the next rank
+        output_list[rank].view(-1).copy_(tensor.reshape(-1))
+        next_rank = _get_global_rank(group, (rank + 1) % world_size)
+        previous_rank = _get_global_rank(group, (rank - 1) % world_size)
+        received = torch.empty_like(tensor).reshape(-1)
+
+        for step in range(world_size - 1):
+            send_index = (rank - step) % world_size
+            recv_index = (rank - step - 1) % world_size
+            send_work = dist.isend(output_list[send_index].reshape(-1).contiguous(), dst=next_rank, group=group)
+            dist.recv(received, src=previous_rank, group=group)
+            send_work.wait()
+            output_list[recv_index].view(-1).copy_(received)
+
+        handle = _CallbackWork(None)
+
+    if async_op:
+        return handle
+
+    handle.wait()
+    return None
@@ -25,6 +25,20 @@ def chunk_and_pad(tensor: torch.Tensor, num_chunks: int) -> List[torch.Tensor]:
     return chunks
 
 
+def chunk_into(tensor: torch.Tensor, out: torch.Tensor) -> None:
+    """Chunk a given Tensor into the rows of out, in the same way as ``chunk_and_pad`` but without
+    intermediate copies. The padding in out is left untouched, typically already zeroed."""
+    num_chunks, chunk_size = out.shape
+    if chunk_size == 0:
+        return
+    flat_tensor = torch.flatten(tensor)
+    assert chunk_size == (flat_tensor.numel() + num_chunks - 1) // num_chunks, "Chunk size mismatch"
+    full_chunks, remainder = divmod(flat_tensor.numel(), chunk_size)
+    out[:full_chunks].copy_(flat_tensor[: full_chunks * chunk_size].view(full_chunks, chunk_size))
+    if remainder > 0:
+        out[full_chunks, :remainder].copy_(flat_tensor[full_chunks * chunk_size :])
+
+
 def validate_process_group(device: torch.device, process_group: ProcessGroup) -> None:
     """Do a quick test in case user called FSDP without calling torch.cuda.set_device()
        correctly. This can easily happen in cpu_offload case where the model resides on
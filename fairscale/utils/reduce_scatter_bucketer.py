@@ -4,13 +4,14 @@
 # LICENSE file in the root directory of this source tree.
 
 import functools
-from typing import Callable, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import torch
 from torch import Tensor
-import torch.distributed as dist
 from torch.distributed import ProcessGroup
 
+from fairscale.utils.collectives import reduce_scatter
+
 
 class Bucket:
     def __init__(self, data: Tensor, group: ProcessGroup):
@@ -19,15 +20,31 @@ class Bucket:
         self.offset = 0
         self.callbacks: List[Callable] = []
         self.output_shard = torch.zeros_like(data[0])
+        self.work: Optional[Any] = None
+
+    @property
+    def in_flight(self) -> bool:
+        return self.work is not None
 
     def flush(self) -> None:
-        if self.offset == 0:
-            assert len(self.callbacks) == 0
+        """Issue the reduce-scatter of this bucket asynchronously. The bucket cannot be filled until ``wait()``"""
+        if self.offset == 0 or self.in_flight:
+            assert self.in_flight or len(self.callbacks) == 0
             return
         # reduce-scatter bucket
-        dist.reduce_scatter(
-            self.output_shard[: self.offset], list(self.data[:, : self.offset].unbind(0)), group=self.group
+        self.work = reduce_scatter(
+            self.output_shard[: self.offset],
+            list(self.data[:, : self.offset].unbind(0)),
+            group=self.group,
+            async_op=True,
         )
+
+    def wait(self) -> None:
+        """Wait for the in flight reduce-scatter, then make the bucket available again"""
+        if self.work is None:
+            return
+        self.work.wait()
+        self.work = None
         # execute post-reduction callbacks
         for callback_fn in self.callbacks:
             callback_fn()
@@ -43,6 +60,12 @@ class ReduceScatterBucketer:
     Helper for bucketing multiple reduce-scatter operations on small tensors
     into larger reduce-scatter ops to improve communication efficiency.
 
+    Several buckets are kept per (dtype, device, group), so that one of them
+    can be filled while the previous ones are being reduced.
+
+    Backends which do not implement reduce-scatter (Gloo) are supported, see
+    :mod:`fairscale.utils.collectives`.
+
     Usage::
 
         bucketer = ReduceScatterBucketer()
@@ -61,14 +84,27 @@ class ReduceScatterBucketer:
         # small
         # small2
 
+    The inputs can also be written directly in the buckets, which saves a copy::
+
+        slot = bucketer.get_slot(shard_numel, dtype, device, group, callback_fn)
+        if slot is not None:
+            slot.copy_(...)  # slot is shaped (world_size, shard_numel)
+
     Args:
         bucket_cap_mb (int, Optional): bucket size for communicating. Buckets
             are sub-divided based on world_size. Values <= 0 disable bucketing.
+        num_buckets (int, Optional): number of buckets per dtype, device and
+            process group. With two or more buckets, a bucket can be filled
+            while the previous one is in flight. Default: 2
     """
 
-    def __init__(self, bucket_cap_mb: int = 25):
+    def __init__(self, bucket_cap_mb: int = 25, num_buckets: int = 2):
+        assert num_buckets > 0, "At least one bucket is required"
         self.bucket_cap_mb = bucket_cap_mb
-        self.buckets: Dict[Tuple[torch.dtype, torch.device, ProcessGroup], Bucket] = {}
+        self.num_buckets = num_buckets
+        self.buckets: Dict[Tuple[torch.dtype, torch.device, ProcessGroup], List[Bucket]] = {}
+        self._current_bucket: Dict[Tuple[torch.dtype, torch.device, ProcessGroup], int] = {}
+        self.reset_stats()
 
     @torch.no_grad()
     def reduce_scatter_async(
@@ -101,36 +137,118 @@ class ReduceScatterBucketer:
         first_input = input_list[0]
         first_input_size = first_input.numel()
 
-        bucket_shard_size = self._get_shard_size(first_input.element_size(), world_size)
-        if first_input_size > bucket_shard_size:
+        # the callback will be given the reduced result, in the shape of the inputs
+        slot_callback_fn = None
+        if callback_fn is not None:
+            slot_callback_fn = functools.partial(_reshape_and_call, callback_fn, first_input)
+
+        slot = self.get_slot(first_input_size, first_input.dtype, first_input.device, group, slot_callback_fn)
+        if slot is None:
             # input is too big to fit in the bucket, reduce-scatter directly
+            self._stats["direct_reductions"] += 1
             output = torch.zeros_like(input_list[0])
-            dist.reduce_scatter(output, input_list, group=group)
+            reduce_scatter(output, input_list, group=group)
             if callback_fn is not None:
                 callback_fn(output)
             return
 
-        bucket = self._get_bucket(first_input, group)
-        if first_input_size > bucket.data.size(1) - bucket.offset:
-            # not enough space remaining in bucket, flush it now
-            bucket.flush()
+        # copy data from input_list straight into the bucket
+        for row, tensor in zip(slot.unbind(0), input_list):
+            row.copy_(tensor.view(-1))
+
+    @torch.no_grad()
+    def get_slot(
+        self,
+        shard_numel: int,
+        dtype: torch.dtype,
+        device: torch.device,
+        group: ProcessGroup,
+        callback_fn: Optional[Callable] = None,
+    ) -> Optional[Tensor]:
+        """
+        Reserve room for a reduce-scatter in a bucket, and return the corresponding
+        view, shaped ``(group.size(), shard_numel)``. Row ``i`` of this view is the
+        input destined to rank ``i``, it should be written in place before the next
+        call to this bucketer. The view is initially zeroed, so padding is not required.
+
+        The given callback (``callback_fn``) will be called with the flat reduced
+        result, once the bucket has been reduced.
+
+        Args:
+            shard_numel (int): number of elements which each rank receives
+            dtype (torch.dtype): type of the inputs
+            device (torch.device): device of the inputs
+            group (ProcessGroup): process group for reduction
+            callback_fn (Callable, Optional): callback function to call after
+                the reduction executes.
+
+        Returns:
+            The slot to write the inputs into, or ``None`` if they are too big
+            to be bucketed. The caller is then expected to reduce them directly.
+        """
+        world_size = group.size()
+        element_size = torch.tensor([], dtype=dtype).element_size()
+        bucket_shard_size = self._get_shard_size(element_size, world_size)
+        if shard_numel > bucket_shard_size:
+            return None
+
+        key = (dtype, device, group)
+        bucket = self._get_bucket(key, world_size)
+        if shard_numel > bucket.data.size(1) - bucket.offset:
+            # not enough space remaining in bucket, flush it now and move on to the next one
+            self._flush_bucket(bucket)
+            self._current_bucket[key] = (self._current_bucket[key] + 1) % self.num_buckets
+            bucket = self.buckets[key][self._current_bucket[key]]
+
+            # the next bucket can still be in flight, wait for it to be available
+            if bucket.in_flight:
+                self._stats["in_flight_waits"] += 1
+                bucket.wait()
 
-        # copy data from input_list into bucket
-        stacked_input = torch.stack(input_list).view(world_size, first_input_size)
         offset = bucket.offset
-        bucket.data[:, offset : offset + first_input_size].copy_(stacked_input)
-        bucket.offset += first_input_size
+        bucket.offset += shard_numel
 
-        # callback will be given the reduced result
         if callback_fn is not None:
-            result_view = bucket.output_shard[offset : offset + first_input_size].view_as(first_input)
+            result_view = bucket.output_shard[offset : offset + shard_numel]
             bucket.callbacks.append(functools.partial(callback_fn, result_view))
 
+        return bucket.data[:, offset : offset + shard_numel]
+
     @torch.no_grad()
     def flush(self) -> None:
-        """Reduce-scatter any partial buckets."""
-        for bucket in self.buckets.values():
-            bucket.flush()
+        """Reduce-scatter any partial buckets, and wait for all the reductions to be done."""
+        for key, buckets in self.buckets.items():
+            # issue the current bucket last, since the others have been filled (and are in flight) first
+            current = self._current_bucket[key]
+            ordered_buckets = buckets[current + 1 :] + buckets[: current + 1]
+            for bucket in ordered_buckets:
+                self._flush_bucket(bucket)
+            for bucket in ordered_buckets:
+                bucket.wait()
+
+    def get_stats(self) -> Dict[str, float]:
+        """
+        Statistics on the bucketing, since the last ``reset_stats()``:
+
+            - ``flushes``: number of bucketed reduce-scatter calls
+            - ``direct_reductions``: number of inputs too big to be bucketed, reduced directly
+            - ``mean_occupancy``: average fraction of the buckets which was filled when reduced
+            - ``in_flight_waits``: number of times filling had to wait for an in flight bucket
+        """
+        stats: Dict[str, float] = dict(self._stats)
+        stats["mean_occupancy"] = self._occupancy_sum / max(self._stats["flushes"], 1)
+        return stats
+
+    def reset_stats(self) -> None:
+        self._stats = {"flushes": 0, "direct_reductions": 0, "in_flight_waits": 0}
+        self._occupancy_sum = 0.0
+
+    def _flush_bucket(self, bucket: Bucket) -> None:
+        if bucket.offset == 0 or bucket.in_flight:
+            return
+        self._stats["flushes"] += 1
+        self._occupancy_sum += bucket.offset / bucket.data.size(1)
+        bucket.flush()
 
     @functools.lru_cache()
     def _get_shard_size(self, element_size: int, num_shards: int) -> int:
@@ -140,12 +258,18 @@ class ReduceScatterBucketer:
         bucket_size = self.bucket_cap_mb * MB / element_size
         return int(bucket_size // num_shards)
 
-    def _get_bucket(self, tensor: Tensor, group: ProcessGroup) -> Bucket:
-        key = (tensor.dtype, tensor.device, group)
+    def _get_bucket(self, key: Tuple[torch.dtype, torch.device, ProcessGroup], world_size: int) -> Bucket:
         if key not in self.buckets:
             # buckets are divided into world_size pieces, bucket.data shaped (world_size, shard_size)
-            world_size = group.size()
-            shard_size = self._get_shard_size(tensor.element_size(), world_size)
-            data = tensor.new_zeros((world_size, shard_size))
-            self.buckets[key] = Bucket(data, group)
-        return self.buckets[key]
+            dtype, device, group = key
+            shard_size = self._get_shard_size(torch.tensor([], dtype=dtype).element_size(), world_size)
+            self.buckets[key] = [
+                Bucket(torch.zeros((world_size, shard_size), dtype=dtype, device=device), group)
+                for _ in range(self.num_buckets)
+            ]
+            self._current_bucket[key] = 0
+        return self.buckets[key][self._current_bucket[key]]
+
+
+def _reshape_and_call(callback_fn: Callable, like: Tensor, result: Tensor) -> None:
+    callback_fn(result.view_as(like))
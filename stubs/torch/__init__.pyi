@@ -85,6 +85,7 @@ class Storage:
     def size(self) -> _int: ...
     def element_size(self) -> _int: ...
     def resize_(self, int) -> None: ...
+    def data_ptr(self) -> _int: ...
 #END
 
 # See https://github.com/python/mypy/issues/4146 for why these workarounds
@@ -237,6 +238,8 @@ class Tensor:
     def abs_(self) -> Tensor: ...
     def acos(self) -> Tensor: ...
     def acos_(self) -> Tensor: ...
+    def add(self, other: Union[Tensor, Number], *, alpha: Number=1) -> Tensor: ...
+    def add_(self, other: Union[Tensor, Number], *, alpha: Number=1) -> Tensor: ...
     def addbmm(self, batch1: Tensor, batch2: Tensor, *, beta: Number=1, alpha: Number=1) -> Tensor: ...
     def addbmm_(self, batch1: Tensor, batch2: Tensor, *, beta: Number=1, alpha: Number=1) -> Tensor: ...
     def addcdiv(self, tensor1: Tensor, tensor2: Tensor, *, value: Number=1) -> Tensor: ...
@@ -493,6 +496,7 @@ class Tensor:
     def is_distributed(self) -> _bool: ...
     def is_floating_point(self) -> _bool: ...
     is_leaf: _bool
+    is_sparse: _bool
     def is_nonzero(self) -> _bool: ...
     def is_pinned(self) -> _bool: ...
     def is_same_size(self, other: Tensor) -> _bool: ...
@@ -993,6 +997,18 @@ def _empty_per_channel_affine_quantized(size: _size, *, scales: Tensor, zero_poi
 @overload
 def _empty_per_channel_affine_quantized(*size: _int, scales: Tensor, zero_points: Tensor, axis: _int, memory_format: Optional[memory_format]=contiguous_format, dtype: _dtype=None, layout: _layout=strided, device: Union[_device, _int, str, None]=None, requires_grad:_bool=False) -> Tensor: ...
 def _fft_with_size(self: Tensor, signal_ndim: _int, complex_input: _bool, complex_output: _bool, inverse: _bool, checked_signal_sizes: _size, normalized: _bool, onesided: _bool, output_sizes: _size) -> Tensor: ...
+def _foreach_add(tensors: List[Tensor], other: Union[Number, List[Tensor]], *, alpha: Number=1) -> List[Tensor]: ...
+def _foreach_add_(tensors: List[Tensor], other: Union[Number, List[Tensor]], *, alpha: Number=1) -> None: ...
+def _foreach_addcdiv_(tensors: List[Tensor], tensor1: List[Tensor], tensor2: List[Tensor], value: Number=1) -> None: ...
+def _foreach_addcmul_(tensors: List[Tensor], tensor1: List[Tensor], tensor2: List[Tensor], value: Number=1) -> None: ...
+def _foreach_div(tensors: List[Tensor], other: Union[Number, List[Tensor]]) -> List[Tensor]: ...
+def _foreach_div_(tensors: List[Tensor], other: Union[Number, List[Tensor]]) -> None: ...
+def _foreach_mul(tensors: List[Tensor], other: Union[Number, List[Tensor]]) -> List[Tensor]: ...
+def _foreach_mul_(tensors: List[Tensor], other: Union[Number, List[Tensor]]) -> None: ...
+def _foreach_norm(tensors: List[Tensor], ord: Number=2) -> List[Tensor]: ...
+def _foreach_sqrt(tensors: List[Tensor]) -> List[Tensor]: ...
+def _foreach_sqrt_(tensors: List[Tensor]) -> None: ...
+def _foreach_zero_(tensors: List[Tensor]) -> None: ...
 def _fused_dropout(self: Tensor, p: _float, generator: Generator=None) -> Tuple[Tensor, Tensor]: ...
 def _has_compatible_shallow_copy_type(self: Tensor, from_: Tensor) -> _bool: ...
 def _index_copy_(self: Tensor, dim: _int, index: Tensor, source: Tensor) -> Tensor: ...
@@ -1889,6 +1905,7 @@ float64: dtype = ...
 double: dtype = ...
 float16: dtype = ...
 half: dtype = ...
+bfloat16: dtype = ...
 uint8: dtype = ...
 int8: dtype = ...
 int16: dtype = ...
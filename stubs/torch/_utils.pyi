@@ -0,0 +1,7 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+
+from typing import Sequence, Tuple
+from . import Tensor
+
+def _flatten_dense_tensors(tensors: Sequence[Tensor]) -> Tensor: ...
+def _unflatten_dense_tensors(flat: Tensor, tensors: Sequence[Tensor]) -> Tuple[Tensor, ...]: ...
@@ -5,6 +5,7 @@ from .. import Tensor
 from .grad_mode import no_grad as no_grad, enable_grad as enable_grad, \
     set_grad_enabled as set_grad_enabled
 from .profiler import record_function
+from . import graph as graph
 
 # This is defined in CPP in PyTorch source
 class ImperativeEngine:
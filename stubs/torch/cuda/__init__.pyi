@@ -64,12 +64,15 @@ class Stream:
     def __init__(self, device: _device_t = ..., priority: int = ...) -> None: ...
     def synchronize(self) -> None: ...
     def wait_stream(self, stream: Stream) -> None: ...
+    def wait_event(self, event: Event) -> None: ...
+    def record_event(self, event: Optional[Event] = None) -> Event: ...
 
 class Event:
     def __new__(cls, enable_timing: bool = False, blocking:bool = False, interprocess: bool = False) -> "Event": ...
     def record(self, stream: Optional[Stream] = None) -> None: ...
     def synchronize(self) -> None: ...
     def elapsed_time(self, end_event: Event) -> int: ...
+    def query(self) -> bool: ...
 
 class stream:
     def __init__(self, stream: Optional[Stream] = ...) -> None: ...
@@ -2,6 +2,12 @@
 
 from .sgd import SGD as SGD
 from .adam import Adam as Adam
+from .adamw import AdamW as AdamW
+from .adamax import Adamax as Adamax
+from .adadelta import Adadelta as Adadelta
+from .adagrad import Adagrad as Adagrad
+from .asgd import ASGD as ASGD
+from .rprop import Rprop as Rprop
 from . import lr_scheduler as lr_scheduler
 from .optimizer import Optimizer as Optimizer
 #MODIFIED BY TORCHGPIPE
@@ -344,6 +344,189 @@ def test_two_optimizers():
     mp.spawn(run_test_two_optimizers, args=(world_size, backend, device, temp_file_name), nprocs=world_size, join=True)
 
 
+def run_test_bucket_order(rank, world_size, backend, device, temp_file_name, reduce_scatter):
+    dist.init_process_group(init_method="file://" + temp_file_name, backend=backend, rank=rank, world_size=world_size)
+
+    torch.manual_seed(rank)
+    model = _get_mlp().to(device)
+    optimizer = OSS(params=model.parameters(), optim=torch.optim.SGD, lr=1e-3, momentum=0.99)
+    ddp_model = ShardedDataParallel(model, optimizer, reduce_scatter=reduce_scatter)
+
+    # Before the first backward, the buckets are filled by increasing param size
+    trainable_params = ddp_model._trainable_params
+    assert [trainable_params[i].numel() for i in ddp_model._bucket_fill_order] == sorted(
+        p.numel() for p in model.parameters()
+    )
+
+    for _ in range(3):
+        optimizer.zero_grad()
+        ddp_model(torch.rand((64, 2)).to(device)).abs().sum().backward()
+        optimizer.step()
+
+    # The gradients of the last layer are ready first, the buckets should now be filled in that order
+    first_params = {trainable_params[i] for i in ddp_model._bucket_fill_order[:2]}
+    assert first_params == set(model[-1].parameters())
+    assert not ddp_model._record_grad_ready_order
+
+    # The buckets need to be the same on all ranks
+    order = torch.tensor(ddp_model._bucket_fill_order)
+    reference_order = order.clone()
+    dist.broadcast(reference_order, src=0)
+    assert torch.equal(order, reference_order)
+
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("reduce_scatter", [False, True])
+def test_bucket_order(reduce_scatter):
+    world_size = 2
+    backend = "gloo"
+    temp_file_name = tempfile.mkstemp()[1]
+    device = "cpu"
+    mp.spawn(
+        run_test_bucket_order,
+        args=(world_size, backend, device, temp_file_name, reduce_scatter),
+        nprocs=world_size,
+        join=True,
+    )
+
+
+def run_test_low_precision_buckets(rank, world_size, backend, device, temp_file_name, reduce_scatter):
+    dist.init_process_group(init_method="file://" + temp_file_name, backend=backend, rank=rank, world_size=world_size)
+
+    torch.manual_seed(rank)
+    model = _get_mlp().to(device)
+    optimizer = OSS(params=model.parameters(), optim=torch.optim.SGD, lr=1e-3, momentum=0.99)
+    ddp_model = ShardedDataParallel(model, optimizer, reduce_dtype=torch.float16, reduce_scatter=reduce_scatter)
+
+    # The buckets are in the reduction precision, the grads keep their own
+    assert all(bucket.buffer.dtype == torch.float16 for bucket in ddp_model._bucket_list)
+
+    for _ in range(2):
+        optimizer.zero_grad()
+        ddp_model(torch.rand((64, 2)).to(device)).abs().sum().backward()
+
+        # Only the owned gradients are kept, in full precision
+        for param, owner in ddp_model._trainable_param_to_rank.items():
+            if owner == rank:
+                assert param.grad is not None and param.grad.dtype == torch.float32
+            else:
+                assert param.grad is None
+
+        optimizer.step()
+
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("reduce_scatter", [False, True])
+def test_low_precision_buckets(reduce_scatter):
+    world_size = 2
+    backend = "gloo"
+    temp_file_name = tempfile.mkstemp()[1]
+    device = "cpu"
+    mp.spawn(
+        run_test_low_precision_buckets,
+        args=(world_size, backend, device, temp_file_name, reduce_scatter),
+        nprocs=world_size,
+        join=True,
+    )
+
+
+def run_test_broadcast_buffers_interval(rank, world_size, backend, device, temp_file_name):
+    dist.init_process_group(init_method="file://" + temp_file_name, backend=backend, rank=rank, world_size=world_size)
+
+    # Several buffers per type, which are coalesced when broadcast
+    model = Sequential(Linear(2, 3), torch.nn.BatchNorm1d(3), Linear(3, 3), torch.nn.BatchNorm1d(3)).to(device)
+    model.register_buffer("float_buffer", torch.ones((2, 2)) * rank)
+    model.register_buffer("long_buffer", torch.ones(3, dtype=torch.long) * rank)
+    optimizer = OSS(params=model.parameters(), optim=torch.optim.SGD, lr=1e-3, momentum=0.99)
+    ddp_model = ShardedDataParallel(model, optimizer, sync_models_at_startup=False, broadcast_buffers_interval=2)
+
+    # Keep the batch norm statistics constant
+    ddp_model.eval()
+
+    for step in range(4):
+        for buffer in model.buffers():
+            buffer.fill_(rank)
+
+        ddp_model(torch.rand((8, 2)).to(device))
+
+        # The reference rank is 0, the buffers are only synced every other step
+        expected = 0 if step % 2 == 0 else rank
+        for buffer in model.buffers():
+            assert torch.all(buffer == expected), f"Unexpected buffer at step {step}: {buffer}"
+
+    dist.destroy_process_group()
+
+
+def test_broadcast_buffers_interval():
+    world_size = 2
+    backend = "gloo"
+    temp_file_name = tempfile.mkstemp()[1]
+    device = "cpu"
+    mp.spawn(
+        run_test_broadcast_buffers_interval,
+        args=(world_size, backend, device, temp_file_name),
+        nprocs=world_size,
+        join=True,
+    )
+
+
+def run_test_auto_tune_buffer_size(rank, world_size, backend, device, temp_file_name):
+    dist.init_process_group(init_method="file://" + temp_file_name, backend=backend, rank=rank, world_size=world_size)
+
+    torch.manual_seed(rank)
+    model = _get_mlp().to(device)
+    optimizer = OSS(params=model.parameters(), optim=torch.optim.SGD, lr=1e-3, momentum=0.99)
+    candidates = [0, 20, 2 ** 20]
+    steps = 2
+    ddp_model = ShardedDataParallel(model, optimizer, reduce_buffer_size_candidates=candidates, auto_tune_steps=steps)
+
+    def step():
+        optimizer.zero_grad()
+        ddp_model(torch.rand((64, 2)).to(device)).abs().sum().backward()
+        optimizer.step()
+
+    # Each candidate is tried in turn, with one warmup step
+    model_size = sum(p.numel() for p in model.parameters())
+    for candidate in candidates:
+        for _ in range(steps + 1):
+            step()
+            assert ddp_model.buffer_max_size == min(candidate, model_size)
+            assert ddp_model.reduce_buffer_size_measurements == {}
+
+    # The next forward should settle on the best candidate, the same on all ranks
+    step()
+    assert sorted(ddp_model.reduce_buffer_size_measurements.keys()) == candidates
+    best = min(candidates, key=lambda c: ddp_model.reduce_buffer_size_measurements[c])
+    assert ddp_model.buffer_max_size == min(best, model_size)
+
+    buffer_size = torch.tensor([ddp_model.buffer_max_size])
+    reference_buffer_size = buffer_size.clone()
+    dist.broadcast(reference_buffer_size, src=0)
+    assert torch.equal(buffer_size, reference_buffer_size)
+
+    # Nothing changes after that
+    for _ in range(2):
+        step()
+        assert ddp_model.buffer_max_size == min(best, model_size)
+
+    check_same_models_across_ranks(
+        ddp_model, dist.group.WORLD, params_should_be_equal=True, check_broadcast_buffers=False
+    )
+    dist.destroy_process_group()
+
+
+def test_auto_tune_buffer_size():
+    world_size = 2
+    backend = "gloo"
+    temp_file_name = tempfile.mkstemp()[1]
+    device = "cpu"
+    mp.spawn(
+        run_test_auto_tune_buffer_size, args=(world_size, backend, device, temp_file_name), nprocs=world_size, join=True
+    )
+
+
 def run_test_gpt2(rank, world_size, backend, device, temp_file_name):
     INPUT_DIM = 16
     BACH_SIZE = 10
@@ -58,6 +58,17 @@ class _DoubleInput(torch.nn.Module):
         return torch.cat((x1, x2), dim=1)
 
 
+class _ConditionalBranch(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.trunk = _get_mlp()
+        self.branch = Sequential(Linear(3, 3), Linear(3, 3))
+
+    def forward(self, x, use_branch):
+        x = self.trunk(x)
+        return self.branch(x) if use_branch else x
+
+
 def run_ddp_parity(
     rank, world_size, backend, temp_file_name, reduce_buffer_size, grad_accumulation, change_train_graph, fp16_reduction
 ):
@@ -628,3 +639,131 @@ def test_multiple_groups(reduce_buffer_size, backend):
         nprocs=world_size,
         join=True,
     )
+
+
+def run_ddp_parity_cpu(rank, world_size, temp_file_name, reduce_buffer_size, sharded_ddp_kwargs):
+    dist.init_process_group(init_method="file://" + temp_file_name, backend="gloo", rank=rank, world_size=world_size)
+
+    device = torch.device("cpu")
+    torch.manual_seed(rank)
+    np.random.seed(rank)
+    NUMBER_BATCHS = 5
+    BATCH_SIZE = 8
+
+    # Any model works. Add one different buffer per rank
+    model = _get_mlp()
+    model.register_buffer("test_buffer", torch.ones((1)) * rank)
+    model.to(device)
+    next(model.parameters()).requires_grad = False
+
+    sharded_optimizer = OSS(params=model.parameters(), optim=torch.optim.SGD, lr=1e-2, momentum=0.99)
+    sharded_ddp_model = ShardedDataParallel(
+        module=model,
+        sharded_optimizer=sharded_optimizer,
+        broadcast_buffers=True,
+        reduce_buffer_size=reduce_buffer_size,
+        **sharded_ddp_kwargs,
+    )
+
+    ddp_model_single = copy.deepcopy(model)
+    ddp_optimizer = torch.optim.SGD(ddp_model_single.parameters(), lr=1e-2, momentum=0.99)
+    ddp_model = DDP(ddp_model_single, broadcast_buffers=True)
+
+    check_same_model_params(sharded_ddp_model, ddp_model)
+
+    # Typical training loop, check that we get the exact same results as DDP
+    for _ in range(NUMBER_BATCHS):
+        input_tensor = torch.rand((BATCH_SIZE, 2)).to(device)
+
+        for model, optimizer in [(ddp_model, ddp_optimizer), (sharded_ddp_model, sharded_optimizer)]:
+            model.zero_grad()
+            model(input_tensor).abs().sum().backward()
+            optimizer.step()
+
+        check_same_model_params(sharded_ddp_model, ddp_model, "ShardedDDP and DDP diverged")
+
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("reduce_buffer_size", [0, 2 ** 20])
+@pytest.mark.parametrize(
+    "sharded_ddp_kwargs",
+    [
+        {},
+        {"reduce_scatter": True},
+        {"bucket_in_backward_order": False},
+        {"reduce_buffer_size_candidates": [0, 2 ** 20], "auto_tune_steps": 1},
+        {"reduce_fp16": True},
+        {"reduce_dtype": torch.float16, "reduce_scatter": True},
+    ],
+)
+def test_ddp_parity_cpu(reduce_buffer_size, sharded_ddp_kwargs):
+    world_size = 3
+    temp_file_name = tempfile.mkstemp()[1]
+    mp.spawn(
+        run_ddp_parity_cpu,
+        args=(world_size, temp_file_name, reduce_buffer_size, sharded_ddp_kwargs),
+        nprocs=world_size,
+        join=True,
+    )
+
+
+def run_ddp_parity_unused_params(rank, world_size, temp_file_name, reduce_buffer_size, sharded_ddp_kwargs):
+    dist.init_process_group(init_method="file://" + temp_file_name, backend="gloo", rank=rank, world_size=world_size)
+
+    torch.manual_seed(rank)
+    np.random.seed(rank)
+    BATCH_SIZE = 8
+
+    model = _ConditionalBranch()
+    sharded_optimizer = OSS(params=model.parameters(), optim=torch.optim.SGD, lr=1e-2, momentum=0.99)
+    sharded_ddp_model = ShardedDataParallel(
+        module=model,
+        sharded_optimizer=sharded_optimizer,
+        reduce_buffer_size=reduce_buffer_size,
+        find_unused_parameters=True,
+        **sharded_ddp_kwargs,
+    )
+
+    ddp_model_single = copy.deepcopy(model)
+    ddp_optimizer = torch.optim.SGD(ddp_model_single.parameters(), lr=1e-2, momentum=0.99)
+    ddp_model = DDP(ddp_model_single, find_unused_parameters=True)
+
+    check_same_model_params(sharded_ddp_model, ddp_model)
+
+    if sharded_ddp_kwargs.get("find_unused_parameters_every_step", False):
+        # The branch is used by all the ranks, then by some of the ranks only, then by none, then by all
+        usage = [True, True, rank % 2 == 0, rank % 2 == 1, False, True, rank % 2 == 0, rank % 2 == 0, True]
+    else:
+        # The branch is unused on some ranks from the start, it is then always reduced at the end of the backward
+        usage = [rank % 2 == 0, rank % 2 == 0, rank % 2 == 1, False, True, rank % 2 == 0, True]
+    for use_branch in usage:
+        input_tensor = torch.rand((BATCH_SIZE, 2))
+
+        for model, optimizer in [(ddp_model, ddp_optimizer), (sharded_ddp_model, sharded_optimizer)]:
+            model.zero_grad()
+            model(input_tensor, use_branch).abs().sum().backward()
+            optimizer.step()
+
+        check_same_model_params(sharded_ddp_model, ddp_model, "ShardedDDP and DDP diverged")
+
+    # The usage pattern is cached unless requested otherwise
+    assert sharded_ddp_model._unused_params_cached != sharded_ddp_kwargs.get("find_unused_parameters_every_step", False)
+
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("reduce_buffer_size", [0, 2 ** 20])
+@pytest.mark.parametrize(
+    "sharded_ddp_kwargs",
+    [{}, {"reduce_scatter": True}, {"reduce_fp16": True}, {"find_unused_parameters_every_step": True}],
+)
+def test_ddp_parity_unused_params(reduce_buffer_size, sharded_ddp_kwargs):
+    world_size = 2
+    temp_file_name = tempfile.mkstemp()[1]
+    mp.spawn(
+        run_ddp_parity_unused_params,
+        args=(world_size, temp_file_name, reduce_buffer_size, sharded_ddp_kwargs),
+        nprocs=world_size,
+        join=True,
+    )
@@ -10,7 +10,13 @@ import torch
 import torch.nn as nn
 from torch.utils.checkpoint import checkpoint as torch_checkpoint_wrapper
 
-from fairscale.nn.misc.checkpoint_activations import checkpoint_wrapper
+from fairscale.nn.misc.checkpoint_activations import (
+    _offloader,
+    _PinnedBufferPool,
+    checkpoint_wrapper,
+    free_offload_buffers,
+    set_offload_buffers_limit,
+)
 from fairscale.utils.testing import skip_if_no_cuda, torch_version
 
 
@@ -197,6 +203,177 @@ def test_offload_memory():
         assert 0
 
 
+@pytest.mark.parametrize("device", ["cpu", "cuda"])
+def test_offload_prefetch(device, monkeypatch):
+    """The offloaded inputs of the previous module are copied back while the current one is recomputed"""
+    if "cuda" in device and not torch.cuda.is_available():
+        pytest.skip("test requires a GPU")
+
+    events = []
+    ids = {}
+
+    def spy(name, method):
+        def wrapper(*args):
+            result = method(*args)
+            if name == "offload":
+                ids[id(result)] = len(ids)
+            events.append((name, ids[id(result if name == "offload" else args[0])]))
+            return result
+
+        monkeypatch.setattr(_offloader, name, wrapper)
+
+    spy("offload", _offloader.offload)
+    spy("_copy_to_device", _offloader._copy_to_device)
+    spy("fetch", _offloader.fetch)
+
+    input = torch.rand(60, 24, 4).requires_grad_(True)
+    model = CpuOffloadModel().to(device)
+    base = get_loss_and_gnorm(model, input.to(device))
+
+    model = CpuOffloadModel().to(device)
+    for i, layer in enumerate(model.layers):
+        model.layers[i] = checkpoint_wrapper(layer, offload_to_cpu=True)
+    offload = get_loss_and_gnorm(model, input.to(device))
+
+    assert base["loss"] == offload["loss"] and base["gnorm"] == offload["gnorm"]
+    assert events == [
+        ("offload", 0),
+        ("offload", 1),
+        ("offload", 2),
+        ("_copy_to_device", 2),
+        ("_copy_to_device", 1),
+        ("fetch", 2),
+        ("_copy_to_device", 0),
+        ("fetch", 1),
+        ("fetch", 0),
+    ]
+    assert len(_offloader._queue) == 0
+
+    # The pinned host buffers are reused by the next iteration
+    if "cuda" in device:
+        buffers = len(_offloader.pool._free)
+        get_loss_and_gnorm(model, input.to(device))
+        assert len(_offloader.pool._free) == buffers
+
+    # Nothing is offloaded without a backward (validation for instance)
+    events.clear()
+    with torch.no_grad():
+        model(input.to(device))
+    assert events == []
+
+
+@pytest.mark.parametrize("device", ["cpu", "cuda"])
+def test_offload_retain_graph(device):
+    """The offloaded inputs can be fetched by several backward passes through the same graph"""
+    if "cuda" in device and not torch.cuda.is_available():
+        pytest.skip("test requires a GPU")
+
+    input = torch.rand(60, 24, 4, device=device).requires_grad_(True)
+    model = CpuOffloadModel().to(device)
+    model(input).sum().backward()
+    ref_grads = [p.grad.clone() for p in model.parameters()]
+    model.zero_grad()
+
+    for i, layer in enumerate(model.layers):
+        model.layers[i] = checkpoint_wrapper(layer, offload_to_cpu=True)
+    loss = model(input).sum()
+    loss.backward(retain_graph=True)
+    loss.backward()
+
+    for p, ref_grad in zip(model.parameters(), ref_grads):
+        assert torch.allclose(p.grad, 2 * ref_grad)
+
+
+def test_pinned_buffer_pool():
+    pool = _PinnedBufferPool(max_bytes=4096)
+
+    # The sizes are rounded up to powers of two, so that close shapes share the buffers
+    buffer = pool.acquire(100, torch.float32)
+    assert buffer.numel() == 128
+    pool.release(buffer)
+    assert pool.acquire(120, torch.float32) is buffer
+    assert pool.acquire(120, torch.float16) is not buffer
+
+    # The free buffers are capped, the least recently released ones are dropped
+    buffers = [pool.acquire(256, torch.float32) for _ in range(5)]
+    for buffer in buffers:
+        pool.release(buffer)
+    assert pool.free_bytes == 4096
+    assert [b for b, _ in pool._free.values()] == buffers[1:]
+
+    pool.max_bytes = 1024
+    pool.trim()
+    assert [b for b, _ in pool._free.values()] == buffers[4:]
+    pool.clear()
+    assert pool.free_bytes == 0
+
+    set_offload_buffers_limit(2048)
+    assert _offloader.pool.max_bytes == 2048 and _offloader.pool.free_bytes <= 2048
+    free_offload_buffers()
+    assert _offloader.pool.free_bytes == 0
+    set_offload_buffers_limit(2 ** 30)
+
+
+def saved_activation_bytes(model, input):
+    """Bytes saved for the backward, besides the params"""
+    params = {p.storage().data_ptr() for p in model.parameters()}
+    saved = {}
+
+    def pack(tensor):
+        if tensor.storage().data_ptr() not in params:
+            saved[tensor.storage().data_ptr()] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        model(input)
+    return sum(saved.values())
+
+
+@pytest.mark.parametrize("device", ["cpu", "cuda"])
+@pytest.mark.parametrize("compress_dtype", [torch.float16, torch.bfloat16, torch.int8])
+@pytest.mark.parametrize("offload_to_cpu", [False, True])
+def test_compressed_activations(device, compress_dtype, offload_to_cpu):
+    if "cuda" in device and not torch.cuda.is_available():
+        pytest.skip("test requires a GPU")
+
+    def make_model(compress_dtype):
+        model = CpuOffloadModel().to(device)
+        for i, layer in enumerate(model.layers):
+            model.layers[i] = checkpoint_wrapper(layer, offload_to_cpu=offload_to_cpu, compress_dtype=compress_dtype)
+        return model
+
+    input = torch.rand(60, 24, 4).requires_grad_(True)
+    model, model_compressed = make_model(None), make_model(compress_dtype)
+    bytes_to_host = _offloader.bytes_to_host
+    ref = get_loss_and_gnorm(model, input.to(device))
+    ref_bytes_to_host = _offloader.bytes_to_host - bytes_to_host
+    compressed = get_loss_and_gnorm(model_compressed, input.to(device))
+    compressed_bytes_to_host = _offloader.bytes_to_host - ref_bytes_to_host - bytes_to_host
+
+    # The forward is exact, the recomputation and the gradients are approximate
+    assert ref["loss"] == compressed["loss"]
+    assert compressed["gnorm"] == pytest.approx(ref["gnorm"], rel=1e-2)
+
+    # The saved activations are half the size in FP16 or BF16, about a quarter in INT8
+    ratio = 0.5 if compress_dtype != torch.int8 else 0.3
+    if offload_to_cpu:
+        if "cuda" in device:
+            assert compressed_bytes_to_host <= ref_bytes_to_host * ratio
+    elif torch_version() >= (1, 10, 0):
+        input = input.to(device)
+        assert saved_activation_bytes(model_compressed, input) <= saved_activation_bytes(model, input) * ratio
+
+
+@pytest.mark.parametrize("compress_dtype", [torch.float16, torch.int8])
+@pytest.mark.parametrize("shape", [(0, 8), (3, 0)])
+def test_compressed_empty_activations(compress_dtype, shape):
+    model = checkpoint_wrapper(nn.Linear(shape[-1], 4), compress_dtype=compress_dtype)
+    input = torch.rand(*shape).requires_grad_(True)
+    model(input).sum().backward()
+    assert input.grad.shape == input.shape
+    assert model.weight.grad.shape == model.weight.shape
+
+
 class MultiinMultioutModel(nn.Module):
     """Model used to check different inputs and outputs"""
 
@@ -0,0 +1,116 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Test fairscale.nn.misc.checkpoint_planner API."""
+
+import copy
+
+import pytest
+import torch
+import torch.nn as nn
+
+from fairscale.nn.misc import auto_checkpoint
+from fairscale.nn.misc.checkpoint_planner import ModuleProfile, plan_checkpointing, profile_activations
+from fairscale.utils.testing import torch_version
+
+skip_if_no_saved_tensors_hooks = pytest.mark.skipif(
+    torch_version() < (1, 10, 0), reason="torch >= 1.10 is required to profile the activations"
+)
+
+
+class Block(nn.Module):
+    def __init__(self, width, hidden):
+        super().__init__()
+        self.ffn = nn.Sequential(nn.Linear(width, hidden), nn.ReLU(), nn.Linear(hidden, width))
+        self.norm = nn.BatchNorm1d(width)
+
+    def forward(self, x):
+        return self.norm(x + self.ffn(x))
+
+
+def make_model():
+    torch.manual_seed(0)
+    return nn.Sequential(Block(16, 32), Block(16, 128), Block(16, 64))
+
+
+def saved_bytes(model, inputs):
+    """Bytes of the activations that autograd actually keeps, besides the params"""
+    params = {p.storage().data_ptr() for p in model.parameters()}
+    saved = {}
+
+    def pack(tensor):
+        ptr = tensor.storage().data_ptr()
+        if ptr not in params:
+            saved[ptr] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = model(inputs).sum()
+    loss.backward()
+    return sum(saved.values())
+
+
+def test_plan_checkpointing():
+    profiles = {
+        "a": ModuleProfile(activation_bytes=100, forward_time=1.0),
+        "b": ModuleProfile(activation_bytes=100, forward_time=3.0),
+        "c": ModuleProfile(activation_bytes=50, forward_time=2.0),
+    }
+    assert plan_checkpointing(profiles, 250) == []
+    assert plan_checkpointing(profiles, 150) == ["a"]
+    assert plan_checkpointing(profiles, 100) == ["a", "c"]
+    assert plan_checkpointing(profiles, 49) == ["a", "b", "c"]
+    assert plan_checkpointing(profiles, 0) == ["a", "b", "c"]
+
+    # The memory steps are rounded up, so that the plan never exceeds the budget
+    for budget in range(300):
+        kept = set(profiles.keys()) - set(plan_checkpointing(profiles, budget, resolution=7))
+        assert sum(profiles[name].activation_bytes for name in kept) <= budget
+
+
+@skip_if_no_saved_tensors_hooks
+def test_profile_activations():
+    model = make_model()
+    inputs = torch.randn(8, 16)
+    state = copy.deepcopy(model.state_dict())
+
+    profiles, total_bytes = profile_activations(model, dict(model.named_children()), inputs)
+    assert total_bytes == saved_bytes(copy.deepcopy(model), inputs)
+
+    # The widest hidden layer keeps the largest activations
+    assert profiles["1"].activation_bytes > profiles["2"].activation_bytes > profiles["0"].activation_bytes > 0
+    assert all(p.forward_time > 0 for p in profiles.values())
+
+    # The profiling does not update the running statistics
+    for key, value in model.state_dict().items():
+        assert torch.equal(value, state[key]), key
+
+    with pytest.raises(AssertionError):
+        profile_activations(model, {"0": model[0], "0.ffn": model[0].ffn}, inputs)
+
+
+@skip_if_no_saved_tensors_hooks
+@pytest.mark.parametrize("budget_factor", [1.0, 0.7, 0.4, 0.0])
+def test_auto_checkpoint(budget_factor):
+    model = make_model()
+    reference = copy.deepcopy(model)
+    inputs = torch.randn(8, 16)
+
+    budget = int(saved_bytes(copy.deepcopy(model), inputs) * budget_factor)
+    plan = auto_checkpoint(model, budget, inputs)
+
+    if budget_factor == 1.0:
+        assert plan.modules == []
+    if budget_factor == 0.0:
+        # The budget cannot be met, all the candidates are checkpointed
+        assert plan.modules == ["0", "1", "2"]
+    else:
+        assert plan.planned_activation_bytes <= budget
+
+    # The checkpointed model keeps at most the planned activations, and computes the same gradients
+    assert saved_bytes(model, inputs.requires_grad_()) <= plan.planned_activation_bytes
+    saved_bytes(reference, inputs)
+    for p, p_ref in zip(model.parameters(), reference.parameters()):
+        assert torch.allclose(p.grad, p_ref.grad)
@@ -0,0 +1,142 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+
+import copy
+
+import pytest
+import torch
+
+from fairscale.optim import Adafactor, Precision
+
+
+@pytest.fixture(autouse=True)
+def set_torch_seed():
+    torch.manual_seed(1)
+    yield
+
+
+def make_model(dtype=torch.float32):
+    return torch.nn.Sequential(torch.nn.Linear(20, 30), torch.nn.ReLU(), torch.nn.Linear(30, 5)).to(dtype)
+
+
+def train(model, optimizer, steps=10):
+    dtype = next(model.parameters()).dtype
+    inputs = (torch.arange(160, dtype=torch.float).view(8, 20) / 160).to(dtype)
+    losses = []
+    for _ in range(steps):
+        optimizer.zero_grad()
+        loss = model(inputs).float().pow(2).mean()
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+    return losses
+
+
+@pytest.mark.parametrize("beta1", [None, 0.9])
+def test_factored_state(beta1):
+    model = make_model()
+    optimizer = Adafactor(model.parameters(), beta1=beta1)
+    losses = train(model, optimizer)
+    assert losses[-1] < losses[0]
+
+    weight, bias = model[0].weight, model[0].bias
+    state = optimizer.state[weight]
+    assert state["exp_avg_sq_row"].shape == (30,)
+    assert state["exp_avg_sq_col"].shape == (20,)
+    assert "exp_avg_sq" not in state
+    assert optimizer.state[bias]["exp_avg_sq"].shape == bias.shape
+    assert ("exp_avg" in state) == (beta1 is not None)
+
+
+def test_external_lr():
+    model = make_model()
+    optimizer = Adafactor(model.parameters(), lr=1e-2, relative_step=False, scale_parameter=False, weight_decay=0.1)
+    losses = train(model, optimizer)
+    assert losses[-1] < losses[0]
+
+    with pytest.raises(ValueError):
+        Adafactor(model.parameters(), lr=1e-2)
+    with pytest.raises(ValueError):
+        Adafactor(model.parameters(), relative_step=False)
+
+
+@pytest.mark.parametrize(
+    "precision", [Precision.MIXED_PRECISION, Precision.MEMORY_EFFICIENT_MIXED_PRECISION, Precision.PURE_FP16],
+)
+def test_fp16_precision_modes(precision):
+    model = make_model()
+    model_fp16 = copy.deepcopy(model).half()
+
+    optimizer = Adafactor(model.parameters(), beta1=0.9)
+    optimizer_fp16 = Adafactor(model_fp16.parameters(), beta1=0.9, precision=precision)
+    assert optimizer_fp16.mixed_precision == (precision is Precision.MIXED_PRECISION)
+
+    # Same gradients for both models, the updates should only differ by the FP16 rounding
+    for _ in range(5):
+        for p, p_fp16 in zip(model.parameters(), model_fp16.parameters()):
+            p.grad = torch.randn_like(p)
+            p_fp16.grad = p.grad.half()
+        optimizer.step()
+        optimizer_fp16.step()
+
+    for p, p_fp16 in zip(model.parameters(), model_fp16.parameters()):
+        assert p_fp16.dtype == torch.float16
+        assert torch.allclose(p, p_fp16.float(), atol=2e-3)
+
+        state = optimizer_fp16.state[p_fp16]
+        expected_dtype = torch.float16 if precision is Precision.PURE_FP16 else torch.float32
+        assert state["exp_avg"].dtype == expected_dtype
+        for key in ["exp_avg_sq", "exp_avg_sq_row", "exp_avg_sq_col"]:
+            if key in state:
+                assert state[key].dtype == torch.float32
+
+    if precision is Precision.MIXED_PRECISION:
+        # The FP16 params are copies of the FP32 masters
+        for p_fp16, p_fp32 in zip(model_fp16.parameters(), optimizer_fp16.fp32_param_groups[0]["params"]):
+            assert torch.equal(p_fp16, p_fp32.half())
+
+
+def test_state_dict():
+    model = make_model()
+    optimizer = Adafactor(model.parameters(), beta1=0.9)
+    train(model, optimizer, steps=3)
+
+    model_restored = copy.deepcopy(model)
+    optimizer_restored = Adafactor(model_restored.parameters(), beta1=0.9)
+    optimizer_restored.load_state_dict(copy.deepcopy(optimizer.state_dict()))
+
+    train(model, optimizer, steps=3)
+    train(model_restored, optimizer_restored, steps=3)
+    for p, p_restored in zip(model.parameters(), model_restored.parameters()):
+        assert torch.equal(p, p_restored)
+
+
+@pytest.mark.parametrize("precision", [Precision.MEMORY_EFFICIENT_MIXED_PRECISION, Precision.PURE_FP16])
+def test_state_dict_fp16(precision):
+    model = make_model().half()
+    optimizer = Adafactor(model.parameters(), beta1=0.9, precision=precision)
+    for p in model.parameters():
+        # Small gradients, the second moments would underflow in FP16
+        p.grad = torch.randn_like(p) * 1e-4
+    optimizer.step()
+
+    optimizer_restored = Adafactor(model.parameters(), beta1=0.9, precision=precision)
+    optimizer_restored.load_state_dict(copy.deepcopy(optimizer.state_dict()))
+
+    # The moments keep their type and values, the factored ones stay in FP32 whatever the type of the params
+    state = optimizer_restored.state[model[0].weight]
+    assert state["exp_avg"].dtype == (torch.float16 if precision is Precision.PURE_FP16 else torch.float32)
+    assert state["exp_avg_sq_row"].dtype == torch.float32
+    assert state["exp_avg_sq_col"].dtype == torch.float32
+    assert optimizer.state[model[0].weight]["exp_avg_sq_row"].max() < 1e-7
+
+    for p in model.parameters():
+        for key, value in optimizer.state[p].items():
+            if torch.is_tensor(value):
+                assert torch.equal(optimizer_restored.state[p][key], value), key
@@ -18,6 +18,7 @@ except ImportError:
 
 skip_if_no_cuda = pytest.mark.skipif(not torch.cuda.is_available(), reason="cuda required")
 skip_if_no_adam = pytest.mark.skipif(not imported_adam, reason="Fairscale Adam not available")
+devices = ["cpu", pytest.param("cuda", marks=skip_if_no_cuda)]
 
 
 @pytest.fixture(autouse=True)
@@ -26,18 +27,18 @@ def set_torch_seed():
     yield
 
 
-def make_full_precision_params():
-    weight = torch.randn(2, 1).cuda().requires_grad_()
-    bias = torch.randn(2).cuda().requires_grad_()
-    input = torch.randn(1).cuda()
+def make_full_precision_params(device="cuda"):
+    weight = torch.randn(2, 1).to(device).requires_grad_()
+    bias = torch.randn(2).to(device).requires_grad_()
+    input = torch.randn(1).to(device)
 
     return weight, bias, input
 
 
-def make_half_precision_params():
-    weight = torch.randn(2, 1).cuda().half().requires_grad_()
-    bias = torch.randn(2).cuda().half().requires_grad_()
-    input = torch.randn(1).half().cuda()
+def make_half_precision_params(device="cuda"):
+    weight = torch.randn(2, 1).to(device).half().requires_grad_()
+    bias = torch.randn(2).to(device).half().requires_grad_()
+    input = torch.randn(1).half().to(device)
 
     return weight, bias, input
 
@@ -48,7 +49,7 @@ def step_test(optimizer, weight, bias, input):
 
     def fn():
         optimizer.zero_grad()
-        y = weight.mv(input)
+        y = (weight * input).sum(dim=1)
         if y.is_cuda and bias.is_cuda and y.get_device() != bias.get_device():
             y = y.cuda(bias.get_device())
         loss = (y + bias).pow(2).sum()
@@ -64,7 +65,7 @@ def step_test(optimizer, weight, bias, input):
 def state_dict_test(optimizer, weight, bias, input):
     def fn_base(optimizer, weight, bias, input):
         optimizer.zero_grad()
-        loss = (weight.mv(input) + bias).pow(2).sum()
+        loss = ((weight * input).sum(dim=1) + bias).pow(2).sum()
         loss.backward()
         return loss
 
@@ -108,10 +109,10 @@ def assert_almost_zero(x):
     return 1.0
 
 
-@skip_if_no_cuda
 @skip_if_no_adam
-def test_step_full_precision_inferred():
-    weight, bias, input = make_full_precision_params()
+@pytest.mark.parametrize("device", devices)
+def test_step_full_precision_inferred(device):
+    weight, bias, input = make_full_precision_params(device)
     optimizer = Adam([weight, bias], lr=1e-3)
 
     step_test(optimizer, weight, bias, input)
@@ -128,10 +129,10 @@ def test_step_full_precision_inferred():
     assert optimizer.state[bias]["exp_avg_sq"].dtype == torch.float32
 
 
-@skip_if_no_cuda
 @skip_if_no_adam
-def test_step_mixed_precision_inferred():
-    weight, bias, input = make_half_precision_params()
+@pytest.mark.parametrize("device", devices)
+def test_step_mixed_precision_inferred(device):
+    weight, bias, input = make_half_precision_params(device)
     optimizer = Adam([weight, bias], lr=1e-3)
     step_test(optimizer, weight, bias, input)
 
@@ -155,10 +156,10 @@ def test_step_mixed_precision_inferred():
     assert optimizer.state[bias]["exp_avg_sq"].dtype == torch.float32
 
 
-@skip_if_no_cuda
 @skip_if_no_adam
-def test_step_memory_efficient():
-    weight, bias, input = make_half_precision_params()
+@pytest.mark.parametrize("device", devices)
+def test_step_memory_efficient(device):
+    weight, bias, input = make_half_precision_params(device)
     optimizer = Adam([weight, bias], lr=1e-3, precision=Precision.MEMORY_EFFICIENT_MIXED_PRECISION)
     step_test(optimizer, weight, bias, input)
 
@@ -175,10 +176,10 @@ def test_step_memory_efficient():
     assert optimizer.state[bias]["exp_avg_sq"].dtype == torch.float32
 
 
-@skip_if_no_cuda
 @skip_if_no_adam
-def test_step_pure_fp16():
-    weight, bias, input = make_half_precision_params()
+@pytest.mark.parametrize("device", devices)
+def test_step_pure_fp16(device):
+    weight, bias, input = make_half_precision_params(device)
     optimizer = Adam([weight, bias], lr=1e-3, precision=Precision.PURE_FP16)
     step_test(optimizer, weight, bias, input)
 
@@ -259,10 +260,10 @@ def test_step_with_grad_scaler():
     assert loss.item() < initial_value
 
 
-@skip_if_no_cuda
 @skip_if_no_adam
-def test_state_dict_full_precision():
-    weight, bias, input = make_full_precision_params()
+@pytest.mark.parametrize("device", devices)
+def test_state_dict_full_precision(device):
+    weight, bias, input = make_full_precision_params(device)
     optimizer = Adam([weight, bias], lr=1e-3)
 
     state_dict_test(optimizer, weight, bias, input)
@@ -296,42 +297,190 @@ def test_state_dict_memory_efficient():
     state_dict_test(optimizer, weight, bias, input)
 
 
-@skip_if_no_cuda
 @skip_if_no_adam
-def test_state_dict_pure_fp16():
-    weight, bias, input = make_half_precision_params()
+@pytest.mark.parametrize("device", devices)
+def test_state_dict_pure_fp16(device):
+    weight, bias, input = make_half_precision_params(device)
     optimizer = Adam([weight, bias], lr=1e-3, precision=Precision.PURE_FP16)
 
     state_dict_test(optimizer, weight, bias, input)
 
 
-@skip_if_no_cuda
 @skip_if_no_adam
-def test_update_optim_scale():
-    weight, bias, input = make_half_precision_params()
+@pytest.mark.parametrize("device", devices)
+@pytest.mark.parametrize("make_params", [make_full_precision_params, make_half_precision_params])
+def test_step_int8_state(device, make_params):
+    weight, bias, input = make_params(device)
+    optimizer = Adam([weight, bias], lr=1e-3, precision=Precision.INT8_STATE)
+    step_test(optimizer, weight, bias, input)
+
+    assert not optimizer.fp32_param_groups
+    for p in [weight, bias]:
+        assert optimizer.state[p]["exp_avg"].dtype == torch.int8
+        assert optimizer.state[p]["exp_avg_sq"].dtype == torch.uint8
+
+    state_dict_test(optimizer, weight, bias, input)
+
+    for p in [weight, bias]:
+        assert optimizer.state[p]["exp_avg"].dtype == torch.int8
+        assert optimizer.state[p]["exp_avg_sq"].dtype == torch.uint8
+
+
+@skip_if_no_adam
+@pytest.mark.parametrize("device", devices)
+def test_state_dict_int8_state_fp16_small_grads(device):
+    weight = torch.randn(2, 3, device=device).half().requires_grad_()
+    optimizer = Adam([weight], lr=1e-3, precision=Precision.INT8_STATE)
+    for _i in range(3):
+        weight.grad = torch.full_like(weight, 1e-5)
+        optimizer.step()
+
+    optimizer_c = Adam([weight.detach().clone().requires_grad_()], lr=1e-3, precision=Precision.INT8_STATE)
+    optimizer_c.load_state_dict(deepcopy(optimizer.state_dict()))
+
+    # The FP32 scales are tiny, they would underflow in the FP16 type of the params
+    state, state_c = optimizer.state[weight], list(optimizer_c.state.values())[0]
+    assert state["exp_avg_sq_absmax"].max() < 1e-8
+    for key in ["exp_avg", "exp_avg_sq", "exp_avg_absmax", "exp_avg_sq_absmax"]:
+        assert state_c[key].dtype == state[key].dtype
+        assert torch.equal(state_c[key], state[key]), key
+
+
+@skip_if_no_adam
+def test_int8_state_close_to_full_precision():
+    weight = torch.randn(100, 50, requires_grad=True)
+    weight_ref = weight.detach().clone().requires_grad_()
+    weight_init = weight.detach().clone()
+    optimizer = Adam([weight], lr=1e-2, precision=Precision.INT8_STATE)
+    optimizer_ref = Adam([weight_ref], lr=1e-2)
+
+    for _i in range(20):
+        grad = torch.randn(100, 50)
+        weight.grad, weight_ref.grad = grad.clone(), grad.clone()
+        optimizer.step()
+        optimizer_ref.step()
+
+    # The updates are within a few percents of the full precision ones
+    update, update_ref = weight.detach() - weight_init, weight_ref.detach() - weight_init
+    assert (update - update_ref).norm() < 0.05 * update_ref.norm()
+    # The moments take a quarter of the memory
+    state = optimizer.state[weight]
+    quantized_bytes = sum(t.numel() * t.element_size() for t in state.values() if torch.is_tensor(t))
+    assert quantized_bytes < 0.3 * 2 * weight.numel() * 4
+
+
+@skip_if_no_adam
+@pytest.mark.parametrize("device", devices)
+def test_update_optim_scale(device):
+    weight, bias, input = make_half_precision_params(device)
     optimizer = Adam([weight, bias], lr=1e-3, precision=Precision.PURE_FP16)
     optimizer._optim_scale_update_freq = 1
     optimizer._optim_scale = 2 ** 15
 
     optimizer.zero_grad()
-    loss = (weight.mv(input) + bias).pow(2).sum()
+    loss = ((weight * input).sum(dim=1) + bias).pow(2).sum()
     loss.backward()
     optimizer.step()
 
     assert optimizer._optim_scale == 2 ** 16
 
 
-@skip_if_no_cuda
 @skip_if_no_adam
-def test_exploding_optimizer_state():
-    weight = torch.tensor([[float("inf")]]).half().cuda().requires_grad_()
-    input = torch.tensor([1.0]).half().cuda().requires_grad_()
+@pytest.mark.parametrize("device", devices)
+def test_deferred_optim_scale_update(device):
+    weight = torch.randn(10, 5).half().to(device).requires_grad_()
+    optimizer = Adam([weight], lr=1e-3, precision=Precision.PURE_FP16, defer_optim_scale_update=True)
+    optimizer._optim_scale_update_freq = 3
+    initial_scale = optimizer._optim_scale
+
+    # The overflows are handled on device: the state is reset, the scale is left as is until the next update
+    for _i in range(2):
+        weight.grad = torch.full_like(weight, 6e4)
+        optimizer.step()
+        assert optimizer._optim_scale == initial_scale
+        assert torch.equal(optimizer.state[weight]["exp_avg"], torch.zeros_like(weight))
+        assert torch.equal(optimizer.state[weight]["exp_avg_sq"], torch.zeros_like(weight))
+
+    for _i in range(2):
+        weight.grad = torch.rand_like(weight)
+        optimizer.step()
+    assert optimizer.state[weight]["exp_avg"].abs().sum() > 0
+
+    # Two overflowing steps, followed by two steps without overflow
+    optimizer.update_optim_scale()
+    assert optimizer._optim_scale == initial_scale / 4
+    assert optimizer._steps_since_optim_scale_change == 2
+
+    # A third step without overflow should bring the scale up again
+    weight.grad = torch.rand_like(weight)
+    optimizer.step()
+    state_dict = optimizer.state_dict()
+    assert optimizer._optim_scale == initial_scale / 2
+    assert state_dict["optim_scale"] == initial_scale / 2
+
+
+@skip_if_no_adam
+@pytest.mark.parametrize("device", devices)
+def test_overflow_resets_all_param_groups(device):
+    weight = torch.randn(10, 5).half().to(device).requires_grad_()
+    bias = torch.randn(5).half().to(device).requires_grad_()
+    optimizer = Adam(
+        [{"params": [weight]}, {"params": [bias]}],
+        lr=1e-3,
+        precision=Precision.PURE_FP16,
+        defer_optim_scale_update=True,
+    )
+
+    for _i in range(2):
+        weight.grad, bias.grad = torch.rand_like(weight), torch.rand_like(bias)
+        optimizer.step()
+    assert optimizer.state[weight]["exp_avg"].abs().sum() > 0
+
+    # Only the last param group overflows, the state of both is reset
+    weight.grad, bias.grad = torch.rand_like(weight), torch.full_like(bias, 6e4)
+    optimizer.step()
+    for p in [weight, bias]:
+        assert torch.equal(optimizer.state[p]["exp_avg"], torch.zeros_like(p))
+        assert torch.equal(optimizer.state[p]["exp_avg_sq"], torch.zeros_like(p))
+    assert optimizer._overflow_steps.item() == 1
+
+
+@skip_if_no_adam
+@pytest.mark.parametrize("device", devices)
+def test_overflow_resets_inf_state(device):
+    weight = torch.randn(10, 5).half().to(device).requires_grad_()
+    bias = torch.randn(5).half().to(device).requires_grad_()
+    optimizer = Adam(
+        [{"params": [weight]}, {"params": [bias]}],
+        lr=1e-3,
+        precision=Precision.PURE_FP16,
+        defer_optim_scale_update=True,
+    )
+
+    weight.grad, bias.grad = torch.rand_like(weight), torch.rand_like(bias)
+    optimizer.step()
+
+    # An inf state is reset to zeros, not multiplied into NaNs
+    optimizer.state[weight]["exp_avg"][0, 0] = float("inf")
+    optimizer.state[weight]["exp_avg_sq"][0, 1] = float("inf")
+    optimizer.step()
+    for p in [weight, bias]:
+        assert torch.equal(optimizer.state[p]["exp_avg"], torch.zeros_like(p))
+        assert torch.equal(optimizer.state[p]["exp_avg_sq"], torch.zeros_like(p))
+    assert optimizer._overflow_steps.item() == 1
+
+
+@skip_if_no_adam
+@pytest.mark.parametrize("device", devices)
+def test_exploding_optimizer_state(device):
+    weight = torch.tensor([[float("inf")]]).half().to(device).requires_grad_()
+    input = torch.tensor([1.0]).half().to(device).requires_grad_()
 
     optimizer = Adam([weight], lr=1e-3, precision=Precision.PURE_FP16)
     optimizer._optim_scale = 1.0
 
     optimizer.zero_grad()
-    loss = (weight.mv(input)).pow(2).sum()
+    loss = (weight * input).sum(dim=1).pow(2).sum()
     loss.backward()
     with pytest.raises(RuntimeError):
         optimizer.step()
@@ -404,3 +553,49 @@ def test_pure_fp16_with_full_precision_parameters():
     bias = torch.randn(10, requires_grad=True).float().cuda()
     with pytest.raises(AssertionError):
         Adam([weight, bias], lr=1e-2, precision=Precision.PURE_FP16)
+
+
+@skip_if_no_adam
+def test_multi_tensor_parity_with_torch_adam():
+    # Without weight decay, the update matches the reference PyTorch implementation
+    weight = torch.randn(10, 5, requires_grad=True)
+    weight_ref = weight.detach().clone().requires_grad_()
+    input = torch.randn(5)
+
+    optimizer = Adam([weight], lr=1e-2)
+    optimizer_ref = torch.optim.Adam([weight_ref], lr=1e-2)
+
+    for _i in range(10):
+        for optim, p in ((optimizer, weight), (optimizer_ref, weight_ref)):
+            optim.zero_grad()
+            p.mv(input).pow(2).sum().backward()
+            optim.step()
+
+        assert torch.allclose(weight, weight_ref, atol=1e-6)
+
+
+@skip_if_no_cuda
+@skip_if_no_adam
+@pytest.mark.parametrize("precision", list(Precision) if imported_adam else [])
+def test_multi_tensor_parity_with_fused_kernel(precision):
+    from fairscale.optim import adam
+
+    if adam.fused_adam_cuda is None:
+        pytest.skip("the fused_adam_cuda extension is not built")
+
+    dtype = torch.float32 if precision is Precision.FULL_PRECISION else torch.float16
+    weight = torch.randn(10, 5, device="cuda", dtype=dtype, requires_grad=True)
+    weight_cpu = weight.detach().cpu().requires_grad_()
+
+    optimizer = Adam([weight], lr=1e-2, weight_decay=0.1, precision=precision)
+    optimizer_cpu = Adam([weight_cpu], lr=1e-2, weight_decay=0.1, precision=precision)
+
+    for _i in range(5):
+        grad = torch.randn(10, 5, dtype=dtype)
+        weight.grad = grad.cuda()
+        weight_cpu.grad = grad.clone()
+        optimizer.step()
+        optimizer_cpu.step()
+
+    assert torch.allclose(weight.cpu().float(), weight_cpu.float(), atol=1e-3)
+    assert optimizer._optim_scale == optimizer_cpu._optim_scale
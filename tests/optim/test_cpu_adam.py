@@ -0,0 +1,118 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+
+import copy
+
+import pytest
+import torch
+
+from fairscale.optim import CPUAdam
+
+
+@pytest.fixture(autouse=True)
+def set_torch_seed():
+    torch.manual_seed(1)
+    yield
+
+
+def make_model():
+    # Some params span several chunks, some are smaller than a chunk
+    return torch.nn.Sequential(torch.nn.Linear(50, 40), torch.nn.ReLU(), torch.nn.Linear(40, 3))
+
+
+def train(model, optimizer, steps=5):
+    inputs = torch.arange(400, dtype=torch.float).view(8, 50) / 400
+    for _ in range(steps):
+        optimizer.zero_grad()
+        model(inputs).pow(2).sum().backward()
+        optimizer.step()
+
+
+@pytest.mark.parametrize("num_threads", [1, 4])
+@pytest.mark.parametrize("weight_decay", [0.0, 0.1])
+def test_parity_with_torch_adam(num_threads, weight_decay):
+    model = make_model()
+    model_ref = copy.deepcopy(model)
+
+    optimizer = CPUAdam(model.parameters(), lr=1e-2, weight_decay=weight_decay, num_threads=num_threads, chunk_size=256)
+    optimizer_ref = torch.optim.Adam(model_ref.parameters(), lr=1e-2, weight_decay=weight_decay)
+
+    train(model, optimizer)
+    train(model_ref, optimizer_ref)
+
+    for p, p_ref in zip(model.parameters(), model_ref.parameters()):
+        assert torch.allclose(p, p_ref, atol=1e-6)
+        assert torch.allclose(optimizer.state[p]["exp_avg"], optimizer_ref.state[p_ref]["exp_avg"], atol=1e-6)
+        assert torch.allclose(optimizer.state[p]["exp_avg_sq"], optimizer_ref.state[p_ref]["exp_avg_sq"], atol=1e-6)
+
+
+@pytest.mark.parametrize("num_threads", [1, 4])
+def test_non_contiguous_params(num_threads):
+    # A transposed weight, and a grad produced by an expand
+    weight = torch.nn.Parameter(torch.rand(40, 50).t())
+    bias = torch.nn.Parameter(torch.rand(40))
+    weight_ref, bias_ref = [torch.nn.Parameter(p.detach().clone()) for p in [weight, bias]]
+
+    optimizer = CPUAdam([weight, bias], lr=1e-2, num_threads=num_threads, chunk_size=256)
+    optimizer_ref = torch.optim.Adam([weight_ref, bias_ref], lr=1e-2)
+
+    for _ in range(3):
+        grad = torch.rand(50, 40)
+        for w, b in [(weight, bias), (weight_ref, bias_ref)]:
+            w.grad, b.grad = grad.clone(), torch.ones(1).expand(40)
+        optimizer.step()
+        optimizer_ref.step()
+
+    assert not weight.is_contiguous()
+    assert torch.allclose(weight, weight_ref, atol=1e-6)
+    assert torch.allclose(bias, bias_ref, atol=1e-6)
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
+def test_low_precision_params(dtype):
+    model = make_model()
+    optimizer = CPUAdam(model.parameters(), lr=1e-2, chunk_size=256, low_precision_dtype=dtype)
+    train(model, optimizer)
+
+    params = list(model.parameters())
+    assert len(optimizer.low_precision_params) == len(params)
+    for p in params:
+        low_precision = optimizer.low_precision_params[p]
+        assert low_precision.dtype == dtype
+        assert torch.equal(low_precision, p.detach().to(dtype))
+
+    # All the copies of a param group share the same buffer, ready for a single host to device copy
+    storages = {optimizer.low_precision_params[p].storage().data_ptr() for p in params}
+    assert len(storages) == 1
+
+
+def test_state_dict():
+    model = make_model()
+    optimizer = CPUAdam(model.parameters(), lr=1e-2, chunk_size=256)
+    train(model, optimizer)
+
+    model_c = copy.deepcopy(model)
+    optimizer_c = CPUAdam(model_c.parameters(), lr=1e-3)
+    optimizer_c.load_state_dict(optimizer.state_dict())
+    assert optimizer_c.param_groups[0]["lr"] == 1e-2
+
+    train(model, optimizer)
+    train(model_c, optimizer_c)
+    for p, p_c in zip(model.parameters(), model_c.parameters()):
+        assert torch.equal(p, p_c)
+
+
+def test_invalid_arguments():
+    params = make_model().parameters()
+    with pytest.raises(ValueError):
+        CPUAdam(params, lr=-1.0)
+    with pytest.raises(ValueError):
+        CPUAdam(params, betas=(1.0, 0.0))
+    with pytest.raises(ValueError):
+        CPUAdam(params, weight_decay=-1)
@@ -9,6 +9,7 @@
 
 
 import copy
+from itertools import chain
 from math import inf
 import tempfile
 from typing import Any, Dict, Type, cast
@@ -22,6 +23,7 @@ import torch.multiprocessing as mp
 from torch.nn.parallel import DistributedDataParallel as DDP
 
 import fairscale.optim as optim
+from fairscale.optim.utils import is_indexed_state_dict, load_indexed_state_dict, save_indexed_state_dict
 from fairscale.utils.testing import check_same_model_params, skip_if_no_cuda, skip_if_py39_no_cuda, skip_if_single_gpu
 
 BACKEND = dist.Backend.NCCL if torch.cuda.is_available() else dist.Backend.GLOO  # type: ignore
@@ -115,6 +117,110 @@ class TestSingleRank(unittest.TestCase):
         # Check that the exposed param_groups are on the proper device
         assert o.param_groups[0]["params"][0].device == x.device
 
+    def test_state_dict_from_file(self):
+        x = torch.tensor([1.0], device=DEVICE, requires_grad=True)
+        o = optim.OSS([x], lr=0.1, momentum=0.9)
+        x.backward()
+        o.step()
+        o.consolidate_state_dict()
+        state_dict = o.state_dict()
+
+        plain_file = tempfile.mkstemp()[1]
+        torch.save(state_dict, plain_file)
+        indexed_file = tempfile.mkstemp()[1]
+        save_indexed_state_dict(state_dict, indexed_file)
+        assert is_indexed_state_dict(indexed_file)
+        assert not is_indexed_state_dict(plain_file)
+
+        # Both formats should restore the same state
+        for f in [plain_file, indexed_file]:
+            o = optim.OSS([x], lr=0.01)
+            o.load_state_dict_from_file(f)
+            assert o.optim.state[x]["momentum_buffer"] == torch.tensor([1.0], device=DEVICE)
+            assert o.param_groups[0]["lr"] == 0.1
+            assert o.optim.param_groups[0]["lr"] == 0.1
+
+        # Entries which are filtered out should not be materialized
+        partial = load_indexed_state_dict(indexed_file, filter_fn=lambda position, key: False)
+        assert partial["param_groups"] == state_dict["param_groups"]
+        assert list(partial["state"].keys()) == list(state_dict["state"].keys())
+        assert all(v is None for v in partial["state"].values())
+
+    def test_heterogeneous_optimizers(self):
+        dense, embedding = torch.nn.Linear(3, 3).to(DEVICE), torch.nn.Embedding(5, 3).to(DEVICE)
+        head = torch.nn.Linear(3, 1).to(DEVICE)
+        dense_ref, embedding_ref, head_ref = copy.deepcopy(dense), copy.deepcopy(embedding), copy.deepcopy(head)
+
+        param_groups = [
+            {"params": dense.parameters()},
+            {"params": embedding.parameters()},
+            {"params": head.parameters()},
+        ]
+        optim_classes = {0: torch.optim.Adam, 1: torch.optim.SGD, 2: torch.optim.Adagrad}
+        o = optim.OSS(param_groups, optim=optim_classes, lr=0.1, momentum=0.9)
+        o_ref = [
+            torch.optim.Adam(dense_ref.parameters(), lr=0.1),
+            torch.optim.SGD(embedding_ref.parameters(), lr=0.1, momentum=0.9),
+            torch.optim.Adagrad(head_ref.parameters(), lr=0.1),
+        ]
+
+        # The defaults which are not supported by a given optimizer should have been filtered out
+        assert "momentum" not in o.optim.optims[torch.optim.Adam].defaults.keys()
+        assert o.optim.optims[torch.optim.SGD].defaults["momentum"] == 0.9
+
+        # The state initialized by the constructors (Adagrad) should be shared
+        assert o.optim.optims[torch.optim.Adagrad].state is o.optim.state
+        assert "sum" in o.optim.state[head.weight].keys()
+
+        inputs = torch.tensor([0, 2, 4], device=DEVICE)
+        for _ in range(3):
+            for d, e, h, optims in [(dense, embedding, head, [o]), (dense_ref, embedding_ref, head_ref, o_ref)]:
+                h(d(e(inputs))).sum().backward()
+                for opt in optims:
+                    opt.step()
+                    opt.zero_grad()
+
+        check_same_model_params(dense, dense_ref)
+        check_same_model_params(embedding, embedding_ref)
+        check_same_model_params(head, head_ref)
+        assert torch.equal(o.optim.state[dense.weight]["exp_avg"], o_ref[0].state[dense_ref.weight]["exp_avg"])
+        assert torch.equal(
+            o.optim.state[embedding.weight]["momentum_buffer"], o_ref[1].state[embedding_ref.weight]["momentum_buffer"]
+        )
+        assert torch.equal(o.optim.state[head.weight]["sum"], o_ref[2].state[head_ref.weight]["sum"])
+
+        # Save and reload, the state should be split back in between the optimizers
+        o.consolidate_state_dict()
+        state_dict = o.state_dict()
+        assert state_dict["param_groups"][0]["betas"] == (0.9, 0.999)
+        assert state_dict["param_groups"][1]["momentum"] == 0.9
+
+        param_groups = [
+            {"params": dense.parameters()},
+            {"params": embedding.parameters()},
+            {"params": head.parameters()},
+        ]
+        o = optim.OSS(param_groups, optim=optim_classes, lr=0.01)
+        o.load_state_dict(state_dict)
+        assert o.optim.param_groups[1]["momentum"] == 0.9
+        assert o.optim.optims[torch.optim.SGD].param_groups[0]["momentum"] == 0.9
+        assert torch.equal(o.optim.state[dense.weight]["exp_avg"], o_ref[0].state[dense_ref.weight]["exp_avg"])
+        assert torch.equal(
+            o.optim.optims[torch.optim.SGD].state[embedding.weight]["momentum_buffer"],
+            o_ref[1].state[embedding_ref.weight]["momentum_buffer"],
+        )
+        assert torch.equal(
+            o.optim.optims[torch.optim.Adagrad].state[head.weight]["sum"], o_ref[2].state[head_ref.weight]["sum"]
+        )
+
+        # A param group without optimizer cannot be handled
+        with pytest.raises(ValueError):
+            o.add_param_group({"params": [torch.rand(3, device=DEVICE, requires_grad=True)]})
+
+        with pytest.raises(ValueError):
+            param_groups = [{"params": dense.parameters()}, {"params": embedding.parameters()}]
+            _ = optim.OSS(param_groups, optim={0: torch.optim.Adam}, lr=0.1)
+
     def test_lr_scheduler(self):
         x = torch.tensor([1.0], device=DEVICE, requires_grad=True)
         x2 = torch.tensor([1.0], device=DEVICE, requires_grad=True)
@@ -590,7 +696,8 @@ def test_multiple_groups():
 
 def run_gradient_clipping(rank, world_size, tempfile_name):
     dist_init(rank, world_size, tempfile_name, backend="gloo")
-    device = torch.device(rank)
+    device = torch.device(rank) if torch.cuda.is_available() else torch.device("cpu")
+    device_ids = [rank] if torch.cuda.is_available() else None
     torch.manual_seed(rank)  # make sure that the different rank get different data
 
     # Run a dummy step so that the optimizer state dict exists
@@ -598,9 +705,9 @@ def run_gradient_clipping(rank, world_size, tempfile_name):
     target = torch.rand((batch, target_width), device=device)
     inputs = torch.rand((batch, input_width), device=device)
     NORMS = [1.0, 2.0, 1, 2, inf]
-    CLIP_NORM = 0.3
+    CLIP_NORMS = [0.3, 1e3]
 
-    def check(norm):
+    def check(norm, clip_norm):
         model_oss = torch.nn.Sequential(
             torch.nn.Linear(input_width, hidden),
             torch.nn.Linear(hidden, hidden),
@@ -612,10 +719,10 @@ def run_gradient_clipping(rank, world_size, tempfile_name):
         # Normally OSS would use ShardedDDP and only reduce to the proper rank, but this does not change the
         # gradient norm computation from OSS and adds a dependency.
         # to keep the comparison apples-to-apples DDP is used in both cases
-        model_oss = DDP(module=model_oss, device_ids=[rank],)
+        model_oss = DDP(module=model_oss, device_ids=device_ids,)
         sharded_optimizer = optim.OSS(model_oss.parameters(), lr=0.1, momentum=0.99)
 
-        model = DDP(model, device_ids=[rank],)
+        model = DDP(model, device_ids=device_ids,)
 
         loss_fn = torch.nn.L1Loss()
         loss_fn.to(device)
@@ -634,26 +741,30 @@ def run_gradient_clipping(rank, world_size, tempfile_name):
         torch.testing.assert_allclose(loss_oss, loss)
 
         # Check the equivalence with the non-sharded optim
-        oss_total_norm = sharded_optimizer.clip_grad_norm(CLIP_NORM, norm_type=norm)
-        total_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), CLIP_NORM, norm_type=norm)
+        oss_total_norm = sharded_optimizer.clip_grad_norm(clip_norm, norm_type=norm)
+        total_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), clip_norm, norm_type=norm)
         assert torch.allclose(oss_total_norm, total_norm), "torch and fairscale should return the same grad norm"
 
-        # Check that the params have indeed been clipped
+        # Check that the params have indeed been clipped, or left untouched
         for params in sharded_optimizer.per_device_params.values():
             for param in filter(lambda x: x.grad is not None, params[rank]):
-                assert torch.norm(param.grad, p=norm) < CLIP_NORM, f"param grad norm above clip : {param.grad}"
+                assert torch.norm(param.grad, p=norm) < clip_norm, f"param grad norm above clip : {param.grad}"
+
+        for param_oss, param in zip(model_oss.parameters(), model.parameters()):
+            if sharded_optimizer.param_to_rank[param_oss] == rank:
+                assert torch.allclose(param_oss.grad, param.grad), "torch and fairscale grads differ after clipping"
 
     for norm in NORMS:
-        print(f"Checking norm {norm}")
-        check(norm)
+        for clip_norm in CLIP_NORMS:
+            print(f"Checking norm {norm} - clip {clip_norm}")
+            check(norm, clip_norm)
 
-        # Check twice, catch an hypothetic iterator dumb mistake
-        check(norm)
+            # Check twice, catch an hypothetic iterator dumb mistake
+            check(norm, clip_norm)
 
     dist.destroy_process_group()
 
 
-@skip_if_no_cuda
 def test_gradient_clipping():
     world_size = 3
     temp_file_name = tempfile.mkstemp()[1]
@@ -774,6 +885,234 @@ def test_state_dict_distributed():
     )
 
 
+def run_test_cpu_offload(rank, world_size, tempfile_name):
+    dist_init(rank, world_size, tempfile_name, backend="gloo")
+    device = torch.device(rank) if torch.cuda.is_available() else torch.device("cpu")
+    torch.manual_seed(rank)  # make sure that the different rank get different data
+
+    batch, input_width, hidden, target_width = 3, 20, 10, 5
+    loss_fn = torch.nn.L1Loss().to(device)
+
+    model = torch.nn.Sequential(torch.nn.Linear(input_width, hidden), torch.nn.Linear(hidden, target_width)).to(device)
+    model_offload = copy.deepcopy(model)
+
+    sharded_optimizer = optim.OSS(model.parameters(), optim=torch.optim.Adam, lr=0.01)
+    sharded_optimizer_offload = optim.OSS(model_offload.parameters(), optim=torch.optim.Adam, lr=0.01, cpu_offload=True)
+
+    # The wrapped optimizer should only see host tensors
+    for pg in sharded_optimizer_offload.optim.param_groups:
+        for p in pg["params"]:
+            assert p.device == torch.device("cpu")
+            assert p.dtype == torch.float32
+
+    def run_grad_step(model, optimizer, inputs, target):
+        def closure():
+            optimizer.zero_grad()
+            loss = loss_fn(model(inputs), target)
+            loss.backward()
+            for p in filter(lambda x: x.requires_grad, model.parameters()):
+                dist.all_reduce(p.grad, op=dist.ReduceOp.SUM)
+                p.grad /= world_size
+            return loss
+
+        return optimizer.step(closure=closure)
+
+    def check_step():
+        target = torch.rand((batch, target_width), device=device)
+        inputs = torch.rand((batch, input_width), device=device)
+        loss = run_grad_step(model, sharded_optimizer, inputs, target)
+        loss_offload = run_grad_step(model_offload, sharded_optimizer_offload, inputs, target)
+        assert torch.allclose(loss, loss_offload)
+        check_same_model_params(model, model_offload, "offloaded and on-device optimizer steps diverged")
+
+    for _ in range(3):
+        check_step()
+
+    # Save and reload the offloaded state, check that the training still matches
+    sharded_optimizer_offload.consolidate_state_dict(recipient_rank=RECIPIENT_RANK)
+    state_dict = sharded_optimizer_offload.state_dict() if rank == RECIPIENT_RANK else {}
+    state_dict = sync_object_ranks(state_dict, RECIPIENT_RANK, device)
+
+    sharded_optimizer_offload = optim.OSS(model_offload.parameters(), optim=torch.optim.Adam, lr=1e6, cpu_offload=True)
+    sharded_optimizer_offload.load_state_dict(state_dict)
+
+    for param, state in sharded_optimizer_offload.optim.state.items():
+        assert param.device == torch.device("cpu")
+        assert state["exp_avg"].device == torch.device("cpu")
+
+    for _ in range(3):
+        check_step()
+
+    # Freezing a layer rebuilds the host buffers, the remaining layers should still train the same way
+    for p in chain(model[0].parameters(), model_offload[0].parameters()):
+        p.requires_grad = False
+        p.grad = None
+
+    sharded_optimizer.refresh_trainable()
+    sharded_optimizer_offload.refresh_trainable()
+
+    for _ in range(3):
+        check_step()
+
+    dist.destroy_process_group()
+
+
+def test_cpu_offload():
+    world_size = 2
+    temp_file_name = tempfile.mkstemp()[1]
+
+    mp.spawn(run_test_cpu_offload, args=(world_size, temp_file_name), nprocs=world_size, join=True)
+
+
+def run_state_dict_from_file(rank, world_size, tempfile_name, checkpoint_file):
+    dist_init(rank, world_size, tempfile_name, backend="gloo")
+    device = torch.device("cpu")
+    torch.manual_seed(0)
+
+    model = torch.nn.Sequential(torch.nn.Linear(20, 10), torch.nn.Linear(10, 5)).to(device)
+    sharded_optimizer = optim.OSS(model.parameters(), optim=torch.optim.Adam, lr=0.1)
+    model(torch.rand((3, 20), device=device)).sum().backward()
+    sharded_optimizer.step()
+
+    sharded_optimizer.consolidate_state_dict(recipient_rank=RECIPIENT_RANK)
+    if rank == RECIPIENT_RANK:
+        save_indexed_state_dict(sharded_optimizer.state_dict(), checkpoint_file)
+    dist.barrier()
+
+    # Only the owned state should be materialized, and match what this rank had before
+    reloaded_optimizer = optim.OSS(model.parameters(), optim=torch.optim.Adam, lr=0.01)
+    reloaded_optimizer.load_state_dict_from_file(checkpoint_file)
+    assert reloaded_optimizer.param_groups[0]["lr"] == 0.1
+
+    for param in model.parameters():
+        if sharded_optimizer.param_to_rank[param] == rank:
+            for key, value in sharded_optimizer.optim.state[param].items():
+                assert torch.equal(torch.as_tensor(value), torch.as_tensor(reloaded_optimizer.optim.state[param][key]))
+        else:
+            assert param not in reloaded_optimizer.optim.state.keys()
+
+    dist.destroy_process_group()
+
+
+def test_state_dict_from_file():
+    world_size = 2
+    temp_file_name = tempfile.mkstemp()[1]
+    checkpoint_file = tempfile.mkstemp()[1]
+
+    mp.spawn(
+        run_state_dict_from_file, args=(world_size, temp_file_name, checkpoint_file), nprocs=world_size, join=True,
+    )
+
+
+def run_quantized_adam_state(rank, world_size, tempfile_name, checkpoint_file):
+    dist_init(rank, world_size, tempfile_name, backend="gloo")
+    torch.manual_seed(0)
+
+    model = torch.nn.Sequential(torch.nn.Linear(20, 10), torch.nn.Linear(10, 5))
+    sharded_optimizer = optim.OSS(model.parameters(), optim=optim.Adam, lr=0.1, precision=optim.Precision.INT8_STATE)
+    for _ in range(3):
+        model(torch.rand((3, 20))).sum().backward()
+        sharded_optimizer.step()
+        sharded_optimizer.zero_grad()
+
+    for state in sharded_optimizer.optim.state.values():
+        assert state["exp_avg"].dtype == torch.int8
+        assert state["exp_avg_sq"].dtype == torch.uint8
+
+    sharded_optimizer.consolidate_state_dict(recipient_rank=RECIPIENT_RANK)
+    if rank == RECIPIENT_RANK:
+        save_indexed_state_dict(sharded_optimizer.state_dict(), checkpoint_file)
+    dist.barrier()
+
+    # The quantized state should be restored as is, and training should proceed
+    reloaded_optimizer = optim.OSS(model.parameters(), optim=optim.Adam, lr=0.1, precision=optim.Precision.INT8_STATE)
+    reloaded_optimizer.load_state_dict_from_file(checkpoint_file)
+    for param, state in sharded_optimizer.optim.state.items():
+        for key, value in state.items():
+            reloaded_value = reloaded_optimizer.optim.state[param][key]
+            assert torch.equal(torch.as_tensor(value), torch.as_tensor(reloaded_value))
+
+    model(torch.rand((3, 20))).sum().backward()
+    reloaded_optimizer.step()
+
+    dist.destroy_process_group()
+
+
+def test_quantized_adam_state():
+    world_size = 2
+    temp_file_name = tempfile.mkstemp()[1]
+    checkpoint_file = tempfile.mkstemp()[1]
+
+    mp.spawn(
+        run_quantized_adam_state, args=(world_size, temp_file_name, checkpoint_file), nprocs=world_size, join=True,
+    )
+
+
+def run_adafactor(rank, world_size, tempfile_name):
+    dist_init(rank, world_size, tempfile_name, backend="gloo")
+    torch.manual_seed(0)
+
+    model = torch.nn.Sequential(torch.nn.Linear(20, 10), torch.nn.Linear(10, 5))
+    model_ref = copy.deepcopy(model)
+    sharded_optimizer = optim.OSS(model.parameters(), optim=optim.Adafactor, beta1=0.9)
+    optimizer_ref = optim.Adafactor(model_ref.parameters(), beta1=0.9)
+
+    # Same inputs on all the ranks, the sharded updates should match the local ones
+    for _ in range(3):
+        inputs = torch.rand((3, 20))
+        for m, o in ((model, sharded_optimizer), (model_ref, optimizer_ref)):
+            o.zero_grad()
+            m(inputs).sum().backward()
+            o.step()
+
+    for state in sharded_optimizer.optim.state.values():
+        assert "exp_avg_sq" in state or "exp_avg_sq_row" in state
+
+    for p, p_ref in zip(model.parameters(), model_ref.parameters()):
+        assert torch.allclose(p, p_ref)
+
+    dist.destroy_process_group()
+
+
+def test_adafactor():
+    world_size = 2
+    temp_file_name = tempfile.mkstemp()[1]
+
+    mp.spawn(run_adafactor, args=(world_size, temp_file_name), nprocs=world_size, join=True)
+
+
+def run_heterogeneous_partition(rank, world_size, tempfile_name):
+    dist_init(rank, world_size, tempfile_name, backend="gloo")
+
+    # A big stateless param, and smaller stateful ones
+    params_sgd = [torch.rand(1000, requires_grad=True)]
+    params_adam = [torch.rand(100, requires_grad=True) for _ in range(4)]
+    o = optim.OSS(
+        [{"params": params_sgd}, {"params": params_adam}], optim={0: torch.optim.SGD, 1: torch.optim.Adam}, lr=0.1
+    )
+
+    # The Adam params are what actually counts memory wise, they should be spread evenly
+    for partition in o.partition_parameters():
+        assert len(partition[1]["params"]) == 2
+
+    # All the params should still be updated, by their respective optimizers
+    for p in params_adam + params_sgd:
+        p.grad = torch.ones_like(p)
+    references = [p.detach().clone() for p in params_adam + params_sgd]
+    o.step()
+    for p, p_ref in zip(params_adam + params_sgd, references):
+        assert not torch.allclose(p, p_ref)
+
+    dist.destroy_process_group()
+
+
+def test_heterogeneous_partition():
+    world_size = 2
+    temp_file_name = tempfile.mkstemp()[1]
+
+    mp.spawn(run_heterogeneous_partition, args=(world_size, temp_file_name), nprocs=world_size, join=True)
+
+
 def run_ddp_parity(rank, world_size, backend, temp_file_name):
     url = "file://" + temp_file_name
     dist.init_process_group(init_method=url, backend=backend, rank=rank, world_size=world_size)
@@ -22,6 +22,7 @@ from torch.nn import Linear, Sequential
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.optim import SGD
 
+from fairscale.nn.data_parallel import ShardedDataParallel as ShardedDDP
 from fairscale.optim import OSS, AdaScale, AdaScaleWrapper
 from fairscale.utils.golden_testing_data import adascale_test_data
 from fairscale.utils.testing import skip_if_single_gpu
@@ -128,3 +129,45 @@ def test_sequential(oss):
     model[3].weight.data.copy_(Tensor(range(30)).reshape(6, 5) / mean(range(30)))
 
     mp.spawn(_test_basic_func, args=(world_size, temp_file_name, test_case, oss, model), nprocs=world_size, join=True)
+
+
+def _test_sharded_grads_func(rank, world_size, tempfile_name, sharded_ddp):
+    dist.init_process_group(init_method="file://" + tempfile_name, backend="gloo", rank=rank, world_size=world_size)
+
+    def make_model():
+        model = Sequential(Linear(2, 3, bias=False), Linear(3, 4, bias=False), Linear(4, 5, bias=False))
+        for i, layer in enumerate(model):
+            layer.weight.data.copy_(
+                torch.arange(layer.weight.numel(), dtype=torch.float).view_as(layer.weight) / (i + 5)
+            )
+        return model
+
+    # Reference: full reduced gradients on all the ranks
+    model_ref = DDP(make_model())
+    optim_ref = AdaScale(SGD(model_ref.parameters(), lr=0.1))
+
+    # With OSS the reduced gradients are only used on the rank which owns the param,
+    # and with ShardedDDP they are only there on this rank
+    model = make_model()
+    optim = AdaScale(OSS(model.parameters(), SGD, lr=0.1))
+    model = ShardedDDP(model, optim._optimizer) if sharded_ddp else DDP(model)
+
+    inputs = [[[1.0, 0], [0, 1.0]], [[0, 1.0], [1.0, 0]], [[1.0, 1.0], [0, 1.0]]]
+    for in_data in inputs:
+        for m, o in ((model_ref, optim_ref), (model, optim)):
+            m(Tensor(in_data[rank])).sum().backward()
+            o.step()
+            o.zero_grad()
+
+        assert np.allclose(optim.gain(), optim_ref.gain()), "{} vs {}".format(optim.gain(), optim_ref.gain())
+
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("sharded_ddp", [False, True])
+def test_sharded_grads(sharded_ddp):
+    """Test that the gain is the same when the reduced gradients are sharded"""
+    world_size = 2
+    temp_file_name = tempfile.mkstemp()[1]
+
+    mp.spawn(_test_sharded_grads_func, args=(world_size, temp_file_name, sharded_ddp), nprocs=world_size, join=True)
@@ -0,0 +1,77 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All rights reserved.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+
+""" Test the ShardedGradScaler unscaling and inf checks, with Gloo """
+
+from collections import defaultdict
+import tempfile
+
+import pytest
+import torch
+from torch.cuda.amp.grad_scaler import _refresh_per_optimizer_state
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.optim import SGD
+
+from fairscale.optim import OSS
+from fairscale.optim.grad_scaler import ShardedGradScaler
+
+
+def _make_scaler(scale):
+    scaler = ShardedGradScaler()
+    if not scaler.is_enabled():
+        # torch.cuda.amp.GradScaler disables itself without CUDA, the unscaling does not depend on it
+        scaler._enabled = True
+        scaler._per_optimizer_states = defaultdict(_refresh_per_optimizer_state)
+    scaler._scale = torch.full((1,), scale)
+    scaler._growth_tracker = torch.zeros(1, dtype=torch.int32)
+    return scaler
+
+
+def run_unscale(rank, world_size, temp_file_name, sharded_optimizer, inf_rank):
+    dist.init_process_group(init_method="file://" + temp_file_name, backend="gloo", rank=rank, world_size=world_size)
+
+    params = [torch.nn.Parameter(torch.ones(4) * i) for i in range(6)]
+    if sharded_optimizer:
+        optimizer = OSS(params, SGD, lr=0.1)
+        local_params = [p for p in params if optimizer.param_to_rank[p] == rank]
+    else:
+        # Stand in for FullyShardedDataParallel: all the params are local shards
+        for p in params:
+            p._is_sharded = True
+        optimizer = SGD(params, lr=0.1)
+        local_params = params
+
+    for p in params:
+        p.grad = torch.full_like(p, 4.0)
+    if rank == inf_rank:
+        local_params[-1].grad[1] = float("inf")
+
+    scaler = _make_scaler(4.0)
+    scaler.unscale_(optimizer)
+
+    # Only the local gradients are unscaled
+    for p in params:
+        if p is local_params[-1] and rank == inf_rank:
+            continue
+        assert torch.equal(p.grad, torch.full_like(p, 1.0 if any(p is lp for lp in local_params) else 4.0))
+
+    # All the ranks agree on the inf check
+    found_inf = scaler._per_optimizer_states[id(optimizer)]["found_inf_per_device"]
+    assert sum(v.item() for v in found_inf.values()) == (0.0 if inf_rank < 0 else 1.0)
+
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("sharded_optimizer", [True, False])
+@pytest.mark.parametrize("inf_rank", [-1, 1])
+def test_unscale(sharded_optimizer, inf_rank):
+    world_size = 2
+    temp_file_name = tempfile.mkstemp()[1]
+    mp.spawn(run_unscale, args=(world_size, temp_file_name, sharded_optimizer, inf_rank), nprocs=world_size, join=True)
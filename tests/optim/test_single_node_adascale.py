@@ -19,7 +19,7 @@ from torch.nn import Linear, Sequential
 from torch.optim import SGD
 from torch.optim.lr_scheduler import LambdaLR
 
-from fairscale.optim import AdaScale
+from fairscale.optim import AdaScale, AdaScaleAccumulationScheduler
 from fairscale.utils.golden_testing_data import adascale_test_data
 from fairscale.utils.testing import skip_if_no_cuda
 from fairscale.utils.testing_memory import find_tensor_by_shape
@@ -382,3 +382,79 @@ def test_custom_smoothing_factor():
     model = Linear(1, 1)
     optim = AdaScale(SGD(model.parameters(), lr=0.1), smoothing=0.12345, num_gradients_to_accumulate=3)
     assert optim._smoothing == 0.12345
+
+
+def test_lazy_state_sync():
+    """Test that the statistics stay on device during the backward passes, and are synced when read."""
+    model = Linear(2, 2, bias=False)
+    optim = AdaScale(SGD(model.parameters(), lr=0.1), num_gradients_to_accumulate=2)
+    for _ in range(3):
+        for in_data in [Tensor([0.0, 1.0]), Tensor([1.0, 0.0])]:
+            model(in_data).sum().backward()
+        # The NumPy state has not been refreshed yet
+        assert optim._device_state_dirty
+        assert isinstance(optim._device_state["grad_sqr_avg"], Tensor)
+        gain = optim.gain()
+        assert not optim._device_state_dirty
+        optim.step()
+        optim.zero_grad()
+
+    # The checkpoints hold the up to date NumPy state
+    state = optim.state_dict()["state"]["adascale"]
+    assert isinstance(state["grad_sqr_avg"], np.ndarray)
+    assert np.allclose(state["grad_sqr_avg"], optim._device_state["grad_sqr_avg"].numpy())
+
+    model_restored = Linear(2, 2, bias=False)
+    optim_restored = AdaScale(SGD(model_restored.parameters(), lr=0.1), num_gradients_to_accumulate=2)
+    optim_restored.load_state_dict(optim.state_dict())
+    assert np.allclose(optim_restored.gain(), gain)
+
+
+@pytest.mark.parametrize("noisy", [True, False])
+def test_accumulation_scheduler(noisy):
+    """Test that the number of gradients to accumulate follows the gradient noise."""
+    torch.manual_seed(0)
+    model = Linear(100, 1, bias=False)
+    optim = AdaScale(SGD(model.parameters(), lr=0.1), num_gradients_to_accumulate=4)
+    scheduler = AdaScaleAccumulationScheduler(optim, max_num_gradients_to_accumulate=64, interval=2, warmup=2)
+
+    for _ in range(20):
+        for _ in range(scheduler.num_gradients_to_accumulate):
+            # The gradient noise scale is 100 with the noisy inputs, 0 with constant ones
+            in_data = torch.ones(100) + (10 * torch.randn(100) if noisy else 0.0)
+            model(in_data).sum().backward()
+        optim.step()
+        optim.zero_grad()
+        scheduler.step()
+
+    # With a noise scale of 100, the predicted efficiency is 0.87 with 16 gradients and 0.77 with 32
+    expected = 16 if noisy else 2
+    assert scheduler.num_gradients_to_accumulate == expected, scheduler.changes
+    assert optim.scale == expected
+    assert len(scheduler.changes) > 0
+    for change in scheduler.changes:
+        ratio = change.new_num_gradients_to_accumulate / change.old_num_gradients_to_accumulate
+        assert ratio == (2.0 if noisy else 0.5)
+
+
+@pytest.mark.parametrize("smoothing", [None, 0.5])
+def test_accumulation_scheduler_smoothing(smoothing):
+    """Test that the scheduler keeps the smoothing value set by the user."""
+    torch.manual_seed(0)
+    model = Linear(100, 1, bias=False)
+    optim = AdaScale(SGD(model.parameters(), lr=0.1), smoothing=smoothing, num_gradients_to_accumulate=4)
+    scheduler = AdaScaleAccumulationScheduler(optim, max_num_gradients_to_accumulate=64, interval=2, warmup=2)
+
+    for _ in range(6):
+        for _ in range(scheduler.num_gradients_to_accumulate):
+            model(torch.ones(100) + 10 * torch.randn(100)).sum().backward()
+        optim.step()
+        optim.zero_grad()
+        scheduler.step()
+
+    assert len(scheduler.changes) > 0
+    if smoothing is None:
+        # Follows the effective world size
+        assert optim.smoothing == max(1 - scheduler.num_gradients_to_accumulate / 1000, 0)
+    else:
+        assert optim.smoothing == smoothing
@@ -0,0 +1,98 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+
+""" Test the AllGatherBucketer """
+
+import tempfile
+from unittest import mock
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from fairscale.utils.all_gather_bucketer import AllGatherBucketer
+
+
+def _spawn(test_fn, world_size=2, args=()):
+    temp_file_name = tempfile.mkstemp()[1]
+    mp.spawn(test_fn, args=(world_size, temp_file_name, *args), nprocs=world_size, join=True)
+
+
+def _init(rank, world_size, temp_file_name):
+    backend = "nccl" if torch.cuda.is_available() and torch.cuda.device_count() >= world_size else "gloo"
+    dist.init_process_group(init_method="file://" + temp_file_name, backend=backend, rank=rank, world_size=world_size)
+    if backend == "nccl":
+        torch.cuda.set_device(rank)
+        return torch.device("cuda", rank)
+    return torch.device("cpu")
+
+
+def run_all_gather(rank, world_size, temp_file_name, bucket_cap_mb, shard_size):
+    device = _init(rank, world_size, temp_file_name)
+    bucketer = AllGatherBucketer(bucket_cap_mb=bucket_cap_mb)
+
+    shard = torch.ones(shard_size, device=device) * rank
+    output = torch.zeros(shard_size * world_size, device=device)
+
+    callback = mock.MagicMock()
+    with mock.patch("torch.distributed.all_gather", wraps=dist.all_gather) as all_gather:
+        bucketer.all_gather_async(shard, output, dist.group.WORLD, callback_fn=callback)
+
+        input_bytes = shard_size * 4
+        bucket_bytes = bucket_cap_mb * 1024 * 1024
+        if bucket_cap_mb > 0 and input_bytes <= bucket_bytes:
+            assert callback.call_count == 0
+            bucketer.flush()
+        assert callback.call_count == 1
+
+        # a single shard is gathered straight into the output, without a temporary
+        assert all_gather.call_count == 1
+        assert all_gather.call_args[0][0][0].data_ptr() == output.data_ptr()
+    assert callback.call_args[0][0] is output
+
+    expected = torch.arange(world_size, device=device, dtype=torch.float).repeat_interleave(shard_size)
+    assert torch.equal(output, expected)
+
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("bucket_cap_mb", [0, 0.25])
+@pytest.mark.parametrize("shard_size", [1, 262144])
+def test_all_gather(bucket_cap_mb, shard_size):
+    _spawn(run_all_gather, args=(bucket_cap_mb, shard_size))
+
+
+def run_coalesced_all_gather(rank, world_size, temp_file_name):
+    device = _init(rank, world_size, temp_file_name)
+    bucketer = AllGatherBucketer(bucket_cap_mb=0.25)
+
+    shapes = [(1,), (3, 2), (262144,), (5,)]
+    shards = [torch.rand(shape, device=device) for shape in shapes]
+    outputs = [torch.zeros((world_size, *shape), device=device) for shape in shapes]
+
+    with mock.patch("torch.distributed.all_gather", wraps=dist.all_gather) as all_gather:
+        for shard, output in zip(shards, outputs):
+            bucketer.all_gather_async(shard, output, dist.group.WORLD)
+
+        # the big shard is gathered directly, the small ones are pending
+        assert all_gather.call_count == 1
+        bucketer.flush()
+        assert all_gather.call_count == 2
+
+    for shard, output in zip(shards, outputs):
+        reference = [torch.zeros_like(shard) for _ in range(world_size)]
+        dist.all_gather(reference, shard)
+        assert torch.equal(output, torch.stack(reference))
+
+    dist.destroy_process_group()
+
+
+def test_coalesced_all_gather():
+    _spawn(run_coalesced_all_gather)
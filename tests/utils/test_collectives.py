@@ -0,0 +1,69 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the BSD license found in the
+# LICENSE file in the root directory of this source tree.
+
+# pylint: disable=missing-module-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-function-docstring
+
+""" Test the collectives with fallbacks from fairscale.utils.collectives """
+
+import tempfile
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from fairscale.utils.collectives import CollectiveStrategy, all_gather, reduce_scatter
+
+FALLBACK_STRATEGIES = [None, CollectiveStrategy.ALL_REDUCE, CollectiveStrategy.RING]
+
+
+def run_reduce_scatter(rank, world_size, temp_file_name, strategy):
+    dist.init_process_group(init_method="file://" + temp_file_name, backend="gloo", rank=rank, world_size=world_size)
+
+    # Gloo does not implement reduce_scatter, this uses the fallbacks
+    inputs = [torch.arange(6, dtype=torch.float).view(2, 3) * (rank + 1) + i for i in range(world_size)]
+    rank_sum = sum(range(1, world_size + 1))
+    expected = torch.arange(6, dtype=torch.float).view(2, 3) * rank_sum + rank * world_size
+
+    for async_op in [False, True]:
+        output = torch.zeros(2, 3)
+        handle = reduce_scatter(output, inputs, async_op=async_op, strategy=strategy)
+        if async_op:
+            handle.wait()
+        assert torch.equal(output, expected), f"{output} vs {expected}"
+
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("world_size", [2, 3])
+@pytest.mark.parametrize("strategy", FALLBACK_STRATEGIES)
+def test_reduce_scatter(world_size, strategy):
+    temp_file_name = tempfile.mkstemp()[1]
+    mp.spawn(run_reduce_scatter, args=(world_size, temp_file_name, strategy), nprocs=world_size, join=True)
+
+
+def run_all_gather(rank, world_size, temp_file_name, strategy):
+    dist.init_process_group(init_method="file://" + temp_file_name, backend="gloo", rank=rank, world_size=world_size)
+
+    tensor = torch.arange(6, dtype=torch.float).view(2, 3) + rank * 10
+
+    for async_op in [False, True]:
+        outputs = [torch.zeros(2, 3) for _ in range(world_size)]
+        handle = all_gather(outputs, tensor, async_op=async_op, strategy=strategy)
+        if async_op:
+            handle.wait()
+        for r, output in enumerate(outputs):
+            assert torch.equal(output, torch.arange(6, dtype=torch.float).view(2, 3) + r * 10)
+
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("world_size", [2, 3])
+@pytest.mark.parametrize("strategy", FALLBACK_STRATEGIES)
+def test_all_gather(world_size, strategy):
+    temp_file_name = tempfile.mkstemp()[1]
+    mp.spawn(run_all_gather, args=(world_size, temp_file_name, strategy), nprocs=world_size, join=True)
@@ -12,7 +12,7 @@
 from parameterized import parameterized
 import torch
 
-from fairscale.utils.parallel import chunk_and_pad
+from fairscale.utils.parallel import chunk_and_pad, chunk_into
 
 
 @parameterized.expand([[num_chunks] for num_chunks in range(1, 33)])
@@ -24,3 +24,15 @@ def test_chunk_and_pad(num_chunks):
         chunks = chunk_and_pad(tensor_i, num_chunks)
         assert len(chunks) == num_chunks
         assert all(len(chunks[0]) == len(chunk) for chunk in chunks)
+
+
+@parameterized.expand([[num_chunks] for num_chunks in range(1, 33)])
+def test_chunk_into(num_chunks):
+    max_tensor_size = 256
+    tensor = torch.rand(max_tensor_size)
+    for tensor_size in range(1, max_tensor_size + 1):
+        tensor_i = tensor[:tensor_size]
+        chunks = chunk_and_pad(tensor_i, num_chunks)
+        out = torch.zeros((num_chunks, chunks[0].numel()))
+        chunk_into(tensor_i, out)
+        assert torch.equal(out, torch.stack(chunks))
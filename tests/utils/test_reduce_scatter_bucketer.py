@@ -6,11 +6,13 @@
 import functools
 import itertools
 import sys
+import tempfile
 import unittest
 from unittest import mock
 
 from parameterized import parameterized
 import torch
+import torch.multiprocessing as mp
 
 from fairscale.utils.reduce_scatter_bucketer import ReduceScatterBucketer
 from fairscale.utils.testing import dist_init, spawn_for_all_world_sizes
@@ -97,6 +99,75 @@ class TestReduceScatterBucketer(unittest.TestCase):
         assert callback2.call_count == 1
         assert callback3.call_count == 1
 
+    def test_double_buffering(self):
+        spawn_and_init(self._test_double_buffering)
+
+    @staticmethod
+    def _test_double_buffering(rank, group):
+        bucketer = ReduceScatterBucketer(bucket_cap_mb=0.25, num_buckets=2)
+        world_size = group.size()
+        shard_numel = int(bucketer._get_shard_size(4, world_size) * 0.6)
+
+        callbacks = [mock.MagicMock() for _ in range(3)]
+        for callback in callbacks:
+            # write the inputs straight into the bucket
+            slot = bucketer.get_slot(shard_numel, torch.float32, torch.device("cuda"), group, callback)
+            assert slot is not None and slot.shape == (world_size, shard_numel)
+            slot.fill_(1.0)
+
+        # the first bucket was reduced to make room for the third input, the second one is still pending
+        assert callbacks[0].call_count == 1
+        assert callbacks[1].call_count == 0
+        assert callbacks[2].call_count == 0
+
+        bucketer.flush()
+        for callback in callbacks:
+            assert callback.call_count == 1
+            result = callback.call_args[0][0]
+            assert result.shape == (shard_numel,)
+            assert torch.all(result == world_size)
+
+        stats = bucketer.get_stats()
+        assert stats["flushes"] == 3
+        assert stats["in_flight_waits"] == 1
+        assert stats["direct_reductions"] == 0
+        assert 0.5 < stats["mean_occupancy"] < 0.7
+
+
+def run_reduce_scatter_gloo(rank, world_size, temp_file_name):
+    torch.distributed.init_process_group(
+        init_method="file://" + temp_file_name, backend="gloo", rank=rank, world_size=world_size
+    )
+    group = torch.distributed.new_group()
+
+    # Small buckets, so that the double buffering is exercised
+    bucketer = ReduceScatterBucketer(bucket_cap_mb=0.001)
+    callbacks = []
+    for size in [1, 10, 50, 100, 1000]:
+        tensors = [torch.ones(size) * (r + 1) for r in range(world_size)]
+        callback = mock.MagicMock()
+        bucketer.reduce_scatter_async(tensors, group, callback_fn=callback)
+        callbacks.append((callback, size))
+
+    bucketer.flush()
+    for callback, size in callbacks:
+        assert callback.call_count == 1
+        result = callback.call_args[0][0]
+        assert torch.equal(result, torch.ones(size) * (rank + 1) * world_size)
+
+    stats = bucketer.get_stats()
+    assert stats["direct_reductions"] == 1
+    assert stats["flushes"] >= 2
+
+    torch.distributed.destroy_process_group()
+
+
+def test_reduce_scatter_gloo():
+    # Gloo does not implement reduce_scatter, the bucketer relies on the fallbacks
+    world_size = 2
+    temp_file_name = tempfile.mkstemp()[1]
+    mp.spawn(run_reduce_scatter_gloo, args=(world_size, temp_file_name), nprocs=world_size, join=True)
+
 
 def spawn_and_init(fn, args=None, **spawn_kwargs):
     if args is None: